@@ -0,0 +1,464 @@
+'''Benchmarks
+=============
+
+Micro and macro benchmarks of the experiment core, with recorded baselines.
+
+The benchmarks run without a window or any hardware, using the simulated
+devices, so they can run on any Linux box with the experiment dependencies
+installed. Each benchmark reports the best time of several repeats of its
+workload.
+
+To record the baseline of this machine::
+
+    python benchmarks/bench.py --save
+
+And then to run the benchmarks and report any regression against it::
+
+    python benchmarks/bench.py
+
+The baselines are stored in ``benchmarks/baselines.json``, keyed by the
+machine name (``--machine``, defaulting to the host name), since the timings
+are only comparable on the same machine. A benchmark regressed when it is
+slower than its baseline by more than ``--tolerance``. The script exits
+with a non-zero status if any benchmark regressed or failed, whether or not
+a baseline was recorded. ``-k`` only runs the benchmarks whose
+name contains any of the given strings.
+'''
+
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import traceback
+from os.path import join, dirname, abspath
+from timeit import default_timer
+from multiprocessing import Pool
+
+import numpy as np
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+# import first, so that kivy is set up for running without a window
+import forced_choice.simulation
+
+from kivy.factory import Factory
+
+from forced_choice.stages import (
+    ExperimentConfig, AnimalStage, RootStage, extract_odor, select_odor)
+from forced_choice.stats import TrialStats
+from forced_choice.writer import TrialLogWriter
+from forced_choice.graphics import PredictionView, TrialPlot
+from forced_choice.timing import session_clock
+
+data_path = join(dirname(dirname(abspath(__file__))), 'forced_choice', 'data')
+
+baselines_file = join(dirname(abspath(__file__)), 'baselines.json')
+'''The file where the baselines are stored.
+'''
+
+tmp_root = None
+'''The temporary directory of the files written by the benchmarks, while
+they run.
+'''
+
+benchmarks = []
+'''The list of ``(name, func, number, repeat)`` of the benchmarks, in the
+order they run. See :func:`benchmark`.
+'''
+
+
+def benchmark(name, number=None, repeat=5):
+    '''Decorator that adds the function to :attr:`benchmarks`.
+
+    The function does any setup and returns the callable that is timed.
+    It's called ``number`` times per repeat, or if None, as many times as
+    needed to take at least 0.2 seconds, and the best of ``repeat`` repeats
+    is reported.
+    '''
+    def decorator(func):
+        benchmarks.append((name, func, number, repeat))
+        return func
+    return decorator
+
+
+def time_workload(run, number=None, repeat=5, min_time=.2):
+    '''Returns the best time, in seconds, of a single call of ``run``. See
+    :func:`benchmark`.
+    '''
+    def timed(n):
+        ts = default_timer()
+        for _ in range(n):
+            run()
+        return default_timer() - ts
+
+    if number is None:
+        number = 1
+        while True:
+            t = timed(number)
+            if t >= min_time:
+                break
+            number *= 10 if t < min_time / 10. else 2
+
+    return min([timed(number) for _ in range(repeat)]) / number
+
+
+def make_tmp_dir():
+    '''Returns a new temporary directory in :attr:`tmp_root`.
+    '''
+    return tempfile.mkdtemp(dir=tmp_root)
+
+
+def make_config(**kwargs):
+    '''Returns a :class:`~forced_choice.stages.ExperimentConfig` with one
+    block of the default config, updated with ``kwargs``.
+    '''
+    with open(join(data_path, 'config.json')) as fh:
+        opts = json.load(fh)['_experiment']['default']
+    opts.update({
+        'num_blocks': 1, 'num_trials': [500], 'odor_method': ['random2'],
+        'odor_selection': [['p1', 'p2', 'p3', 'p4']], 'odor_equalizer': [8],
+        'wait_for_nose_poke': [True], 'odor_beta': [0], 'good_iti': [3],
+        'bad_iti': [4], 'incomplete_iti': [4], 'max_nose_poke': [10.],
+        'max_decision_duration': [20.], 'min_nose_poke': [0],
+        'odor_delay': [0], 'sound_cue_delay': [0], 'sound_dur': [0],
+        'num_pellets': [2], 'air_rate': [0], 'mfc_a_rate': [.1],
+        'mfc_b_rate': [.1], 'odor_path': join(data_path, 'odor_list.txt')})
+    opts.update(kwargs)
+    return ExperimentConfig(n_valve_boards=2, **opts)
+
+
+odor_selection = [
+    'p1', 'p2(80)', 'p3/p4', 'p5(90)/p6(60)@[30;50;70]', 'p8@[100]',
+    'p9/p10@[20;40;60;80]', 'p11(50)', 'p12/p13(75)', 'p14', 'p15(10)']
+
+
+@benchmark('extract_odor')
+def bench_extract_odor():
+    return lambda: extract_odor(odor_selection, 0, 16)
+
+
+@benchmark('select_odor')
+def bench_select_odor():
+    odors = [o for elems in extract_odor(odor_selection, 0, 16)
+             for o in elems]
+
+    def run():
+        for odor in odors:
+            select_odor(odor)
+    return run
+
+
+@benchmark('compute_odors.constant')
+def bench_compute_constant():
+    config = make_config(odor_method=['constant'], odor_selection=[['p1']])
+    return lambda: config.compute_odors(seed=0)
+
+
+@benchmark('compute_odors.random')
+def bench_compute_random():
+    config = make_config(odor_method=['random'], odor_equalizer=[0])
+    return lambda: config.compute_odors(seed=0)
+
+
+@benchmark('compute_odors.random2')
+def bench_compute_random2():
+    config = make_config(odor_method=['random2'], odor_equalizer=[0])
+    return lambda: config.compute_odors(seed=0)
+
+
+@benchmark('compute_odors.random2_equalized')
+def bench_compute_random2_equalized():
+    config = make_config(odor_method=['random2'], odor_equalizer=[8])
+    return lambda: config.compute_odors(seed=0)
+
+
+@benchmark('compute_odors.list')
+def bench_compute_list():
+    tmp = make_tmp_dir()
+    fname = join(tmp, 'odors.csv')
+    with open(fname, 'w') as fh:
+        fh.write('0,{}\n'.format(','.join(['p1', 'p2', 'p3', 'p4'] * 125)))
+    config = make_config(odor_method=['list'], odor_selection=[[fname]])
+    return lambda: config.compute_odors(seed=0)
+
+
+@benchmark('do_equal_random.n8_m4_cond1')
+def bench_equal_random_8():
+    config = make_config()
+    config.compute_odors(seed=0)
+    return lambda: config.do_equal_random(8, 4, 1)
+
+
+@benchmark('do_equal_random.n600_m6_cond2')
+def bench_equal_random_600():
+    config = make_config()
+    config.compute_odors(seed=0)
+    return lambda: config.do_equal_random(600, 6, 2)
+
+
+@benchmark('do_equal_random.n2400_m8_cond3', repeat=3)
+def bench_equal_random_2400():
+    config = make_config()
+    config.compute_odors(seed=0)
+    return lambda: config.do_equal_random(2400, 8, 3)
+
+
+def make_animal_stage(config, history=0):
+    '''Returns a :class:`~forced_choice.stages.AnimalStage` for the first
+    block of the computed config, with the GUI widgets it uses, and
+    ``history`` outcomes of each odor in its stats.
+    '''
+    stage = AnimalStage()
+    stage.config = config
+    stage.animal_id = 'bench'
+    stage.block = stage.trial = 0
+
+    view = PredictionView(knsname='gui_prediction_container')
+    view.set_predictions(
+        [[('p', 'l')] * len(trials) for trials in config.trial_odors])
+    graph = Factory.TrialGraph(knsname='gui_outcome')
+    graph.add_plot(TrialPlot())
+    # knspace only keeps weak references
+    stage._bench_refs = [view, graph]
+
+    stage.stats = stats = TrialStats(
+        config.n_valve_boards * 8, 10, config.beta_trials_max)
+    stage.odor_opt_valves = valves = np.array(
+        [select_odor(o)[0] for o in config.odor_opts[0]])
+    for i in range(history):
+        for valve in valves:
+            stats.add_outcome('pass' if i % 3 else 'fail', int(valve), 'l')
+    return stage
+
+
+@benchmark('update_trial_odor.long_history')
+def bench_update_trial_odor():
+    config = make_config(odor_beta=[3], beta_trials_max=1000)
+    config.compute_odors(seed=0)
+    stage = make_animal_stage(config, history=20000)
+    n = len(config.trial_odors[0])
+
+    def run():
+        for trial in range(n):
+            stage.trial = trial
+            stage.update_trial_odor()
+    return run
+
+
+@benchmark('post_trial.log', number=1)
+def bench_post_trial():
+    config = make_config()
+    config.compute_odors(seed=0)
+    stage = make_animal_stage(config)
+    tmp = make_tmp_dir()
+    root = RootStage(knsname='exp_root')
+    root.log_filename = join(tmp, '{animal}.csv')
+    root.session_filename = join(tmp, '{animal}.fcs')
+    stage._bench_refs.append(root)
+
+    odor = config.trial_odors[0][0]
+    stage.odor, stage.side, stage.side_went = odor, 'l', 'l'
+    stage.outcome, stage.reward_side, stage.iti = 'pass', 'feeder_l', 3
+    stage.trial_start_time = '00:00:00'
+
+    def run():
+        root.log_writer = writer = TrialLogWriter()
+        writer.start()
+        for trial in range(1000):
+            ts = session_clock.now()
+            stage.trial = trial
+            stage.trial_start_ts = ts
+            stage.nose_poke_ts = ts + 1
+            stage.nose_poke_exit_ts = ts + 2
+            stage.reward_entry_ts = ts + 3
+            stage.post_trial()
+        writer.stop()
+        root.log_writer = None
+    return run
+
+
+def _simulate_block(json_config_path, n_trials):
+    '''Runs a simulated session of a block in this process and returns its
+    duration in seconds.
+    '''
+    from forced_choice.agents import simulate_agent
+    model = {'ttnp': ['constant', 1.], 'tinp': ['constant', .5],
+             'ttrp': ['constant', 1.], 'reward_visit': ['constant', .2]}
+    ts = default_timer()
+    res = simulate_agent(json_config_path, 'bench', model, seed=0)
+    t = default_timer() - ts
+    if res['trials'] != n_trials:
+        raise Exception('Simulated {} trials instead of {}'.format(
+            res['trials'], n_trials))
+    return t
+
+
+@benchmark('simulated_block.200_trials', number=1, repeat=3)
+def bench_simulated_block():
+    n_trials = 200
+    tmp = make_tmp_dir()
+    with open(join(data_path, 'config.json')) as fh:
+        settings = json.load(fh)
+    settings['_experiment']['default'].update({
+        'num_blocks': 1, 'num_trials': [n_trials],
+        'odor_method': ['random2'], 'odor_selection': [['p1', 'p2']],
+        'wait_for_nose_poke': [True], 'odor_equalizer': [8],
+        'odor_path': join(data_path, 'odor_list.txt')})
+    settings['devices'].update({
+        'log_filename': join(tmp, '{animal}.csv'),
+        'session_filename': join(tmp, '{animal}.fcs'),
+        'events_filename': join(tmp, '{animal}.fce'),
+        'schedule_path': '', 'sound_file_l': join(data_path, 'Tone.wav'),
+        'sound_file_r': join(data_path, 'Tone.wav')})
+    fname = join(tmp, 'config.json')
+    with open(fname, 'w') as fh:
+        json.dump(settings, fh)
+
+    # each session needs a fresh process, so time it in the process
+    def run():
+        pool = Pool(1, maxtasksperchild=1)
+        try:
+            times.append(pool.apply(_simulate_block, (fname, n_trials)))
+        finally:
+            pool.close()
+            pool.join()
+    times = []
+    return run, times
+
+
+def run_benchmarks(names=None):
+    '''Runs the benchmarks whose name contain any of ``names``, or all if
+    None, and returns a dict mapping the name of each benchmark to its time,
+    or to None if it failed.
+    '''
+    global tmp_root
+    tmp_root = tempfile.mkdtemp()
+    try:
+        return _run_benchmarks(names)
+    finally:
+        shutil.rmtree(tmp_root, ignore_errors=True)
+        tmp_root = None
+
+
+def _run_benchmarks(names):
+    results = {}
+    for name, func, number, repeat in benchmarks:
+        if names and not any([n in name for n in names]):
+            continue
+
+        try:
+            run = func()
+            if isinstance(run, tuple):
+                # the workload measures its own times
+                run, times = run
+                for _ in range(repeat):
+                    run()
+                t = min(times)
+            else:
+                t = time_workload(run, number, repeat)
+        except Exception:
+            traceback.print_exc()
+            t = None
+        results[name] = t
+        print('{:<40} {}'.format(name, format_time(t)))
+        sys.stdout.flush()
+    return results
+
+
+def format_time(t):
+    '''Formats the time in seconds with a suitable unit.
+    '''
+    if t is None:
+        return 'failed'
+    for unit, scale in (('s', 1.), ('ms', 1e3), ('us', 1e6)):
+        if t * scale >= 1.:
+            return '{:.3f} {}'.format(t * scale, unit)
+    return '{:.3f} ns'.format(t * 1e9)
+
+
+def compare(results, baseline, tolerance):
+    '''Prints the results compared to the baseline and returns the list of
+    the names of the benchmarks that regressed.
+    '''
+    regressed = []
+    print('\n{:<40} {:>12} {:>12} {:>7}'.format(
+        'benchmark', 'time', 'baseline', 'ratio'))
+    for name, t in results.items():
+        base = baseline.get(name)
+        if t is None or not base:
+            print('{:<40} {:>12} {:>12}'.format(
+                name, format_time(t), format_time(base) if base else '-'))
+            continue
+
+        ratio = t / base
+        status = ''
+        if ratio > 1 + tolerance:
+            status = 'REGRESSION'
+            regressed.append(name)
+        elif ratio < 1 - tolerance:
+            status = 'faster'
+        print('{:<40} {:>12} {:>12} {:>7.2f} {}'.format(
+            name, format_time(t), format_time(base), ratio, status))
+    return regressed
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Runs the benchmarks and compares them to the baseline.')
+    parser.add_argument(
+        '-k', '--select', nargs='+', default=None,
+        help='Only run the benchmarks whose name contain any of these.')
+    parser.add_argument(
+        '--save', action='store_true',
+        help='Save the results as the baseline of the machine.')
+    parser.add_argument(
+        '--machine', default=platform.node(),
+        help='The name of the machine whose baseline is used.')
+    parser.add_argument(
+        '--tolerance', type=float, default=.2,
+        help='The fraction by which a benchmark may be slower than the '
+        'baseline before it is a regression.')
+    parser.add_argument(
+        '--baselines', default=baselines_file,
+        help='The json file of the baselines.')
+    args = parser.parse_args(args)
+
+    try:
+        with open(args.baselines) as fh:
+            baselines = json.load(fh)
+    except IOError:
+        baselines = {}
+
+    results = run_benchmarks(args.select)
+    failed = [name for name, t in results.items() if t is None]
+    if args.save:
+        machine = baselines.setdefault(args.machine, {})
+        machine['platform'] = platform.platform()
+        machine['python'] = platform.python_version()
+        machine.setdefault('results', {}).update(
+            {k: v for k, v in results.items() if v is not None})
+        with open(args.baselines, 'w') as fh:
+            json.dump(baselines, fh, indent=2, sort_keys=True)
+        print('\nSaved the baseline of "{}"'.format(args.machine))
+        regressed = []
+    elif args.machine not in baselines:
+        compare(results, {}, args.tolerance)
+        print('\nNo baseline recorded for "{}", run with --save to record '
+              'it'.format(args.machine))
+        regressed = []
+    else:
+        regressed = compare(
+            results, baselines[args.machine]['results'], args.tolerance)
+
+    if regressed or failed:
+        print('\n{} regressed, {} failed{}'.format(
+            len(regressed), len(failed),
+            ': ' + ', '.join(failed) if failed else ''))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
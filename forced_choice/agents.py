@@ -0,0 +1,320 @@
+'''Agents
+=========
+
+Synthetic animals that drive the simulated input devices.
+
+An :class:`Agent` plays the part of the animal in a simulated session. It
+watches the trial stages and sets the ``nose_beam``, ``reward_beam_l``, and
+``reward_beam_r`` channels of the simulated
+:class:`~forced_choice.devices.DAQInDeviceSim` like an animal breaking the
+beams would. When and where it goes is decided by its
+:class:`BehaviorModel`, e.g. how long it takes to poke its nose and how
+accurately it picks the rewarded side of each odor.
+
+Agents are typically run with a
+:class:`~forced_choice.simulation.HeadlessExperiment`, where the events are
+scheduled on the virtual clock. :func:`simulate_agents` runs the sessions of
+many animals in parallel, one process per animal.
+
+A latency of a :class:`BehaviorModel` is a list, whose first element is the
+name of the distribution followed by its parameters, in seconds:
+
+    ``['constant', value]``: Always ``value``.
+    ``['uniform', low, high]``: Uniform between ``low`` and ``high``.
+    ``['exponential', scale]``: Exponential with mean ``scale``.
+    ``['normal', mean, std]``: Normal, clipped at zero.
+    ``['lognormal', median, sigma]``: Log-normal with the given median and
+    ``sigma`` of the underlying normal distribution.
+'''
+
+import os
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+# import first, so that kivy is set up for running without a window
+from forced_choice.simulation import HeadlessExperiment
+
+from kivy.clock import Clock
+from kivy.uix.behaviors.knspace import knspace
+
+from forced_choice.stages import select_odor
+
+__all__ = ('sample_latency', 'BehaviorModel', 'Agent', 'simulate_agent',
+           'simulate_agents')
+
+
+def sample_latency(rng, spec):
+    '''Returns a sample, in seconds, of the latency distribution ``spec``
+    (see :mod:`forced_choice.agents`) using the numpy ``RandomState``
+    ``rng``.
+    '''
+    kind, params = spec[0], spec[1:]
+    if kind == 'constant':
+        return float(params[0])
+    if kind == 'uniform':
+        return rng.uniform(params[0], params[1])
+    if kind == 'exponential':
+        return rng.exponential(params[0])
+    if kind == 'normal':
+        return max(rng.normal(params[0], params[1]), 0.)
+    if kind == 'lognormal':
+        return rng.lognormal(np.log(params[0]), params[1])
+    raise ValueError('Unknown latency distribution "{}"'.format(kind))
+
+
+class BehaviorModel(object):
+    '''Describes how an :class:`Agent` behaves in the trials.
+
+    All the attributes can be set as keyword arguments, e.g. from a json
+    dict.
+    '''
+
+    ttnp = ['lognormal', 2., .5]
+    '''The latency distribution of the time from the start of the trial until
+    the nose poke.
+    '''
+
+    tinp = ['lognormal', 1., .3]
+    '''The latency distribution of the time spent in the nose port.
+    '''
+
+    ttrp = ['lognormal', 1.5, .4]
+    '''The latency distribution of the time from the nose port exit until
+    the reward port entry.
+    '''
+
+    reward_visit = ['constant', .5]
+    '''The latency distribution of the time spent in the reward port.
+    '''
+
+    accuracy = .8
+    '''The probability of going to the rewarded side, for odors not in
+    :attr:`odor_accuracy`.
+    '''
+
+    odor_accuracy = {}
+    '''A dict mapping odor valve indices to the probability of going to the
+    rewarded side for that odor.
+    '''
+
+    side_bias = .5
+    '''The probability of going to the right side when the trial does not
+    have a rewarded side, or when the agent goes to the wrong side of a
+    trial rewarded on both sides.
+    '''
+
+    miss = 0.
+    '''The probability of not going to any reward port after the nose poke.
+    '''
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            if not hasattr(BehaviorModel, key):
+                raise ValueError('Unknown behavior model option "{}"'.
+                                 format(key))
+            setattr(self, key, value)
+        self.odor_accuracy = {
+            int(k): v for k, v in dict(self.odor_accuracy).items()}
+
+    def get_accuracy(self, odor):
+        '''Returns the probability of going to the rewarded side for the odor
+        valve index, which is None for trials without an odor.
+        '''
+        if odor is None:
+            return self.accuracy
+        return self.odor_accuracy.get(odor, self.accuracy)
+
+    def choose_side(self, rng, odor, side):
+        '''Returns the side, ``'l'`` or ``'r'``, the agent goes to in a trial
+        of the odor valve index that rewards ``side``, or None if it doesn't
+        go to any side.
+        '''
+        if self.miss and rng.uniform() < self.miss:
+            return None
+
+        random_side = 'r' if rng.uniform() < self.side_bias else 'l'
+        if side not in ('l', 'r'):
+            return random_side
+        if rng.uniform() < self.get_accuracy(odor):
+            return side
+        return 'l' if side == 'r' else 'r'
+
+
+class Agent(object):
+    '''A synthetic animal that drives the beams of the simulated input device,
+    :attr:`device`, according to its :attr:`model`.
+
+    Once attached with :meth:`attach`, it pokes its nose when the trial waits
+    for the nose poke, leaves the nose port, and goes to a reward port when
+    the trial waits for it, each after a latency sampled from the
+    :attr:`model`. All the beam changes are scheduled with the kivy
+    ``Clock``.
+    '''
+
+    model = None
+    '''The :class:`BehaviorModel` of the agent.
+    '''
+
+    rng = None
+    '''The numpy ``RandomState`` used to sample the behavior.
+    '''
+
+    device = None
+    '''The simulated input device whose beams are driven. Defaults to
+    ``knspace.daqin`` when attached.
+    '''
+
+    stage = None
+    '''The :class:`~forced_choice.stages.AnimalStage` whose trials the agent
+    responds to.
+    '''
+
+    _bindings = []
+
+    _events = []
+
+    def __init__(self, model=None, seed=None, **kwargs):
+        self.model = model if model is not None else BehaviorModel(**kwargs)
+        self.rng = np.random.RandomState(seed)
+        self._bindings = []
+        self._events = []
+
+    def attach(self, device=None):
+        '''Starts responding to the trials of the experiment, which must
+        already be started.
+        '''
+        self.device = device if device is not None else knspace.daqin
+        self.stage = knspace.exp_animal_stage
+        for name, callback in (
+                ('exp_nose_poke_wait', self.nose_poke),
+                ('exp_nose_poke', self.nose_poke_exit),
+                ('exp_decision', self.reward_entry)):
+            stage = getattr(knspace, name)
+            uid = stage.fbind('on_stage_start', callback)
+            self._bindings.append((stage, uid))
+
+    def detach(self):
+        '''Stops responding to the trials and cancels all the scheduled beam
+        changes.
+        '''
+        for stage, uid in self._bindings:
+            stage.unbind_uid('on_stage_start', uid)
+        self._bindings = []
+        for event in self._events:
+            event.cancel()
+        self._events = []
+
+    def set_beam(self, name, state, *largs):
+        '''Sets the beam ``name``, e.g. ``nose_beam``, of :attr:`device` to
+        ``state``.
+        '''
+        setattr(self.device, name, state)
+
+    def schedule_beam(self, name, state, latency):
+        '''Sets the beam ``name`` to ``state`` after ``latency``
+        seconds.
+        '''
+        events = self._events = [e for e in self._events if e.is_triggered]
+        events.append(Clock.schedule_once(
+            partial(self.set_beam, name, state), latency))
+
+    def nose_poke(self, *largs):
+        '''Called when the trial waits for the nose poke.
+        '''
+        self.schedule_beam(
+            'nose_beam', True, sample_latency(self.rng, self.model.ttnp))
+
+    def nose_poke_exit(self, *largs):
+        '''Called when the trial waits for the nose port exit.
+        '''
+        self.schedule_beam(
+            'nose_beam', False, sample_latency(self.rng, self.model.tinp))
+
+    def reward_entry(self, *largs):
+        '''Called when the trial waits for the reward port entry.
+        '''
+        stage, model, rng = self.stage, self.model, self.rng
+        odor = stage.odor
+        side = model.choose_side(
+            rng, None if odor is None else select_odor(odor)[0], stage.side)
+        if side is None:
+            return
+
+        name = 'reward_beam_' + side
+        latency = sample_latency(rng, model.ttrp)
+        self.schedule_beam(name, True, latency)
+        self.schedule_beam(
+            name, False, latency + sample_latency(rng, model.reward_visit))
+
+
+def simulate_agent(json_config_path, animal_id, model=None, seed=None,
+                   experiment='default', **kwargs):
+    '''Runs a simulated session of the animal driven by an :class:`Agent`.
+
+    :Parameters:
+
+        `json_config_path`: str
+            The json config file of the experiment.
+        `animal_id`: str
+            The animal id.
+        `model`: dict
+            The :class:`BehaviorModel` options.
+        `seed`: int
+            The seed of the agent's random numbers.
+        `experiment`: str
+            The name of the experiment in the json config file.
+        `kwargs`:
+            Passed on to the
+            :class:`~forced_choice.simulation.HeadlessExperiment`.
+
+    :returns:
+
+        A dict with the ``animal_id``, the number of ``trials``, and the
+        simulated ``duration`` of the session.
+    '''
+    agent = Agent(BehaviorModel(**(model or {})), seed=seed)
+    sim = HeadlessExperiment(
+        json_config_path, [animal_id], experiment, agents=[agent], **kwargs)
+    duration = sim.run()
+    return {'animal_id': animal_id, 'trials': sim.trials,
+            'duration': duration}
+
+
+def _simulate_agent(args):
+    '''Pool worker calling :func:`simulate_agent`.
+    '''
+    args, kwargs = args
+    return simulate_agent(*args, **kwargs)
+
+
+def simulate_agents(json_config_path, animal_ids, model=None, seed=None,
+                    experiment='default', processes=None, **kwargs):
+    '''Runs the simulated sessions of all the animals with
+    :func:`simulate_agent`, each in its own process of a pool of processes.
+
+    The ``seed`` of each animal is ``seed`` plus the animal's index, or None
+    if ``seed`` is None. The other parameters are as in
+    :func:`simulate_agent`, and ``processes`` is the number of processes to
+    use, defaulting to the number of cpus.
+
+    :returns:
+
+        The list of the results of :func:`simulate_agent`, one for each
+        animal.
+    '''
+    json_config_path = os.path.abspath(json_config_path)
+    tasks = [((json_config_path, animal_id, model,
+               None if seed is None else seed + i, experiment), kwargs)
+             for i, animal_id in enumerate(animal_ids)]
+
+    # each session needs its own process because the kivy Clock and the
+    # knspace names are global
+    pool = Pool(min(processes or cpu_count(), len(tasks)) or 1,
+                maxtasksperchild=1)
+    try:
+        return pool.map(_simulate_agent, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,519 @@
+'''Audio
+========
+
+A low latency engine for the sound cues.
+
+Rather than starting a media player for every cue, the :class:`CueEngine`
+decodes the cue files into PCM buffers once, when the cues are added, and
+mixes the playing cues from memory into the blocks requested by its sink.
+Besides wav files, a cue can be a pure tone synthesized from its frequency
+and duration, given as ``tone:<frequency>:<duration>``, e.g.
+``tone:4000:0.5`` for a 4 kHz half second tone.
+
+The sink pulls the audio from the engine a block at a time, so the onset
+latency of a cue is bounded by the duration of a block plus the output
+latency of the sink. For each cue played, the engine records the time it
+was requested and the time its first sample was estimated to be output in
+:attr:`CueEngine.onsets`. :meth:`AudioCueDevice.get_onset` returns them for
+the last cue played by the device, from which the
+:class:`~forced_choice.stages.AnimalStage` logs the onset latency of every
+trial.
+
+The sinks are:
+
+    :class:`SoundDeviceSink`: Plays to the sound card using the
+    ``sounddevice`` package, which is only required for this sink.
+    :class:`NullSink`: Discards the audio, pulling it with the kivy
+    ``Clock``. Useful for testing and simulations.
+    :class:`FileSink`: Like :class:`NullSink`, but writes the audio pulled
+    while cues are played to a wav file.
+
+:class:`AudioCueDevice` is the moa device playing a cue of an engine, used
+in place of the ffpyplayer audio device when
+:attr:`~forced_choice.stages.RootStage.sound_engine` is ``'memory'``.
+'''
+
+import wave
+from threading import Lock
+
+import numpy as np
+
+from moa.device.digital import ButtonChannel
+
+from kivy.clock import Clock
+from kivy.properties import ObjectProperty, StringProperty
+from kivy import resources
+
+from forced_choice.timing import session_clock
+
+__all__ = ('decode_wav', 'synthesize_tone', 'load_cue', 'CueEngine',
+           'NullSink', 'FileSink', 'SoundDeviceSink', 'create_sink',
+           'AudioCueDevice')
+
+
+def decode_wav(filename, sample_rate, channels=2):
+    '''Decodes the wav file and returns it as a float32 numpy array of shape
+    ``(frames, channels)`` with values between -1 and 1, resampled to
+    ``sample_rate``.
+    '''
+    fh = wave.open(filename, 'rb')
+    try:
+        n_channels = fh.getnchannels()
+        width = fh.getsampwidth()
+        rate = fh.getframerate()
+        data = fh.readframes(fh.getnframes())
+    finally:
+        fh.close()
+
+    if width == 1:
+        pcm = (np.frombuffer(data, dtype=np.uint8).astype(np.float32) -
+               128) / 128.
+    elif width in (2, 4):
+        dtype = '<i{}'.format(width)
+        pcm = np.frombuffer(data, dtype=dtype).astype(np.float32) / \
+            float(1 << (8 * width - 1))
+    else:
+        raise ValueError('{}: {} byte samples are not supported'.format(
+            filename, width))
+    pcm = pcm.reshape(-1, n_channels)
+
+    if rate != sample_rate and len(pcm):
+        n = int(round(len(pcm) * sample_rate / float(rate)))
+        t = np.arange(n) * (rate / float(sample_rate))
+        src = np.arange(len(pcm))
+        pcm = np.stack(
+            [np.interp(t, src, pcm[:, i]) for i in range(n_channels)],
+            axis=1).astype(np.float32)
+
+    if n_channels == channels:
+        return np.ascontiguousarray(pcm)
+    if n_channels == 1:
+        return np.ascontiguousarray(np.repeat(pcm, channels, axis=1))
+    return np.ascontiguousarray(
+        np.repeat(pcm.mean(axis=1, keepdims=True), channels, axis=1))
+
+
+def synthesize_tone(frequency, duration, sample_rate, channels=2,
+                    amplitude=.5, ramp=.005):
+    '''Returns a pure tone of ``frequency`` Hz and ``duration`` seconds as a
+    float32 numpy array of shape ``(frames, channels)``. The tone is ramped
+    up and down over ``ramp`` seconds to prevent clicks.
+    '''
+    n = int(round(duration * sample_rate))
+    t = np.arange(n) / float(sample_rate)
+    tone = amplitude * np.sin(2 * np.pi * frequency * t)
+
+    k = min(int(ramp * sample_rate), n // 2)
+    if k:
+        window = np.linspace(0., 1., k)
+        tone[:k] *= window
+        tone[n - k:] *= window[::-1]
+    return np.ascontiguousarray(
+        np.repeat(tone.astype(np.float32)[:, None], channels, axis=1))
+
+
+def load_cue(spec, sample_rate, channels=2):
+    '''Returns the PCM buffer of the cue ``spec``, either a
+    ``tone:<frequency>:<duration>`` tone or a wav filename, which is found
+    with the kivy resources.
+    '''
+    if spec.startswith('tone:'):
+        try:
+            _, frequency, duration = spec.split(':')
+            frequency, duration = float(frequency), float(duration)
+        except ValueError:
+            raise ValueError('"{}" is not a valid tone, it must be '
+                             '"tone:<frequency>:<duration>"'.format(spec))
+        return synthesize_tone(frequency, duration, sample_rate, channels)
+
+    filename = resources.resource_find(spec)
+    if filename is None:
+        raise IOError('Cannot find the sound file "{}"'.format(spec))
+    return decode_wav(filename, sample_rate, channels)
+
+
+class CueEngine(object):
+    '''Plays the cues from memory to a sink.
+
+    Cues are added with :meth:`add_cue`, after which they are played with
+    :meth:`play` once the engine is opened with :meth:`open`. :meth:`play`
+    and :meth:`stop` may be called from the kivy thread while the sink pulls
+    the audio with :meth:`render`, possibly from its own thread.
+    '''
+
+    sample_rate = 44100
+    '''The sample rate of the audio.
+    '''
+
+    channels = 2
+    '''The number of channels of the audio.
+    '''
+
+    sink = None
+    '''The sink that outputs the audio, e.g. a :class:`NullSink`.
+    '''
+
+    cues = {}
+    '''A dict mapping cue names to their float32 PCM buffers.
+    '''
+
+    onsets = []
+    '''A list with a ``(name, requested, onset)`` tuple for each cue played,
+    where ``requested`` is the time :meth:`play` was called and ``onset`` is
+    the estimated time the first sample of the cue was output. Both are in
+    the :attr:`~forced_choice.timing.session_clock` time, and the onset
+    latency is ``onset - requested``.
+    '''
+
+    _voices = []
+
+    _requests = []
+
+    _lock = None
+
+    _open_count = 0
+
+    def __init__(self, sink, sample_rate=44100, channels=2):
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.cues = {}
+        self.onsets = []
+        self._voices = []
+        self._requests = []
+        self._lock = Lock()
+
+    def add_cue(self, name, spec):
+        '''Decodes, or synthesizes, the cue ``spec`` (see :func:`load_cue`)
+        and adds it as ``name``.
+        '''
+        self.cues[name] = load_cue(spec, self.sample_rate, self.channels)
+
+    def open(self):
+        '''Opens the sink. Each call must be matched by a call to
+        :meth:`close`.
+        '''
+        self._open_count += 1
+        if self._open_count == 1:
+            self.sink.open(self)
+
+    def close(self):
+        '''Closes the sink once it's closed as many times as it was opened.
+        All the playing cues are stopped.
+        '''
+        if not self._open_count:
+            return
+        self._open_count -= 1
+        if not self._open_count:
+            self.sink.close()
+            with self._lock:
+                self._voices = []
+                self._requests = []
+
+    def play(self, name):
+        '''Starts playing the cue ``name`` from its start. If it's already
+        playing, it's restarted.
+
+        :returns:
+
+            The time the cue was requested, in the
+            :attr:`~forced_choice.timing.session_clock` time, which can be
+            passed to :meth:`get_onset`.
+        '''
+        buf = self.cues[name]
+        requested = session_clock.now()
+        with self._lock:
+            self._requests.append((name, buf, requested))
+        self.sink.wake()
+        return requested
+
+    def stop(self, name=None):
+        '''Stops playing the cue ``name``, or all the cues if None.
+        '''
+        with self._lock:
+            if name is None:
+                self._voices = []
+                self._requests = []
+                return
+            self._voices = [v for v in self._voices if v[0] != name]
+            self._requests = [r for r in self._requests if r[0] != name]
+
+    def render(self, frames, delay=0.):
+        '''Returns the next ``frames`` frames of the audio, mixed from all
+        the playing cues, as a float32 array of shape ``(frames, channels)``.
+        Called by the sink, ``delay`` is its estimate of the duration, in
+        seconds, until the first of the frames is output.
+        '''
+        out = np.zeros((frames, self.channels), dtype=np.float32)
+        with self._lock:
+            if self._requests:
+                onset = session_clock.now() + delay
+                names = set(r[0] for r in self._requests)
+                voices = [v for v in self._voices if v[0] not in names]
+                for name, buf, requested in self._requests:
+                    voices = [v for v in voices if v[0] != name]
+                    voices.append([name, buf, 0])
+                    self.onsets.append((name, requested, onset))
+                self._voices = voices
+                self._requests = []
+
+            remaining = []
+            for voice in self._voices:
+                name, buf, pos = voice
+                n = min(frames, len(buf) - pos)
+                out[:n] += buf[pos:pos + n]
+                voice[2] = pos + n
+                if voice[2] < len(buf):
+                    remaining.append(voice)
+            self._voices = remaining
+
+        np.clip(out, -1., 1., out=out)
+        return out
+
+    def get_onset(self, name, requested):
+        '''Returns the estimated time the first sample of the cue ``name``,
+        requested at time ``requested`` (as returned by :meth:`play`), was
+        output, or None if it wasn't output, e.g. because it was stopped
+        before the sink pulled it.
+        '''
+        with self._lock:
+            for cue, t, onset in reversed(self.onsets):
+                if cue == name and t == requested:
+                    return onset
+                if t < requested:
+                    break
+        return None
+
+    def is_playing(self, name=None):
+        '''Returns whether the cue ``name``, or any cue if None, is playing
+        or requested.
+        '''
+        with self._lock:
+            if name is None:
+                return bool(self._voices or self._requests)
+            return any(v[0] == name for v in self._voices) or \
+                any(r[0] == name for r in self._requests)
+
+
+class NullSink(object):
+    '''A sink that pulls the audio from the engine with the kivy ``Clock``,
+    every ``block_duration`` seconds, and discards it.
+
+    The audio is only pulled while cues are playing, so that e.g. a
+    simulation on the virtual clock is not stepped every block when no cue
+    is played.
+    '''
+
+    block_duration = .005
+    '''The interval, in seconds, at which the audio is pulled.
+    '''
+
+    engine = None
+    '''The :class:`CueEngine` when opened.
+    '''
+
+    _event = None
+
+    _last = 0.
+
+    _frac = 0.
+
+    def __init__(self, block_duration=.005):
+        self.block_duration = block_duration
+
+    def open(self, engine):
+        self.engine = engine
+
+    def close(self):
+        if self._event is not None:
+            self._event.cancel()
+            self._event = None
+        self.engine = None
+
+    def wake(self):
+        '''Called by the engine when a cue is played, to start pulling the
+        audio.
+        '''
+        if self._event is None and self.engine is not None:
+            self._last = Clock.time()
+            self._frac = 0.
+            self._event = Clock.schedule_interval(
+                self._pull, self.block_duration)
+
+    def _pull(self, *largs):
+        engine = self.engine
+        t = Clock.time()
+        n = (t - self._last) * engine.sample_rate + self._frac
+        self._last = t
+        frames = int(n)
+        self._frac = n - frames
+        if frames:
+            self.write(engine.render(frames))
+
+        if not engine.is_playing():
+            self._event.cancel()
+            self._event = None
+
+    def write(self, data):
+        '''Called with each block of audio pulled from the engine.
+        '''
+        pass
+
+
+class FileSink(NullSink):
+    '''A :class:`NullSink` that writes the audio it pulls to the 16 bit wav
+    file ``filename``. Like :class:`NullSink`, the silence between cues is
+    not pulled, so it's not written.
+    '''
+
+    filename = ''
+    '''The wav filename.
+    '''
+
+    _fh = None
+
+    def __init__(self, filename, **kwargs):
+        super(FileSink, self).__init__(**kwargs)
+        self.filename = filename
+
+    def open(self, engine):
+        fh = self._fh = wave.open(self.filename, 'wb')
+        fh.setnchannels(engine.channels)
+        fh.setsampwidth(2)
+        fh.setframerate(engine.sample_rate)
+        super(FileSink, self).open(engine)
+
+    def close(self):
+        super(FileSink, self).close()
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def write(self, data):
+        self._fh.writeframes((data * 32767).astype('<i2').tobytes())
+
+
+class SoundDeviceSink(object):
+    '''A sink that plays the audio on the sound card using a ``sounddevice``
+    output stream, which pulls the audio from the engine in its own thread.
+    '''
+
+    block_size = 256
+    '''The number of frames pulled at a time.
+    '''
+
+    device = None
+    '''The ``sounddevice`` output device, or None for the default device.
+    '''
+
+    latency = 'low'
+    '''The ``sounddevice`` latency of the stream.
+    '''
+
+    engine = None
+    '''The :class:`CueEngine` when opened.
+    '''
+
+    stream = None
+    '''The ``sounddevice.OutputStream`` when opened.
+    '''
+
+    def __init__(self, block_size=256, device=None, latency='low'):
+        self.block_size = block_size
+        self.device = device
+        self.latency = latency
+
+    def open(self, engine):
+        import sounddevice
+        self.engine = engine
+        stream = self.stream = sounddevice.OutputStream(
+            samplerate=engine.sample_rate, channels=engine.channels,
+            dtype='float32', blocksize=self.block_size, device=self.device,
+            latency=self.latency, callback=self._callback)
+        stream.start()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+        self.engine = None
+
+    def wake(self):
+        pass
+
+    def _callback(self, outdata, frames, time_info, status):
+        delay = max(time_info.outputBufferDacTime - time_info.currentTime, 0.)
+        outdata[:] = self.engine.render(frames, delay)
+
+
+def create_sink(name, filename=''):
+    '''Returns a new sink given its ``name``, ``'device'``, ``'null'``, or
+    ``'file'``, in which case it writes to ``filename``.
+    '''
+    if name == 'device':
+        return SoundDeviceSink()
+    if name == 'null':
+        return NullSink()
+    if name == 'file':
+        return FileSink(filename)
+    raise ValueError('Unknown audio sink "{}"'.format(name))
+
+
+class AudioCueDevice(ButtonChannel):
+    '''A device that plays the cue :attr:`cue` of the :attr:`engine` when
+    its state is set to True and stops it when set to False.
+
+    The engine is opened when the device is activated and closed when it's
+    deactivated.
+    '''
+
+    engine = ObjectProperty(None)
+    '''The :class:`CueEngine`.
+    '''
+
+    cue = StringProperty('')
+    '''The name of the cue in the :attr:`engine`.
+    '''
+
+    requested_ts = None
+    '''The time the cue was last requested by setting the state to True, in
+    the :attr:`~forced_choice.timing.session_clock` time, or None.
+    '''
+
+    _opened = False
+
+    def get_onset(self):
+        '''Returns a ``(requested, onset)`` tuple of the time the cue was last
+        requested and the estimated time its first sample was output, or None
+        if it was never requested or not output (yet). See
+        :meth:`CueEngine.get_onset`.
+        '''
+        requested = self.requested_ts
+        if requested is None:
+            return None
+        onset = self.engine.get_onset(self.cue, requested)
+        if onset is None:
+            return None
+        return requested, onset
+
+    def activate(self, *largs, **kwargs):
+        if not self._opened:
+            self.engine.open()
+            self._opened = True
+        return super(AudioCueDevice, self).activate(*largs, **kwargs)
+
+    def deactivate(self, *largs, **kwargs):
+        res = super(AudioCueDevice, self).deactivate(*largs, **kwargs)
+        if self._opened and self.activation == 'inactive':
+            self.engine.stop(self.cue)
+            self.engine.close()
+            self._opened = False
+        return res
+
+    def set_state(self, state, **kwargs):
+        if state:
+            self.requested_ts = self.engine.play(self.cue)
+        else:
+            self.engine.stop(self.cue)
+        self.state = state
@@ -2,42 +2,207 @@
 ===========
 
 Defines some of the devices that are used in the experiment.
+
+The output devices, the odor valves and the daq output, coalesce their state
+changes with :class:`BatchedOutputBase`. Changes queued with
+:meth:`~BatchedOutputBase.queue_state` during the same clock iteration, or made
+within a :meth:`~BatchedOutputBase.batch` block, are written to the port
+together, with a single ``set_state`` call.
+
+The devices that use the actual hardware are defined in
+:mod:`forced_choice.hardware`, so that the hardware backends are only
+imported when they are used. :func:`get_hardware_config_classes` returns
+the classes from which the settings schema of the hardware devices is built.
+When the backends can be imported, these are the hardware device classes,
+otherwise they are the fallback settings classes, e.g.
+:class:`ServerSettings`, which copy the settings of the backend devices.
 '''
 
 
 __all__ = (
-    'FTDIOdorsBase', 'FTDIOdorsSim', 'FTDIOdors', 'DAQInDeviceBase',
-    'DAQInDeviceSim', 'DAQInDevice', 'DAQOutDeviceBase', 'DAQOutDeviceSim',
-    'DAQOutDevice')
+    'BatchedOutputBase', 'FTDIOdorsBase', 'FTDIOdorsSim', 'DAQInDeviceBase',
+    'DAQInDeviceSim', 'DAQOutDeviceBase', 'DAQOutDeviceSim', 'DAQInPins',
+    'DAQOutPins', 'ServerSettings', 'FTDIChannelSettings',
+    'FTDIOdorsSettings', 'DAQSettings', 'DAQInSettings', 'DAQOutSettings',
+    'MFCSettings', 'hardware_config_classes', 'get_hardware_config_classes')
 
 from weakref import ref
+from importlib import import_module
+from binascii import hexlify
+from contextlib import contextmanager
+
+import numpy as np
 
 from moa.device.digital import ButtonChannel, ButtonPort
 from moa.device.analog import NumericPropertyChannel
 
-from ffpyplayer.player import MediaPlayer
-
 from kivy.properties import (
     ConfigParserProperty, BooleanProperty, ListProperty, ObjectProperty,
-    NumericProperty)
+    NumericProperty, StringProperty)
+from kivy.event import EventDispatcher
 from kivy.app import App
+from kivy.logger import Logger
+from kivy.clock import Clock
 from kivy import resources
 
-from cplcom.moa.device.ftdi import FTDISerializerDevice
-from cplcom.moa.device.mcdaq import MCDAQDevice
+from forced_choice.timing import session_clock
+
+
+class BatchedOutputBase(object):
+    '''Base class for output port devices that coalesces the changes of their
+    channels into a single port write.
 
+    :meth:`queue_state` adds changes to the pending changes, which are all
+    written with one ``set_state`` call by the kivy ``Clock`` once the current
+    callback returns, in the same frame when queued from a clock callback
+    (e.g. from a stage). Within a :meth:`batch` block, ``set_state`` also
+    queues its changes, and the pending changes are written when the
+    outermost block exits, or discarded if it exits with an exception.
 
+    When a channel is changed more than once before the changes are written,
+    the last change wins.
+    '''
+
+    _batch_depth = 0
+
+    _pending = {}
 
-class FTDIOdorsBase(object):
+    _flush_trigger = None
+
+    def __init__(self, **kwargs):
+        self._pending = {}
+        self._flush_trigger = Clock.create_trigger(self.flush_state)
+        super(BatchedOutputBase, self).__init__(**kwargs)
+
+    def set_state(self, high=[], low=[], **kwargs):
+        if self._batch_depth:
+            self.queue_state(high=high, low=low)
+            return
+        return self.write_state(high=high, low=low, **kwargs)
+
+    def write_state(self, high=[], low=[], **kwargs):
+        '''Writes the changes to the port with the device's ``set_state``.
+        All the writes go through this method.
+        '''
+        return super(BatchedOutputBase, self).set_state(
+            high=high, low=low, **kwargs)
+
+    def queue_state(self, high=[], low=[]):
+        '''Queues the channels in ``high`` and ``low`` to be set high and low,
+        respectively. Unless within a :meth:`batch`, they are written by the
+        clock together with all the other changes queued until then.
+        '''
+        pending = self._pending
+        for name in high:
+            pending[name] = True
+        for name in low:
+            pending[name] = False
+        if not self._batch_depth:
+            self._flush_trigger()
+
+    def flush_state(self, *largs):
+        '''Writes all the queued changes with a single ``set_state`` call.
+        '''
+        self._flush_trigger.cancel()
+        pending = self._pending
+        if not pending:
+            return
+        self._pending = {}
+        self.write_state(
+            high=[name for name, state in pending.items() if state],
+            low=[name for name, state in pending.items() if not state])
+
+    def discard_state(self):
+        '''Discards all the queued changes that were not written yet.
+        '''
+        self._flush_trigger.cancel()
+        self._pending = {}
+
+    @contextmanager
+    def batch(self):
+        '''A context manager within which all the state changes are queued
+        and then written together, e.g.::
+
+            with knspace.odors.batch():
+                knspace.odors.set_state(high=['p1'])
+                knspace.odors.set_state(low=['p2'])
+        '''
+        self._batch_depth += 1
+        try:
+            yield self
+        except Exception:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.discard_state()
+            raise
+        self._batch_depth -= 1
+        if not self._batch_depth:
+            self.flush_state()
+
+
+class FTDIOdorsBase(BatchedOutputBase):
     '''Base class for the FTDI odor device.
+
+    The state of the valves is tracked in :attr:`valves`, a numpy array with
+    an element for each valve, which is the authoritative state of the
+    valves. Valves are addressed by their index with :meth:`set_valves` and
+    :meth:`queue_valves`, or as an integer bitmask with :meth:`set_mask`.
+    The queued changes are kept as a mask of valve indices. All the writes go
+    through :meth:`write_valves`, which only writes the valves whose state
+    differs from :attr:`valves`, so the valve names are only built for the
+    changed valves when they are written to the underlying device.
+
+    Once the underlying device's ``set_state`` returns, :attr:`valves` is
+    updated, so it never claims a state that failed to be written, and the
+    changed valves are dispatched together in a single ``on_valves`` event,
+    with their time in :attr:`applied_ts`.
+
+    A valve is also a ``p<index>`` property, e.g. ``p3``, only when an
+    observer asks for it with :meth:`create_valve_properties`, e.g. the
+    valve widgets of the ``attr_map``. Other valves don't pay for any
+    property dispatching.
+    '''
+
+    __events__ = ('on_valves', )
+
+    valves = None
+    '''A numpy bool array with the last applied state of each valve.
+    '''
+
+    applied_ts = 0
+    '''The time, in nanoseconds in the
+    :attr:`~forced_choice.timing.session_clock` time, when the valves of the
+    last ``on_valves`` event were applied by the device.
+    '''
+
+    valve_names = []
+    '''The list of the property names of the valves, ``p<index>``, indexed
+    by the valve index.
+    '''
+
+    valve_index = {}
+    '''A dict mapping the property name of each valve to its index.
     '''
 
+    _queued = None
+
+    _observed = None
+
+    _writing = False
+
     def __init__(self, **kwargs):
         n_valve_boards = kwargs.get('n_valve_boards', self.n_valve_boards)
-        # we don't know ahead of time how many valves, so we need to create
-        # the bool prop for each valve dynamically
-        for i in range(8 * n_valve_boards):
-            self.create_property('p{}'.format(i), value=False, allownone=True)
+        n = 8 * n_valve_boards
+        self.valves = np.zeros(n, dtype=np.bool_)
+        # the queued state of each valve, 1 for high, 0 for low, and -1 if
+        # it's not queued
+        self._queued = np.full(n, -1, dtype=np.int8)
+        # whether each valve has a p<index> property
+        self._observed = np.zeros(n, dtype=np.bool_)
+        self.valve_names = names = ['p{}'.format(i) for i in range(n)]
+        self.valve_index = {name: i for i, name in enumerate(names)}
+        # the widgets of the attr_map are bound to the valve properties
+        self.create_valve_properties(kwargs.get('attr_map', {}).keys())
 
         super(FTDIOdorsBase, self).__init__(direction='o', **kwargs)
 
@@ -48,6 +213,153 @@ class FTDIOdorsBase(object):
     Defaults to 2.
     '''
 
+    def on_valves(self, changed):
+        '''Dispatched after the device applied a write that changed valves,
+        with the numpy array of the indices of the changed valves. Their new
+        state is in :attr:`valves`.
+        '''
+        pass
+
+    spans = None
+    '''The :class:`~forced_choice.spans.SpanRecorder` in which the writes are
+    marked, or None when the latency spans are not recorded.
+    '''
+
+    def create_valve_properties(self, names):
+        '''Creates the ``p<index>`` property of each valve in ``names``, if
+        it wasn't created yet, set to the valve's state in :attr:`valves`.
+        The properties are then kept in sync with :attr:`valves`, and a
+        change of the property from outside :meth:`write_valves`, e.g. from
+        its widget, updates :attr:`valves`.
+        '''
+        index = self.valve_index
+        observed = self._observed
+        for name in names:
+            i = index[name]
+            if not observed[i]:
+                # we don't know ahead of time how many valves, so we need to
+                # create the bool prop for each valve dynamically
+                self.create_property(
+                    name, value=bool(self.valves[i]), allownone=True)
+                self.fbind(name, self._valve_changed, i)
+                observed[i] = True
+
+    def _valve_changed(self, i, instance, value):
+        value = bool(value)
+        if self._writing or self.valves[i] == value:
+            return
+        self.applied_ts = session_clock.now_ns()
+        self.valves[i] = value
+        self.dispatch('on_valves', np.array([i], dtype=np.intp))
+
+    def write_state(self, high=[], low=[], **kwargs):
+        index = self.valve_index
+        return self.write_valves(
+            high=[index[name] for name in high],
+            low=[index[name] for name in low], **kwargs)
+
+    def write_valves(self, high=(), low=(), force=False, **kwargs):
+        '''Writes the valves whose indices are in ``high`` and ``low`` high and
+        low, respectively, with the underlying device's ``set_state``. All the
+        writes go through this method.
+
+        Only the valves whose state differs from :attr:`valves` are written,
+        unless ``force``, e.g. to reset the valves to a safe state.
+        '''
+        valves = self.valves
+        new = valves.copy()
+        new[np.asarray(high, dtype=np.intp)] = True
+        new[np.asarray(low, dtype=np.intp)] = False
+        if force:
+            changed = np.union1d(high, low).astype(np.intp)
+        else:
+            changed = np.flatnonzero(new != valves)
+        if not len(changed):
+            return
+
+        names = self.valve_names
+        states = new[changed]
+        spans = self.spans
+        if spans is not None:
+            spans.mark('valve_write')
+        self._writing = True
+        try:
+            res = super(FTDIOdorsBase, self).write_state(
+                high=[names[i] for i in changed[states]],
+                low=[names[i] for i in changed[~states]], **kwargs)
+        finally:
+            self._writing = False
+        if spans is not None:
+            spans.mark('valve_written')
+
+        self.applied_ts = session_clock.now_ns()
+        valves[changed] = states
+        for i in changed[self._observed[changed]]:
+            setattr(self, names[i], bool(valves[i]))
+        self.dispatch('on_valves', changed)
+        return res
+
+    def queue_state(self, high=[], low=[]):
+        index = self.valve_index
+        self.queue_valves(
+            high=[index[name] for name in high],
+            low=[index[name] for name in low])
+
+    def flush_state(self, *largs):
+        self._flush_trigger.cancel()
+        queued = self._queued
+        high = np.flatnonzero(queued == 1)
+        low = np.flatnonzero(queued == 0)
+        if not len(high) and not len(low):
+            return
+        queued[:] = -1
+        self.write_valves(high=high, low=low)
+
+    def discard_state(self):
+        self._flush_trigger.cancel()
+        self._queued[:] = -1
+
+    def set_valves(self, high=(), low=()):
+        '''Sets the valves whose indices are in ``high`` and ``low`` high and
+        low, respectively. Like ``set_state``, it's queued within a
+        :meth:`batch`.
+        '''
+        if self._batch_depth:
+            self.queue_valves(high=high, low=low)
+        else:
+            self.write_valves(high=high, low=low)
+
+    def queue_valves(self, high=(), low=()):
+        '''Like :meth:`set_valves`, but queues the changes like
+        :meth:`queue_state`.
+        '''
+        queued = self._queued
+        queued[np.asarray(high, dtype=np.intp)] = 1
+        queued[np.asarray(low, dtype=np.intp)] = 0
+        if not self._batch_depth:
+            self._flush_trigger()
+
+    def get_mask(self):
+        '''Returns the state of the valves as an integer bitmask, where bit
+        ``i`` is the state of valve ``i``.
+        '''
+        packed = np.packbits(self.valves, bitorder='little')
+        return int(hexlify(packed[::-1].tobytes()) or b'0', 16)
+
+    def set_mask(self, mask):
+        '''Sets the state of all the valves from the integer bitmask, where
+        bit ``i`` is the state of valve ``i``. Only the valves that change
+        are written.
+        '''
+        n = len(self.valves)
+        packed = np.array(
+            [(mask >> (8 * i)) & 0xFF for i in range((n + 7) // 8)],
+            dtype=np.uint8)
+        states = np.unpackbits(packed, bitorder='little')[:n].astype(np.bool_)
+        changed = np.flatnonzero(states != self.valves)
+        self.set_valves(
+            high=changed[states[changed]], low=changed[~states[changed]])
+
 
 class FTDIOdorsSim(FTDIOdorsBase, ButtonPort):
     '''Device used when simulating the odor device.
@@ -55,17 +367,36 @@ class FTDIOdorsSim(FTDIOdorsBase, ButtonPort):
     pass
 
 
-class FTDIOdors(FTDIOdorsBase, FTDISerializerDevice):
-    '''Device used when using the barst ftdi odor device.
+class DAQInPins(object):
+    '''The settings of the Switch & Sense 8/8 ports used as inputs.
     '''
 
-    def __init__(self, **kwargs):
-        super(FTDIOdors, self).__init__(**kwargs)
-        self.dev_map = {'p{}'.format(i): i
-                        for i in range(self.n_valve_boards * 8)}
+    __settings_attrs__ = (
+        'nose_beam_pin', 'reward_beam_r_pin', 'reward_beam_l_pin')
 
+    nose_beam_pin = NumericProperty(1)
+    '''The port in the Switch & Sense to which the nose port photobeam is
+    connected to.
 
-class DAQInDeviceBase(object):
+    Defaults to 1.
+    '''
+
+    reward_beam_r_pin = NumericProperty(3)
+    '''The port in the Switch & Sense to which the right reward port photobeam
+    is connected to.
+
+    Defaults to 3.
+    '''
+
+    reward_beam_l_pin = NumericProperty(2)
+    '''The port in the Switch & Sense to which the left reward port photobeam
+    is connected to.
+
+    Defaults to 2.
+    '''
+
+
+class DAQInDeviceBase(DAQInPins):
     '''Base class for the Switch & Sense 8/8 input ports.
     '''
 
@@ -81,6 +412,17 @@ class DAQInDeviceBase(object):
     '''Reads / controls the left reward port photobeam.
     '''
 
+    spans = None
+    '''The :class:`~forced_choice.spans.SpanRecorder` in which the nose port
+    beam breaks are marked, or None when the latency spans are not recorded.
+    '''
+
+    def on_nose_beam(self, *largs):
+        # the class handler is called before all the bound callbacks, so the
+        # beam is marked before the stages waiting for it are done
+        if self.nose_beam and self.spans is not None:
+            self.spans.mark('nose_beam')
+
 
 class DAQInDeviceSim(DAQInDeviceBase, ButtonPort):
     '''Device used when simulating the Switch & Sense 8/8 input device.
@@ -88,43 +430,46 @@ class DAQInDeviceSim(DAQInDeviceBase, ButtonPort):
     pass
 
 
-class DAQInDevice(DAQInDeviceBase, MCDAQDevice):
-    '''Device used when using the barst Switch & Sense 8/8 input device.
+class DAQOutPins(object):
+    '''The settings of the Switch & Sense 8/8 ports used as outputs.
     '''
 
     __settings_attrs__ = (
-        'nose_beam_pin', 'reward_beam_r_pin', 'reward_beam_l_pin')
+        'house_light_pin', 'ir_leds_pin', 'fans_pin', 'feeder_r_pin',
+        'feeder_l_pin')
 
-    def __init__(self, **kwargs):
-        super(DAQInDevice, self).__init__(direction='i', **kwargs)
-        self.dev_map = {
-        'nose_beam': self.nose_beam_pin,
-        'reward_beam_r': self.reward_beam_r_pin,
-        'reward_beam_l': self.reward_beam_l_pin}
+    house_light_pin = NumericProperty(4)
+    '''The port in the Switch & Sense that controls the house light.
 
-    nose_beam_pin = NumericProperty(1)
-    '''The port in the Switch & Sense to which the nose port photobeam is
-    connected to.
+    Defaults to 4.
+    '''
 
-    Defaults to 1.
+    ir_leds_pin = NumericProperty(6)
+    '''The port in the Switch & Sense that controls the IR lights.
+
+    Defaults to 6.
     '''
 
-    reward_beam_r_pin = NumericProperty(3)
-    '''The port in the Switch & Sense to which the right reward port photobeam
-    is connected to.
+    fans_pin = NumericProperty(5)
+    '''The port in the Switch & Sense that controls the fans.
 
-    Defaults to 3.
+    Defaults to 5.
     '''
 
-    reward_beam_l_pin = NumericProperty(2)
-    '''The port in the Switch & Sense to which the left reward port photobeam
-    is connected to.
+    feeder_r_pin = NumericProperty(2)
+    '''The port in the Switch & Sense that controls the right feeder.
 
     Defaults to 2.
     '''
 
+    feeder_l_pin = NumericProperty(0)
+    '''The port in the Switch & Sense that controls the left feeder.
+
+    Defaults to 0.
+    '''
+
 
-class DAQOutDeviceBase(object):
+class DAQOutDeviceBase(DAQOutPins, BatchedOutputBase):
     '''Base class for the Switch & Sense 8/8 output ports.
     '''
 
@@ -155,48 +500,198 @@ class DAQOutDeviceSim(DAQOutDeviceBase, ButtonPort):
     pass
 
 
-class DAQOutDevice(DAQOutDeviceBase, MCDAQDevice):
-    '''Device used when using the barst Switch & Sense 8/8 output device.
+class ServerSettings(EventDispatcher):
+    '''The settings of the Barst server,
+    :class:`~cplcom.moa.device.barst_server.Server`, used as a fallback
+    when it cannot be imported, see :func:`get_hardware_config_classes`.
+    '''
+
+    __settings_attrs__ = ('server_path', 'server_pipe')
+
+    server_path = StringProperty('')
+    '''The full path to the Barst executable. If empty, it is searched for
+    in the default install locations.
+    '''
+
+    server_pipe = StringProperty('')
+    '''The pipe name used to communicate with the server. If empty, the
+    default pipe name is used.
+    '''
+
+
+class FTDIChannelSettings(EventDispatcher):
+    '''The settings of the FTDI channel,
+    :class:`~cplcom.moa.device.ftdi.FTDIDevChannel`, used as a fallback
+    when it cannot be imported, see :func:`get_hardware_config_classes`.
+    '''
+
+    __settings_attrs__ = ('ftdi_desc', 'ftdi_serial')
+
+    ftdi_desc = StringProperty('')
+    '''The description of the FTDI hardware board. This a name written to the
+    hardware device.
+
+    :attr:`ftdi_serial` or :attr:`ftdi_desc` are used to locate the correct
+    board to open. An example is `'Alder Board'` for the Alder board.
+    '''
+
+    ftdi_serial = StringProperty('')
+    '''The serial number of the FTDI hardware board. Can be empty if
+    :attr:`ftdi_desc` is provided.
+    '''
+
+
+class FTDIOdorsSettings(EventDispatcher):
+    '''The settings of the FTDI serializer device of
+    :class:`~forced_choice.hardware.FTDIOdors`, used as a fallback when it
+    cannot be imported, see :func:`get_hardware_config_classes`.
     '''
 
     __settings_attrs__ = (
-        'house_light_pin', 'ir_leds_pin', 'fans_pin', 'feeder_r_pin',
-        'feeder_l_pin')
+        'clock_size', 'num_boards', 'clock_bit', 'data_bit', 'latch_bit',
+        'output')
 
-    def __init__(self, **kwargs):
-        super(DAQOutDevice, self).__init__(direction='o', **kwargs)
-        self.dev_map = {'house_light': self.house_light_pin,
-                   'ir_leds': self.ir_leds_pin,
-                   'fans': self.fans_pin,
-                   'feeder_r': self.feeder_r_pin,
-                   'feeder_l': self.feeder_l_pin}
+    clock_size = NumericProperty(20)
+    '''The hardware clock width used to clock out data. Defaults to 20.
+    '''
 
-    house_light_pin = NumericProperty(4)
-    '''The port in the Switch & Sense that controls the house light.
+    num_boards = NumericProperty(1)
+    '''The number of serial boards connected in series to the FTDI device.
 
-    Defaults to 4.
+    Each board is a 8-channel port. Defaults to 1.
     '''
 
-    ir_leds_pin = NumericProperty(6)
-    '''The port in the Switch & Sense that controls the IR lights.
+    clock_bit = NumericProperty(0)
+    '''The pin on the FTDI board to which the serial device's clock bit is
+    connected.
 
-    Defaults to 6.
+    Defaults to zero.
     '''
 
-    fans_pin = NumericProperty(5)
-    '''The port in the Switch & Sense that controls the fans.
+    data_bit = NumericProperty(0)
+    '''The pin on the FTDI board to which the serial device's data bit is
+    connected.
 
-    Defaults to 5.
+    Defaults to zero.
     '''
 
-    feeder_r_pin = NumericProperty(2)
-    '''The port in the Switch & Sense that controls the right feeder.
+    latch_bit = NumericProperty(0)
+    '''The pin on the FTDI board to which the serial device's latch bit is
+    connected.
 
-    Defaults to 2.
+    Defaults to zero.
     '''
 
-    feeder_l_pin = NumericProperty(0)
-    '''The port in the Switch & Sense that controls the left feeder.
+    output = BooleanProperty(True)
+    '''Whether the serial device is a output or input device.
 
-    Defaults to 0.
+    Defaults to True.
+    '''
+
+
+class DAQSettings(EventDispatcher):
+    '''The settings of the Switch & Sense device,
+    :class:`~cplcom.moa.device.mcdaq.MCDAQDevice`, used as a fallback
+    when it cannot be imported, see :func:`get_hardware_config_classes`.
+    '''
+
+    __settings_attrs__ = ('SAS_chan', )
+
+    SAS_chan = NumericProperty(0)
+    '''The channel number of the Switch & Sense 8/8 as configured in
+    InstaCal.
+
+    Defaults to zero.
+    '''
+
+
+class DAQInSettings(DAQInPins, DAQSettings):
+    '''The settings of :class:`~forced_choice.hardware.DAQInDevice`.
+    '''
+    pass
+
+
+class DAQOutSettings(DAQOutPins, DAQSettings):
+    '''The settings of :class:`~forced_choice.hardware.DAQOutDevice`.
+    '''
+    pass
+
+
+class MFCSettings(EventDispatcher):
+    '''The settings of a MFC, :class:`~cplcom.moa.device.mfc.MFC`, used as a
+    fallback when it cannot be imported, see
+    :func:`get_hardware_config_classes`.
+    '''
+
+    __settings_attrs__ = ('mfc_id', 'port_name')
+
+    mfc_id = NumericProperty(0)
+    '''The MFC assigned decimal number used to communicate with that MFC.
+    '''
+
+    port_name = StringProperty('')
+    '''The COM port name of the MFC, e.g. COM3.
+    '''
+
+
+hardware_config_classes = {
+    'barst_server': (
+        'cplcom.moa.device.barst_server', 'Server', ServerSettings),
+    'ftdi_chan': ('cplcom.moa.device.ftdi', 'FTDIDevChannel',
+                  FTDIChannelSettings),
+    'odors': ('forced_choice.hardware', 'FTDIOdors', FTDIOdorsSettings),
+    'daqout': ('forced_choice.hardware', 'DAQOutDevice', DAQOutSettings),
+    'daqin': ('forced_choice.hardware', 'DAQInDevice', DAQInSettings),
+    'mfc_air': ('cplcom.moa.device.mfc', 'MFC', MFCSettings),
+    'mfc_a': ('cplcom.moa.device.mfc', 'MFC', MFCSettings),
+    'mfc_b': ('cplcom.moa.device.mfc', 'MFC', MFCSettings)}
+'''Maps the settings section of each hardware device to a
+``(module, class name, fallback)`` tuple, where ``fallback`` is the settings
+class used when the module cannot be imported.
+'''
+
+
+def _settings_defaults(cls):
+    '''Returns a dict mapping each of the ``__settings_attrs__`` of the class
+    and its bases to its default value.
+    '''
+    defaults = {}
+    for c in reversed(cls.__mro__):
+        for attr in c.__dict__.get('__settings_attrs__', ()):
+            prop = getattr(cls, attr, None)
+            defaults[attr] = getattr(prop, 'defaultvalue', prop)
+    return defaults
+
+
+def get_hardware_config_classes():
+    '''Returns a dict mapping the settings section of each hardware device
+    to the class from which its settings are read, see
+    :attr:`hardware_config_classes`.
+
+    It's called when the settings schema is built, so the backends are only
+    imported then. If they cannot be imported, e.g. when only simulating,
+    the fallback settings classes are used instead. Otherwise, the fallback
+    classes are checked against the backend classes and a warning is logged
+    if their settings or defaults differ, so the copies don't silently
+    drift from the backends.
     '''
+    classes = {}
+    checked = set()
+    for section, (module, name, fallback) in hardware_config_classes.items():
+        try:
+            cls = getattr(import_module(module), name)
+        except (ImportError, OSError) as e:
+            Logger.debug(
+                'Devices: Using the fallback settings of "{}", cannot import '
+                '{}: {}'.format(section, module, e))
+            classes[section] = fallback
+            continue
+
+        if cls not in checked and \
+                _settings_defaults(cls) != _settings_defaults(fallback):
+            Logger.warning(
+                'Devices: The settings of {}.{} differ from {}, which '
+                'should be updated'.format(module, name, fallback.__name__))
+        checked.add(cls)
+        classes[section] = cls
+    return classes
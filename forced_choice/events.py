@@ -0,0 +1,218 @@
+'''Events
+=========
+
+Records every change of the input and output channels of the devices, e.g.
+every beam break and every valve change, with its
+:attr:`~forced_choice.timing.session_clock` timestamp.
+
+The changes are stored in a preallocated ring buffer, and are periodically
+handed off in bulk to the :class:`~forced_choice.writer.TrialLogWriter` that
+appends them to a binary events file. The file starts with a short text header
+describing the channels and the clock anchor, followed by the records. It can
+be read back with :func:`read_events`.
+'''
+
+import json
+from time import localtime
+
+import numpy as np
+
+from forced_choice.timing import session_clock
+
+__all__ = ('event_dtype', 'EdgeRecorder', 'read_events')
+
+events_magic = b'FCEVENTS\n'
+'''The first line of every events file.
+'''
+
+events_version = 1
+'''The version of the events file format.
+'''
+
+event_dtype = np.dtype([('ts', '<i8'), ('channel', '<u2'), ('state', 'i1')])
+'''The numpy dtype of an event record. ``ts`` is the time of the change in
+nanoseconds since the :attr:`~forced_choice.timing.session_clock` anchor,
+``channel`` is the index of the channel in the ``channels`` of the file, and
+``state`` is the new state, 1 for high, 0 for low, and -1 for unknown.
+'''
+
+
+class EdgeRecorder(object):
+    '''Records the changes of device channels into a preallocated ring buffer
+    and writes them to the events file in bulk.
+
+    Devices are added with :meth:`bind_device`, after which every change of
+    their channels is recorded with :meth:`record`. Whenever
+    :attr:`flush_size` events are pending, they are copied out of the buffer
+    and queued to the :attr:`writer`, which writes them in its thread.
+    '''
+
+    filename = ''
+    '''The events filename pattern, passed to ``strftime`` with the time of
+    the clock anchor.
+    '''
+
+    writer = None
+    '''The :class:`~forced_choice.writer.TrialLogWriter` that writes the
+    events.
+    '''
+
+    channels = []
+    '''The list of the names of the recorded channels, in the form of
+    ``device.channel``, e.g. ``daqin.nose_beam``.
+    '''
+
+    events = None
+    '''The preallocated ring buffer of :attr:`event_dtype` records.
+    '''
+
+    flush_size = 0
+    '''The number of pending events at which they are written.
+    '''
+
+    count = 0
+    '''The total number of events recorded.
+    '''
+
+    flushed = 0
+    '''The total number of events handed off to :attr:`writer`.
+    '''
+
+    dropped = 0
+    '''The number of events that were overwritten before they were written
+    because the buffer filled up.
+    '''
+
+    def __init__(self, filename, writer, capacity=1 << 16, flush_size=None):
+        self.filename = filename
+        self.writer = writer
+        self.channels = []
+        self._bindings = []
+        self.events = np.zeros(capacity, dtype=event_dtype)
+        self.flush_size = flush_size or capacity // 4
+
+    def bind_device(self, device, dev_name, names):
+        '''Records the changes of the channels ``names``, the names of the
+        properties of the ``device``. ``dev_name`` is the name of the device
+        used in the :attr:`channels` names.
+        '''
+        for name in names:
+            channel = len(self.channels)
+            self.channels.append('{}.{}'.format(dev_name, name))
+            uid = device.fbind(name, self._record_change, channel)
+            self._bindings.append((device, name, uid))
+
+    def bind_valves(self, device, dev_name):
+        '''Records the changes of all the valves of the odor ``device``, a
+        :class:`~forced_choice.devices.FTDIOdorsBase`, like
+        :meth:`bind_device` with all its
+        :attr:`~forced_choice.devices.FTDIOdorsBase.valve_names`. However,
+        rather than binding each valve, it binds once to the device's
+        ``on_valves`` event and records all the valves changed by a write with
+        the time the device applied them,
+        :attr:`~forced_choice.devices.FTDIOdorsBase.applied_ts`.
+        '''
+        start = len(self.channels)
+        self.channels.extend(
+            '{}.{}'.format(dev_name, name) for name in device.valve_names)
+        uid = device.fbind('on_valves', self._record_valves, start)
+        self._bindings.append((device, 'on_valves', uid))
+
+    def unbind_devices(self):
+        '''Stops recording all the devices bound with :meth:`bind_device` or
+        :meth:`bind_valves`.
+        '''
+        for device, name, uid in self._bindings:
+            device.unbind_uid(name, uid)
+        self._bindings = []
+
+    def _record_change(self, channel, instance, value):
+        self.record(channel, value)
+
+    def _record_valves(self, start, device, changed):
+        ts = device.applied_ts
+        valves = device.valves
+        for i in changed:
+            self.record(start + int(i), valves[i], ts=ts)
+
+    def record(self, channel, state, ts=None):
+        '''Records a change of the channel (an index in :attr:`channels`) to
+        ``state`` at ``ts``, in nanoseconds since the clock anchor. Defaults
+        to now.
+        '''
+        events = self.events
+        i = self.count % len(events)
+        event = events[i]
+        event['ts'] = session_clock.now_ns() if ts is None else ts
+        event['channel'] = channel
+        event['state'] = -1 if state is None else int(bool(state))
+        self.count += 1
+
+        if self.count - self.flushed >= self.flush_size:
+            self.flush()
+
+    def header(self):
+        '''Returns the header bytes written at the start of the events file.
+        '''
+        desc = json.dumps({
+            'version': events_version, 'dtype': event_dtype.descr,
+            'channels': self.channels, 'epoch_time': session_clock.epoch_time,
+            'epoch_ns': session_clock.epoch_ns})
+        return events_magic + desc.encode('utf8') + b'\n'
+
+    def flush(self):
+        '''Hands off all the pending events to :attr:`writer`.
+        '''
+        events = self.events
+        n = len(events)
+        count = self.count
+        start = self.flushed
+        if count - start > n:
+            self.dropped += count - start - n
+            start = count - n
+        if start == count:
+            return
+
+        i, j = start % n, count % n
+        if i < j:
+            data = events[i:j].tobytes()
+        else:
+            data = events[i:].tobytes() + events[:j].tobytes()
+        self.flushed = count
+
+        self.writer.write(
+            self.filename, self.header(), data,
+            ts=localtime(session_clock.epoch_time), binary=True)
+
+
+def read_events(filename, mode='r'):
+    '''Reads the events file written by :class:`EdgeRecorder`.
+
+    :returns:
+
+        A 3-tuple of ``(events, channels, epoch_time)``. ``events`` is a numpy
+        memory map of the :attr:`event_dtype` records, ``channels`` is the list
+        of the channel names indexed by the records, and ``epoch_time`` is the
+        wall time of the clock anchor, so that the absolute time of an event
+        is ``epoch_time + ts / 1e9``.
+    '''
+    with open(filename, 'rb') as fh:
+        if fh.readline() != events_magic:
+            raise ValueError('"{}" is not an events file'.format(filename))
+        desc = json.loads(fh.readline().decode('utf8'))
+        offset = fh.tell()
+        fh.seek(0, 2)
+        size = fh.tell()
+
+    if desc['version'] != events_version:
+        raise ValueError('Events file "{}" version {} is not supported'.
+                         format(filename, desc['version']))
+
+    dtype = np.dtype([tuple(field) for field in desc['dtype']])
+    n = (size - offset) // dtype.itemsize
+    if not n:
+        events = np.zeros(0, dtype=dtype)
+    else:
+        events = np.memmap(filename, dtype=dtype, mode=mode, offset=offset,
+                           shape=(n, ))
+    return events, desc['channels'], desc['epoch_time']
@@ -5,19 +5,30 @@
 GUI elements.
 '''
 
+import numpy as np
+
 from kivy.uix.gridlayout import GridLayout
 from kivy.uix.label import Label
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.behaviors.knspace import KNSpaceBehavior
 from kivy.properties import StringProperty, NumericProperty, BooleanProperty
 from kivy.lang import Builder
-from kivy.garden.graph import Graph
+from kivy.factory import Factory
+from kivy.garden.graph import Graph, MeshLinePlot
 
 import cplcom.graphics
 
 from os import path
 
-__all__ = ('TrialOutcome', 'TrialPrediction')
+__all__ = ('TrialOutcome', 'TrialPrediction', 'PredictionView', 'TrialPlot',
+           'load_kv')
+
 
-Builder.load_file(path.join(path.dirname(__file__), 'display.kv'))
+def load_kv():
+    '''Loads the kv rules of the GUI, ``display.kv``. Called by the app
+    before it builds the GUI.
+    '''
+    Builder.load_file(path.join(path.dirname(__file__), 'display.kv'))
 
 
 class TrialOutcome(GridLayout):
@@ -88,8 +99,9 @@ class TrialOutcome(GridLayout):
 
 
 class TrialPrediction(Label):
-    '''A Label generated for each trial ahead of time, indicating the
-    pre-computed params for that trial.
+    '''A Label indicating the pre-computed params of a trial. It's the view
+    class of the :class:`PredictionView`, which reuses the labels for the
+    visible trials.
     '''
 
     odor = StringProperty('')
@@ -100,7 +112,7 @@ class TrialPrediction(Label):
     '''The trial number.
     '''
 
-    outcome = BooleanProperty(None)
+    outcome = BooleanProperty(None, allownone=True)
     '''Whether it passed or failed the trial.
     '''
 
@@ -120,3 +132,266 @@ class TrialPrediction(Label):
     side_rewarded = StringProperty(u'Ø')
     '''Which feeder side was rewarded for this trial.
     '''
+
+
+class PredictionView(KNSpaceBehavior, RecycleView):
+    '''Displays the :class:`TrialPrediction` of all the trials, with a row
+    for each block.
+
+    The predictions are stored as dicts in
+    :attr:`~kivy.uix.recycleview.RecycleView.data`, block after block, with
+    :attr:`n_trials` items per block. Only the visible trials get a
+    :class:`TrialPrediction` label, which are reused as the view is scrolled.
+    '''
+
+    n_trials = NumericProperty(0)
+    '''The number of items of each block in
+    :attr:`~kivy.uix.recycleview.RecycleView.data`, the number of trials of
+    the longest block. The shorter blocks are padded with items whose
+    ``trial`` is -1, and that are not displayed.
+    '''
+
+    @staticmethod
+    def prediction_item(trial, odor='', side=u'Ø'):
+        '''Returns the data dict of the prediction of the trial. Every dict
+        contains all the :class:`TrialPrediction` properties set by the view,
+        so that nothing carries over when a label is reused.
+        '''
+        return {'trial': trial, 'odor': odor, 'side': side,
+                'side_went': u'Ø', 'side_rewarded': u'Ø', 'outcome': None,
+                'outcome_text': ''}
+
+    def set_predictions(self, blocks):
+        '''Sets the predictions of all the trials.
+
+        :Parameters:
+
+            `blocks`: list
+                A list with a list for each block of the ``(odor, side)``
+                of each of its trials.
+        '''
+        n = self.n_trials = max([len(trials) for trials in blocks] or [0])
+        item = self.prediction_item
+        data = []
+        for trials in blocks:
+            data.extend([item(trial, odor, side)
+                         for trial, (odor, side) in enumerate(trials)])
+            data.extend([item(-1) for _ in range(n - len(trials))])
+        self.data = data
+
+    def update_prediction(self, block, trial, **kwargs):
+        '''Updates the properties, given as keyword arguments, of the
+        prediction of the trial. Only the label of that trial, if visible, is
+        updated.
+        '''
+        i = block * self.n_trials + trial
+        item = dict(self.data[i])
+        item.update(kwargs)
+        self.data[i] = item
+
+
+class TrialPlot(MeshLinePlot):
+    '''A :class:`~kivy.garden.graph.MeshLinePlot` whose points are stored in
+    numpy arrays and added with :meth:`add_point`, instead of in
+    :attr:`~kivy.garden.graph.Plot.points`.
+
+    Adding a point only computes the vertex of that point, rather than
+    recomputing all the vertices of the mesh. Once there are more points than
+    the plot is pixels wide, the points are decimated to the minimum and
+    maximum value of each pixel column, so the mesh never grows beyond twice
+    the plot width.
+
+    The points and vertices are stored in arrays whose capacity doubles when
+    full. The vertex and index lists of the mesh are extended when a vertex
+    is added and, when a point only changes the minimum or maximum of the
+    last column, only its vertex is updated. They are only rebuilt when all
+    the vertices are recomputed, e.g. when the graph is resized.
+    '''
+
+    _n = 0
+
+    _nv = 0
+
+    _ncols = 0
+
+    def __init__(self, **kwargs):
+        super(TrialPlot, self).__init__(**kwargs)
+        self._x = np.zeros(64)
+        self._y = np.zeros(64)
+        self._reset_vertices()
+
+    def _reset_vertices(self):
+        # the (x, y) pixel coordinates of the vertices in the mesh, of which
+        # the first _nv are used
+        self._vert = np.zeros((64, 2))
+        self._nv = 0
+        # when decimating, the pixel column of each pair of vertices, of
+        # which the first _ncols are used
+        self._cols = np.zeros(32, dtype=np.int64)
+        self._ncols = 0
+        self._decimated = False
+        # the vertex and index lists of the mesh
+        self._vertices = []
+        self._indices = []
+
+    def clear_points(self):
+        '''Removes all the points from the plot.
+        '''
+        self._n = 0
+        self._reset_vertices()
+        self._update_mesh()
+
+    def add_point(self, x, y):
+        '''Adds the point ``(x, y)`` to the end of the plot. ``x`` must not be
+        smaller than the ``x`` of the previous point.
+        '''
+        n = self._n
+        if n == len(self._x):
+            self._x = np.concatenate((self._x, np.zeros(n)))
+            self._y = np.concatenate((self._y, np.zeros(n)))
+        self._x[n] = x
+        self._y[n] = y
+        self._n = n + 1
+
+        if not self._decimated and self._n > self._px_width():
+            self._compute_vertices()
+            return
+
+        px, py = self._to_px(self._x[n:n + 1], self._y[n:n + 1])
+        px, py = float(px[0]), float(py[0])
+        if not self._decimated:
+            self._add_vertices(((px, py), ))
+            return
+
+        col = int(px)
+        ncols = self._ncols
+        if ncols and self._cols[ncols - 1] == col:
+            nv = self._nv
+            vert = self._vert
+            low = min(vert[nv - 2, 1], py)
+            high = max(vert[nv - 1, 1], py)
+            if low == vert[nv - 2, 1] and high == vert[nv - 1, 1]:
+                return
+            vert[nv - 2, 1] = low
+            vert[nv - 1, 1] = high
+            vertices = self._vertices
+            vertices[4 * (nv - 2) + 1] = float(low)
+            vertices[4 * (nv - 1) + 1] = float(high)
+            self._mesh.vertices = vertices
+            return
+
+        if ncols == len(self._cols):
+            self._cols = np.concatenate(
+                (self._cols, np.zeros_like(self._cols)))
+        self._cols[ncols] = col
+        self._ncols = ncols + 1
+        self._add_vertices(((col, py), (col, py)))
+
+    def _add_vertices(self, verts):
+        '''Appends the ``(x, y)`` pixel coordinates in ``verts`` to the
+        vertices, and extends the mesh with them.
+        '''
+        nv = self._nv
+        end = nv + len(verts)
+        if end > len(self._vert):
+            self._reserve(end)
+        self._vert[nv:end] = verts
+        self._nv = end
+
+        vertices = self._vertices
+        indices = self._indices
+        for i, (px, py) in enumerate(verts):
+            vertices.extend((float(px), float(py), 0., 0.))
+            indices.append(nv + i)
+        # indices must never point past the vertices
+        mesh = self._mesh
+        mesh.vertices = vertices
+        mesh.indices = indices
+
+    def _reserve(self, n):
+        '''Grows the capacity of the vertices, by doubling it, to at least
+        ``n``.
+        '''
+        size = max(len(self._vert), 1)
+        while size < n:
+            size *= 2
+        vert = np.zeros((size, 2))
+        vert[:self._nv] = self._vert[:self._nv]
+        self._vert = vert
+
+    def _px_width(self):
+        size = self.params['size']
+        return max(int(size[2] - size[0]), 1)
+
+    def _to_px(self, x, y):
+        '''Converts the arrays of graph values to pixel coordinates.
+        '''
+        params = self.params
+        size = params['size']
+        xmin, xmax = params['xmin'], params['xmax']
+        ymin, ymax = params['ymin'], params['ymax']
+        if params['xlog']:
+            x = np.log10(x)
+            xmin, xmax = np.log10(xmin), np.log10(xmax)
+        if params['ylog']:
+            y = np.log10(y)
+            ymin, ymax = np.log10(ymin), np.log10(ymax)
+
+        px = (x - xmin) * ((size[2] - size[0]) / float(xmax - xmin)) + size[0]
+        py = (y - ymin) * ((size[3] - size[1]) / float(ymax - ymin)) + size[1]
+        return px, py
+
+    def _compute_vertices(self):
+        '''Recomputes all the vertices from the points, e.g. after the graph
+        was resized.
+        '''
+        n = self._n
+        px, py = self._to_px(self._x[:n], self._y[:n])
+        self._decimated = n > self._px_width()
+        self._nv = 0
+        if not self._decimated:
+            self._reserve(n)
+            self._vert[:n, 0] = px
+            self._vert[:n, 1] = py
+            self._nv = n
+            self._ncols = 0
+        else:
+            cols = px.astype(np.int64)
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(cols)) + 1))
+            cols = cols[starts]
+            ncols = self._ncols = len(cols)
+            if ncols > len(self._cols):
+                self._cols = np.zeros(2 * ncols, dtype=np.int64)
+            self._cols[:ncols] = cols
+
+            nv = 2 * ncols
+            self._reserve(nv)
+            vert = self._vert
+            vert[:nv, 0] = np.repeat(cols, 2)
+            vert[:nv:2, 1] = np.minimum.reduceat(py, starts)
+            vert[1:nv:2, 1] = np.maximum.reduceat(py, starts)
+            self._nv = nv
+        self._update_mesh()
+
+    def _update_mesh(self):
+        '''Rebuilds the mesh vertices and indices from the computed vertices.
+        '''
+        mesh = self._mesh
+        n = self._nv
+        vertices = np.zeros((n, 4))
+        vertices[:, :2] = self._vert[:n]
+        self._vertices = vertices.ravel().tolist()
+        self._indices = list(range(n))
+
+        # indices must never point past the vertices
+        if len(mesh.indices) > n:
+            mesh.indices = self._indices
+        mesh.vertices = self._vertices
+        if len(mesh.indices) < n:
+            mesh.indices = self._indices
+
+    def plot_mesh(self):
+        self._compute_vertices()
+
+
+Factory.register('TrialPlot', cls=TrialPlot)
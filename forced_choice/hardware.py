@@ -0,0 +1,54 @@
+'''Hardware
+============
+
+The devices that use the actual hardware, through the Barst server.
+
+They are in their own module, rather than in :mod:`forced_choice.devices`,
+because importing them imports the hardware backends. The
+:class:`~forced_choice.stages.RootStage` only imports this module when it
+creates the devices of an experiment that does not simulate the hardware.
+The settings schema is built from these classes when they can be imported,
+see :func:`~forced_choice.devices.get_hardware_config_classes`.
+'''
+
+from cplcom.moa.device.ftdi import FTDISerializerDevice
+from cplcom.moa.device.mcdaq import MCDAQDevice
+
+from forced_choice.devices import (
+    FTDIOdorsBase, DAQInDeviceBase, DAQOutDeviceBase)
+
+__all__ = ('FTDIOdors', 'DAQInDevice', 'DAQOutDevice')
+
+
+class FTDIOdors(FTDIOdorsBase, FTDISerializerDevice):
+    '''Device used when using the barst ftdi odor device.
+    '''
+
+    def __init__(self, **kwargs):
+        super(FTDIOdors, self).__init__(**kwargs)
+        self.dev_map = dict(self.valve_index)
+
+
+class DAQInDevice(DAQInDeviceBase, MCDAQDevice):
+    '''Device used when using the barst Switch & Sense 8/8 input device.
+    '''
+
+    def __init__(self, **kwargs):
+        super(DAQInDevice, self).__init__(direction='i', **kwargs)
+        self.dev_map = {
+        'nose_beam': self.nose_beam_pin,
+        'reward_beam_r': self.reward_beam_r_pin,
+        'reward_beam_l': self.reward_beam_l_pin}
+
+
+class DAQOutDevice(DAQOutDeviceBase, MCDAQDevice):
+    '''Device used when using the barst Switch & Sense 8/8 output device.
+    '''
+
+    def __init__(self, **kwargs):
+        super(DAQOutDevice, self).__init__(direction='o', **kwargs)
+        self.dev_map = {'house_light': self.house_light_pin,
+                   'ir_leds': self.ir_leds_pin,
+                   'fans': self.fans_pin,
+                   'feeder_r': self.feeder_r_pin,
+                   'feeder_l': self.feeder_l_pin}
@@ -0,0 +1,362 @@
+'''Lifecycle
+============
+
+Activates and deactivates the devices of a rig according to their
+dependencies.
+
+The devices are added to a :class:`DeviceGraph` with the names of the devices
+they depend on, e.g. the FTDI channel depends on the Barst server, and the
+valve device depends on the FTDI channel. When activating, each device is
+activated as soon as all the devices it depends on are active, so devices
+that don't depend on each other are activated concurrently. When
+deactivating, each device is deactivated as soon as all the devices that
+depend on it are inactive.
+
+The startup or shutdown therefore takes as long as the slowest chain of
+dependent devices rather than the sum of all the devices. The whole graph
+has one deadline, and the time each device took is recorded in
+:attr:`DeviceGraph.timings`.
+
+Warm devices
+------------
+
+When :attr:`~forced_choice.stages.RootStage.keep_devices_warm`, the devices
+are not deactivated when the experiment stops. Instead, their outputs are
+reset to a safe state and they are parked as :class:`WarmDevices` of the
+rig's namespace with :func:`park_devices`. The next experiment of the rig
+takes them back with :func:`take_warm_devices`, so it only re-binds to the
+already open devices rather than creating and activating them again, as
+long as the device settings did not change. :func:`release_warm_devices`
+deactivates all the parked devices, e.g. when the app exits. Because the
+deactivation is asynchronous, the app only stops once it's done.
+'''
+
+from kivy.clock import Clock
+
+from forced_choice.timing import session_clock
+from forced_choice.rig import release_server
+
+__all__ = ('DeviceGraph', 'WarmDevices', 'park_devices', 'take_warm_devices',
+           'has_warm_devices', 'release_warm_devices')
+
+
+class DeviceGraph(object):
+    '''The devices of a rig and their dependencies.
+
+    Devices are added with :meth:`add`, after which they are all activated
+    with :meth:`activate` or deactivated with :meth:`deactivate`. A device is
+    any moa device with the ref-counted ``activate``, ``deactivate``
+    methods and the ``activation`` property.
+    '''
+
+    names = []
+    '''The names of the devices, in the order they were added.
+    '''
+
+    devices = {}
+    '''A dict mapping the name of each device to the device.
+    '''
+
+    deps = {}
+    '''A dict mapping the name of each device to the set of names of the
+    devices it depends on.
+    '''
+
+    timings = {}
+    '''A dict mapping the name of each device to the duration, in seconds,
+    that it took to reach the target state during the last
+    :meth:`activate` or :meth:`deactivate`, or None if it didn't reach it
+    (yet).
+    '''
+
+    elapsed = None
+    '''The duration, in seconds, of the last :meth:`activate` or
+    :meth:`deactivate`, or None while it's in progress.
+    '''
+
+    pending = []
+    '''The names of the devices that have not reached the target state of the
+    current :meth:`activate` or :meth:`deactivate`.
+    '''
+
+    _state = ''
+
+    _prereqs = {}
+
+    _start_func = None
+
+    _callback = None
+
+    _on_timeout = None
+
+    _timeout_event = None
+
+    _t0 = {}
+
+    _bindings = {}
+
+    _start = 0.
+
+    _running = False
+
+    _dirty = False
+
+    def __init__(self):
+        self.names = []
+        self.devices = {}
+        self.deps = {}
+        self.timings = {}
+        self.pending = []
+        self._t0 = {}
+        self._bindings = {}
+
+    def add(self, name, device, deps=()):
+        '''Adds the ``device`` named ``name`` that depends on the devices
+        named in ``deps``, which must have been added already.
+        '''
+        if name in self.devices:
+            raise ValueError('Device "{}" was already added'.format(name))
+        for dep in deps:
+            if dep not in self.devices:
+                raise ValueError('Device "{}" depends on the unknown device '
+                                 '"{}"'.format(name, dep))
+        self.names.append(name)
+        self.devices[name] = device
+        self.deps[name] = set(deps)
+
+    def without(self, name):
+        '''Returns a new :class:`DeviceGraph` with all the devices except for
+        the device ``name``, which is also removed from the dependencies of
+        the other devices.
+        '''
+        graph = DeviceGraph()
+        for n in self.names:
+            if n != name:
+                graph.add(n, self.devices[n], self.deps[n] - {name})
+        return graph
+
+    def activate(self, owner, callback, timeout=None, on_timeout=None):
+        '''Activates all the devices with ``owner`` as the identifier, each
+        after all its dependencies are active.
+
+        :Parameters:
+
+            `owner`:
+                The identifier passed to each device's ``activate``.
+            `callback`: callable
+                Called with this instance once all the devices are active.
+            `timeout`: float
+                If not None, the duration, in seconds, within which all the
+                devices must be active.
+            `on_timeout`: callable
+                Called with this instance if the devices are not all active
+                within ``timeout``, after which the activation is canceled.
+                :attr:`pending` lists the devices that were not active.
+        '''
+        self._run('active', self.deps, lambda dev: dev.activate(owner),
+                  callback, timeout, on_timeout)
+
+    def deactivate(self, owner, callback, timeout=None, on_timeout=None,
+                   clear=False):
+        '''Deactivates all the devices with ``owner`` as the identifier, each
+        after all the devices that depend on it are inactive. The parameters
+        are as in :meth:`activate`, and ``clear`` is passed to each device's
+        ``deactivate``.
+        '''
+        dependents = {name: set() for name in self.names}
+        for name, deps in self.deps.items():
+            for dep in deps:
+                dependents[dep].add(name)
+        self._run('inactive', dependents,
+                  lambda dev: dev.deactivate(owner, clear=clear),
+                  callback, timeout, on_timeout)
+
+    def cancel(self):
+        '''Cancels the current :meth:`activate` or :meth:`deactivate`. The
+        devices already started are not reverted.
+        '''
+        for name, uid in self._bindings.items():
+            self.devices[name].unbind_uid('activation', uid)
+        self._bindings = {}
+        if self._timeout_event is not None:
+            self._timeout_event.cancel()
+            self._timeout_event = None
+        self._callback = self._on_timeout = self._start_func = None
+
+    def format_timings(self):
+        '''Returns a one line summary of the :attr:`timings`, e.g. for
+        logging.
+        '''
+        items = []
+        for name in self.names:
+            t = self.timings.get(name)
+            items.append('{} {}'.format(
+                name, '-' if t is None else '{:.3f}s'.format(t)))
+        return ', '.join(items)
+
+    def _run(self, state, prereqs, start_func, callback, timeout, on_timeout):
+        self.cancel()
+        self._state = state
+        self._prereqs = prereqs
+        self._start_func = start_func
+        self._callback = callback
+        self._on_timeout = on_timeout
+        self.pending = list(self.names)
+        self.timings = {name: None for name in self.names}
+        self.elapsed = None
+        self._t0 = {}
+        self._start = session_clock.now()
+
+        if timeout is not None:
+            self._timeout_event = Clock.schedule_once(
+                self._do_timeout, timeout)
+        self._start_ready()
+
+    def _start_ready(self):
+        # devices may reach their state synchronously when started, which
+        # re-enters here through _state_changed, so only loop at the top
+        if self._running:
+            self._dirty = True
+            return
+
+        self._running = True
+        try:
+            self._dirty = True
+            while self._dirty and self._start_func is not None:
+                self._dirty = False
+                pending = self.pending
+                for name in self.names:
+                    if name in self._t0 or any(
+                            n in pending for n in self._prereqs[name]):
+                        continue
+
+                    device = self.devices[name]
+                    self._t0[name] = session_clock.now()
+                    self._bindings[name] = device.fbind(
+                        'activation', self._state_changed, name)
+                    self._start_func(device)
+                    self._state_changed(name, device, device.activation)
+                    if self._start_func is None:
+                        return
+        finally:
+            self._running = False
+
+        if not self.pending and self._start_func is not None:
+            callback = self._callback
+            self.elapsed = session_clock.now() - self._start
+            self.cancel()
+            callback(self)
+
+    def _state_changed(self, name, device, value):
+        if value != self._state or name not in self._bindings:
+            return
+        device.unbind_uid('activation', self._bindings.pop(name))
+        self.timings[name] = session_clock.now() - self._t0[name]
+        self.pending.remove(name)
+        self._start_ready()
+
+    def _do_timeout(self, *largs):
+        self._timeout_event = None
+        on_timeout = self._on_timeout
+        self.elapsed = session_clock.now() - self._start
+        self.cancel()
+        if on_timeout is not None:
+            on_timeout(self)
+
+
+class WarmDevices(object):
+    '''The devices of a rig that are kept open between experiments, see
+    :mod:`forced_choice.lifecycle`.
+
+    The instance is also the identifier, the owner, with which the devices
+    are activated, so that they stay active when the root stage that
+    created them is done.
+    '''
+
+    key = ''
+    '''A string encoding the settings with which the devices were created.
+    The devices are only reused with the same settings.
+    '''
+
+    attrs = {}
+    '''A dict mapping the names of the
+    :class:`~forced_choice.stages.RootStage` properties, e.g. ``odor_dev``,
+    to their devices.
+    '''
+
+    widgets = {}
+    '''The :attr:`~forced_choice.stages.RootStage.odor_widgets` of the
+    devices.
+    '''
+
+    graph = None
+    '''The :class:`DeviceGraph` of the devices.
+    '''
+
+    def __init__(self, key):
+        self.key = key
+        self.attrs = {}
+        self.widgets = {}
+
+    def release(self, callback=None, timeout=10.):
+        '''Deactivates all the devices, and calls ``callback`` with the
+        :class:`DeviceGraph`, if not None, once they are inactive or after
+        ``timeout``.
+
+        The Barst server is only deactivated if no other rig uses it.
+        '''
+        graph = self.graph
+        server = self.attrs.get('server')
+        if server is not None and not release_server(self, server):
+            server.deactivate(self)
+            graph = graph.without('server')
+
+        callback = callback or (lambda graph: None)
+        graph.deactivate(self, callback, timeout=timeout, on_timeout=callback,
+                         clear=True)
+
+
+_warm = {}
+'''Maps the namespace of each rig to its parked :class:`WarmDevices`.
+'''
+
+
+def park_devices(namespace, warm):
+    '''Parks the :class:`WarmDevices`, ``warm``, of the rig whose namespace is
+    ``namespace`` until they are taken with :func:`take_warm_devices`.
+    '''
+    _warm[namespace] = warm
+
+
+def take_warm_devices(namespace):
+    '''Returns the :class:`WarmDevices` parked for the rig namespace
+    ``namespace`` and removes them from the parked devices, or None if there
+    are none.
+    '''
+    return _warm.pop(namespace, None)
+
+
+def has_warm_devices():
+    '''Returns whether any rig has parked devices.
+    '''
+    return bool(_warm)
+
+
+def release_warm_devices(callback=None):
+    '''Releases, with :meth:`WarmDevices.release`, the parked devices of all
+    the rigs. ``callback``, if not None, is called once all the rigs'
+    devices are released.
+    '''
+    warms = list(_warm.values())
+    _warm.clear()
+    remaining = [len(warms)]
+
+    def released(graph):
+        remaining[0] -= 1
+        if not remaining[0] and callback is not None:
+            callback()
+
+    if not warms and callback is not None:
+        callback()
+    for warm in warms:
+        warm.release(released)
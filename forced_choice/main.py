@@ -5,18 +5,32 @@ The main module that starts the experiment.
 '''
 
 from functools import partial
+from os import environ
 from os.path import join, dirname, isdir
+from time import sleep, time, strftime, localtime
 
 from cplcom.moa.app import ExperimentApp, run_app as run_cpl_app
+from cplcom.config import populate_dump_config
 
-from kivy.properties import ObjectProperty
+from kivy.properties import ObjectProperty, ListProperty, StringProperty
+from kivy.base import EventLoop
+from kivy.clock import Clock
+from kivy.logger import Logger
+from kivy.factory import Factory
+from kivy.uix.tabbedpanel import TabbedPanelItem
 from kivy.resources import resource_add_path
 from kivy.uix.behaviors.knspace import knspace
-from kivy.garden.filebrowser import FileBrowser
 from kivy.lang import Builder
 
 import forced_choice.graphics
 import forced_choice.stages
+from forced_choice.rig import Rig, load_rigs
+from forced_choice.lifecycle import has_warm_devices, release_warm_devices
+from forced_choice.startup import report_startup
+from forced_choice.timing import session_clock
+
+# only import the file browser when it's first shown
+Factory.register('FileBrowser', module='kivy.garden.filebrowser')
 
 __all__ = ('ForcedChoiceApp', 'run_app')
 
@@ -25,14 +39,136 @@ class ForcedChoiceApp(ExperimentApp):
     '''The app which runs the experiment.
     '''
 
+    rigs = ListProperty([])
+    '''The list of the :class:`~forced_choice.rig.Rig` instances run by the
+    app, each displayed in its own tab. The first rig uses the global
+    ``knspace`` and its root stage is the app's root stage.
+    '''
+
+    rigs_path = StringProperty(environ.get('FORCED_CHOICE_RIGS', ''))
+    '''The json file listing the rigs, see :mod:`forced_choice.rig`. If
+    empty, a single rig is run.
+
+    Defaults to the ``FORCED_CHOICE_RIGS`` environment variable.
+    '''
+
+    warm_release_timeout = 15.
+    '''The maximum time, in seconds, to wait for the warm devices to be
+    released when the app stops after the kivy loop ended.
+    '''
+
+    _releasing = False
+
     def __init__(self, **kwargs):
         super(ForcedChoiceApp, self).__init__(**kwargs)
+        forced_choice.graphics.load_kv()
         Builder.load_file(join(dirname(__file__), 'Experiment.kv'))
 
+    def on_start(self):
+        super(ForcedChoiceApp, self).on_start()
+        self.build_rigs()
+        report_startup()
+        if EventLoop.window is not None:
+            EventLoop.window.fbind('on_request_close', self._request_close)
+
+    def stop(self, *largs):
+        '''Stops the app once the devices kept open between experiments
+        with :attr:`~forced_choice.stages.RootStage.keep_devices_warm` are
+        released.
+
+        While the kivy loop runs, the app only stops once the asynchronous
+        release is done. Otherwise, the clock is ticked until it's done or
+        after :attr:`warm_release_timeout`.
+        '''
+        if self._releasing:
+            return
+        for rig in self.rigs[1:]:
+            rig.stop()
+        if not has_warm_devices():
+            super(ForcedChoiceApp, self).stop(*largs)
+            return
+
+        if EventLoop.status == 'started':
+            self._releasing = True
+            release_warm_devices(
+                callback=lambda: self._warm_released(*largs))
+            return
+
+        done = []
+        release_warm_devices(callback=lambda: done.append(True))
+        end = time() + self.warm_release_timeout
+        while not done and time() < end:
+            Clock.tick()
+            sleep(.005)
+        super(ForcedChoiceApp, self).stop(*largs)
+
+    def _warm_released(self, *largs):
+        self._releasing = False
+        super(ForcedChoiceApp, self).stop(*largs)
+
+    def _request_close(self, *largs, **kwargs):
+        # closing the window ends the loop, so first release the devices
+        if self._releasing or has_warm_devices():
+            self.stop()
+            return True
+        return False
+
+    def build_rigs(self):
+        '''Creates the :attr:`rigs` and adds a tab with the widgets of each
+        rig.
+        '''
+        if self.rigs_path:
+            rigs = load_rigs(self.rigs_path)
+        else:
+            rigs = [Rig(name='Rig', knspace=knspace)]
+        self.rigs = rigs
+        self.fbind('recovery_file', self._sync_recovery_file)
+        self._sync_recovery_file()
+
+        panel = knspace.gui_rigs
+        tabs = []
+        for rig in rigs:
+            tab = TabbedPanelItem(text=rig.name)
+            tab.add_widget(Factory.RigView(knspace=rig.knspace, rig=rig))
+            panel.add_widget(tab)
+            tabs.append(tab)
+        panel.switch_to(tabs[0])
+
+    def anchor_session_clock(self):
+        '''Anchors the :attr:`~forced_choice.timing.session_clock` shared by
+        all the rigs, unless one of them is already running.
+        '''
+        if any(rig.is_running() or rig.root_stage is not None
+               for rig in self.rigs) or self.root_stage is not None:
+            return
+        session_clock.anchor()
+        Logger.info('Forced choice: Session clock anchored at {}'.format(
+            strftime('%m-%d-%Y %H:%M:%S', localtime(
+                session_clock.epoch_time))))
+
+    def load_settings(self):
+        '''Reloads the :attr:`app_settings` from the config file, like
+        :meth:`start_stage` does for the first rig, so the other rigs started
+        with :meth:`~forced_choice.rig.Rig.start` see the current settings.
+        '''
+        self.app_settings = populate_dump_config(
+            self.ensure_config_file(self.json_config_path),
+            self.get_config_classes())
+
+    def _sync_recovery_file(self, *largs):
+        # the first rig is recovered by the app
+        if self.rigs:
+            self.rigs[0].recovery_file = self.recovery_file or ''
+
+    def start_stage(self, *largs, **kwargs):
+        self.anchor_session_clock()
+        super(ForcedChoiceApp, self).start_stage(*largs, **kwargs)
+
     def clean_up_root_stage(self):
         super(ForcedChoiceApp, self).clean_up_root_stage()
         knspace.gui_start_stop.state = 'normal'
 
+
 run_app = partial(run_cpl_app, ForcedChoiceApp)
 '''The function that starts the experiment GUI and the entry point for
 the main script.
@@ -0,0 +1,182 @@
+'''Precompute
+=============
+
+Computes the trial odor schedules of many animals ahead of time, without
+starting the experiment GUI.
+
+The schedules are computed in parallel in a pool of processes, one animal at a
+time per process, and are written to the same schedule files the experiment
+uses (see :mod:`forced_choice.schedule`). So when an animal is started in the
+experiment with the same configuration and seed, its schedule is simply loaded.
+
+For example, to compute the schedules of three animals for two sessions
+whose :attr:`~forced_choice.stages.ExperimentConfig.seed` is 0 and 1,
+using the ``default`` experiment of the json config file::
+
+    forced_choice_precompute config.json -a rat1 rat2 rat3 -s 0 1
+'''
+
+import os
+# don't let kivy parse the command line of the script
+os.environ['KIVY_NO_ARGS'] = '1'
+
+import json
+import argparse
+from multiprocessing import Pool, cpu_count
+from os.path import dirname, abspath
+
+from kivy.resources import resource_add_path
+
+from forced_choice.stages import ExperimentConfig
+from forced_choice.schedule import (
+    compute_schedule_key, schedule_seed, schedule_filename, save_schedules)
+
+__all__ = ('precompute_animal', 'precompute_schedules', 'run_precompute')
+
+
+def precompute_animal(
+        opts, animal_id, seeds, schedule_path, resource_paths=()):
+    '''Computes the schedules of one animal for each seed and adds them to
+    the animal's schedule file.
+
+    :Parameters:
+
+        `opts`: dict
+            The :class:`~forced_choice.stages.ExperimentConfig` settings, as
+            well as its
+            :attr:`~forced_choice.stages.ExperimentConfig.n_valve_boards` and
+            :attr:`~forced_choice.stages.ExperimentConfig.use_mfc`.
+        `animal_id`: str
+            The animal id.
+        `seeds`: list
+            The list of :attr:`~forced_choice.stages.ExperimentConfig.seed`
+            for which to compute a schedule, e.g. one for each session.
+        `schedule_path`: str
+            The :attr:`~forced_choice.stages.RootStage.schedule_path` in which
+            to save the schedules.
+        `resource_paths`: list
+            Directories added to the kivy resource path, so that the odor files
+            can be found.
+
+    :returns:
+
+        The filename of the schedule file.
+    '''
+    for path in resource_paths:
+        resource_add_path(path)
+
+    config = ExperimentConfig(**opts)
+    schedules = {}
+    for seed in seeds:
+        config.seed = seed
+        key = compute_schedule_key(config, animal_id)
+        config.compute_odors(seed=schedule_seed(key))
+        schedules[key] = (config.trial_odors, config.odor_opts)
+
+    fname = schedule_filename(schedule_path, animal_id)
+    save_schedules(fname, schedules)
+    return fname
+
+
+def _precompute_animal(args):
+    '''Pool worker calling :func:`precompute_animal`.
+    '''
+    return precompute_animal(*args)
+
+
+def precompute_schedules(
+        settings, animal_ids, seeds, experiment='default', schedule_path=None,
+        resource_paths=(), processes=None):
+    '''Computes the schedules of all the animals, for all the seeds, using a
+    pool of processes.
+
+    :Parameters:
+
+        `settings`: dict
+            The app settings as read from the json config file.
+        `animal_ids`: list
+            The animal ids.
+        `seeds`: list
+            The seeds to compute for each animal.
+        `experiment`: str
+            The name of the experiment in ``settings['_experiment']``.
+        `schedule_path`: str
+            The directory where to save the schedules. If None, it's the
+            :attr:`~forced_choice.stages.RootStage.schedule_path` of the
+            settings.
+        `resource_paths`: list
+            Directories added to the kivy resource path, so that the odor files
+            can be found.
+        `processes`: int
+            The number of processes to use. If None, it's the number of cpus.
+
+    :returns:
+
+        The list of the schedule filenames, one for each animal.
+    '''
+    if experiment not in settings.get('_experiment', {}):
+        raise ValueError('Experiment "{}" not found in the configuration'.
+                         format(experiment))
+
+    devices = settings.get('devices', {})
+    opts = dict(settings['_experiment'][experiment])
+    for name in ('n_valve_boards', 'use_mfc'):
+        if name in devices:
+            opts[name] = devices[name]
+    if schedule_path is None:
+        schedule_path = devices.get('schedule_path', 'schedules')
+    if not schedule_path:
+        raise ValueError('No schedule path provided')
+
+    tasks = [(opts, animal_id, seeds, schedule_path, resource_paths)
+             for animal_id in animal_ids]
+    processes = min(processes or cpu_count(), len(tasks))
+    if processes <= 1:
+        return list(map(_precompute_animal, tasks))
+
+    pool = Pool(processes)
+    try:
+        return pool.map(_precompute_animal, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_precompute(args=None):
+    '''The entry point of the ``forced_choice_precompute`` script that
+    computes the schedules using :func:`precompute_schedules`.
+    '''
+    parser = argparse.ArgumentParser(
+        description='Precomputes the trial odor schedules of animals.')
+    parser.add_argument(
+        'config', help='The json config file of the experiment.')
+    parser.add_argument(
+        '-a', '--animals', nargs='+', required=True, help='The animal ids.')
+    parser.add_argument(
+        '-s', '--seeds', nargs='+', type=int, default=[0],
+        help='The config seeds for which to compute each animal schedule.')
+    parser.add_argument(
+        '-e', '--experiment', default='default',
+        help='The name of the experiment in the config.')
+    parser.add_argument(
+        '-o', '--output', default=None,
+        help='The directory where to save the schedules. Defaults to the '
+        'schedule_path of the config.')
+    parser.add_argument(
+        '-j', '--processes', type=int, default=None,
+        help='The number of processes. Defaults to the number of cpus.')
+    args = parser.parse_args(args)
+
+    with open(args.config, 'r') as fh:
+        settings = json.load(fh)
+
+    resource_paths = [dirname(abspath(args.config)),
+                      os.path.join(dirname(__file__), 'data')]
+    for fname in precompute_schedules(
+            settings, args.animals, args.seeds, args.experiment, args.output,
+            resource_paths, args.processes):
+        print(fname)
+
+
+if __name__ == '__main__':
+    run_precompute()
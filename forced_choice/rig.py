@@ -0,0 +1,286 @@
+'''Rigs
+=========
+
+Runs several behavior boxes, rigs, from a single process.
+
+Each :class:`Rig` has its own namespace, :attr:`Rig.knspace`, in which the
+:class:`~forced_choice.stages.RootStage` stage tree, the devices, and the GUI
+widgets of the rig are named. E.g. the input device of a rig is
+``rig.knspace.daqin``. The first rig uses the global ``knspace``, so that with
+a single rig everything is named as before, while the other rigs use a fork
+of it.
+
+All the rigs run in the same app, sharing its render loop and its settings,
+and the rigs using the same Barst server settings share the server (see
+:func:`acquire_server`). Each rig shows its GUI in its own tab, with its own
+start / stop button and recovery check, so each rig runs its own
+:class:`~forced_choice.stages.RootStage`, animals and sessions, and is
+started, stopped, and recovered independently of the other rigs.
+
+The first rig's root stage is the app's root stage, so it is started and
+recovered by the app as before. The other rigs' root stages are started with
+:meth:`Rig.start`, and when they are done, the ``restore_properties`` of
+their stages, e.g. the block and trial counts, are saved to
+:attr:`Rig.recovery_file`, from which the rig can be recovered the next time
+it's started.
+
+The rigs are listed in a json file, whose path is given by the
+``FORCED_CHOICE_RIGS`` environment variable (see
+:attr:`~forced_choice.main.ForcedChoiceApp.rigs_path`). It is a list with a
+dict for each rig, holding the ``name`` of the rig and the settings sections
+that override the app settings for that rig. A ``supervisor`` dict is
+ignored by the app and only used by the :mod:`forced_choice.supervisor`.
+E.g.::
+
+    [
+        {"name": "box1"},
+        {"name": "box2",
+         "devices": {"log_filename": "box2_{animal}_%m-%d-%Y.csv"},
+         "daqin": {"nose_beam_pin": 5}}
+    ]
+'''
+
+import json
+from os.path import join, isfile
+from time import strftime
+
+from kivy.event import EventDispatcher
+from kivy.logger import Logger
+from kivy.factory import Factory
+from kivy.properties import StringProperty, DictProperty, ObjectProperty
+from kivy.uix.behaviors.knspace import knspace, KNSpaceBehavior
+
+
+__all__ = ('Rig', 'load_rigs', 'acquire_server', 'release_server',
+           'rig_names')
+
+rig_names = (
+    'exp_root', 'exp_dev_init', 'exp_animal_stage', 'exp_animal_wait',
+    'exp_block', 'exp_trial', 'exp_nose_poke_wait', 'exp_nose_poke',
+    'exp_decision', 'exp_config', 'ftdi_chan', 'odors', 'daqin', 'daqout',
+    'mfc_air', 'mfc_a', 'mfc_b', 'sound_l', 'sound_r', 'gui_start_stop')
+'''The names of the stages and devices of a rig that are named in the rig's
+namespace. A forked namespace otherwise returns the objects of the first rig
+for names it doesn't have, so :func:`load_rigs` sets them to None in the
+forked namespaces.
+'''
+
+_servers = {}
+'''Maps the json encoded settings of each shared Barst server to a list of
+the server and the set of the root stages using it.
+'''
+
+
+def acquire_server(owner, settings):
+    '''Returns the Barst server,
+    :class:`~cplcom.moa.device.barst_server.Server`, with the given settings,
+    creating it if no other rig uses it. ``owner``,
+    the :class:`~forced_choice.stages.RootStage` using it, must release it
+    with :func:`release_server` when done.
+    '''
+    key = json.dumps(settings, sort_keys=True)
+    if key not in _servers:
+        from cplcom.moa.device.barst_server import Server
+        _servers[key] = [Server(knsname='barst_server', **settings), set()]
+
+    server, owners = _servers[key]
+    owners.add(owner)
+    return server
+
+
+def release_server(owner, server):
+    '''Releases the Barst server acquired by ``owner`` with
+    :func:`acquire_server`.
+
+    :returns:
+
+        True if ``owner`` was the last rig using the server, in which case
+        it should stop the server, otherwise False.
+    '''
+    for key, (shared, owners) in list(_servers.items()):
+        if shared is server:
+            owners.discard(owner)
+            if owners:
+                return False
+            del _servers[key]
+            return True
+    return True
+
+
+class Rig(KNSpaceBehavior, EventDispatcher):
+    '''A behavior box run by the app. The rig is named ``rig`` in its
+    :attr:`knspace`.
+    '''
+
+    name = StringProperty('')
+    '''The name of the rig, displayed in its tab.
+    '''
+
+    settings = DictProperty({})
+    '''A dict of the settings sections, e.g. ``daqin``, that override the app
+    settings for this rig. See :meth:`get_settings`.
+    '''
+
+    root_stage = ObjectProperty(None, allownone=True)
+    '''The :class:`~forced_choice.stages.RootStage` of the rig started with
+    :meth:`start`, or None when not running. The root stage of the first rig
+    is the app's root stage instead.
+    '''
+
+    recovery_file = StringProperty('')
+    '''The file holding the state of the rig's last experiment, from which
+    it's recovered when started with ``recover``. For the first rig, it's
+    the app's ``recovery_file``.
+    '''
+
+    def __init__(self, **kwargs):
+        super(Rig, self).__init__(knsname='rig', **kwargs)
+
+    def get_settings(self, settings):
+        '''Returns a copy of the app ``settings`` with the options of each
+        section updated from :attr:`settings`.
+        '''
+        settings = dict(settings)
+        for section, opts in self.settings.items():
+            base = dict(settings.get(section, {}))
+            base.update(opts)
+            settings[section] = base
+        return settings
+
+    @property
+    def is_app_rig(self):
+        '''Whether this is the first rig, whose root stage is the app's root
+        stage.
+        '''
+        return self.knspace is knspace
+
+    def is_running(self):
+        '''Returns whether the rig's root stage is running.
+        '''
+        root = self.knspace.exp_root
+        return bool(root) and root.started and not root.finished
+
+    def start(self, recover=False):
+        '''Starts the rig's experiment. If ``recover``, the stages are
+        restored from the :attr:`recovery_file`.
+
+        The first rig is started by the app's ``start_stage``. For the other
+        rigs, the app settings are reloaded and the :attr:`root_stage` is
+        created in the rig's namespace and started.
+        '''
+        app = self.knspace.app
+        if self.is_app_rig:
+            app.start_stage(recover=recover)
+            return
+        if self.root_stage is not None:
+            return
+
+        app.anchor_session_clock()
+        app.load_settings()
+        root = self.root_stage = Factory.RootStage(knspace=self.knspace)
+        if recover:
+            self.load_recovery(root)
+        root.step_stage()
+
+    def stop(self):
+        '''Stops the rig's experiment, if running.
+        '''
+        if self.is_app_rig:
+            self.knspace.app.stop_experiment()
+            return
+        root = self.root_stage
+        if root is not None and root.started and not root.finished:
+            root.step_stage()
+
+    def clean_up(self):
+        '''Called by the :attr:`root_stage` when it's done. Saves its state to
+        a new :attr:`recovery_file`.
+        '''
+        root = self.root_stage
+        self.root_stage = None
+        try:
+            self.dump_recovery(root)
+        except Exception as e:
+            Logger.error('Rig: Failed saving the recovery state of "{}": {}'.
+                         format(self.name, e))
+        gui = self.knspace.gui_start_stop
+        if gui is not None:
+            gui.state = 'normal'
+
+    def dump_recovery(self, root):
+        '''Saves the ``restore_properties`` of all the stages of ``root``, in
+        the order of the stage tree, to a new file in the app's
+        ``recovery_path`` and sets it as the :attr:`recovery_file`. Nothing is
+        saved if the ``recovery_path`` is empty.
+        '''
+        path = self.knspace.app.recovery_path
+        if not path:
+            return
+        states = [
+            {name: getattr(stage, name)
+             for name in stage.restore_properties}
+            for stage in _walk_stages(root)]
+
+        filename = join(path, strftime(
+            '{}_%m-%d-%Y_%I-%M-%S_%p.json'.format(self.name)))
+        with open(filename, 'w') as fh:
+            json.dump(states, fh)
+        self.recovery_file = filename
+
+    def load_recovery(self, root):
+        '''Restores the stages of ``root``, not yet started, from the state
+        saved in the :attr:`recovery_file` by :meth:`dump_recovery`. They are
+        restored with their ``restored_properties`` when they start.
+        '''
+        filename = self.recovery_file
+        if not filename or not isfile(filename):
+            raise ValueError('Rig "{}" has no recovery file to recover from'.
+                             format(self.name))
+        with open(filename, 'r') as fh:
+            states = json.load(fh)
+
+        stages = list(_walk_stages(root))
+        if len(stages) != len(states):
+            raise ValueError(
+                'The stages of "{}" do not match the experiment of rig "{}"'.
+                format(filename, self.name))
+        for stage, state in zip(stages, states):
+            if state:
+                stage.restored_properties = state
+
+
+def _walk_stages(root):
+    '''Yields ``root`` and all its sub-stages, depth first.
+    '''
+    stack = [root]
+    while stack:
+        stage = stack.pop()
+        yield stage
+        stack.extend(reversed(stage.stages))
+
+
+def load_rigs(filename):
+    '''Creates the :class:`Rig` instances listed in the json file (see
+    :mod:`forced_choice.rig`). The first rig uses the global ``knspace`` and
+    the others use a fork of it.
+    '''
+    with open(filename, 'r') as fh:
+        items = json.load(fh)
+    if not items:
+        raise ValueError('No rigs listed in "{}"'.format(filename))
+
+    rigs = []
+    for i, item in enumerate(items):
+        item = dict(item)
+        name = item.pop('name', 'Rig {}'.format(i))
+        item.pop('supervisor', None)
+        if name in [rig.name for rig in rigs]:
+            raise ValueError('Rig name "{}" is not unique'.format(name))
+
+        namespace = knspace
+        if i:
+            namespace = knspace.fork()
+            for obj_name in rig_names:
+                setattr(namespace, obj_name, None)
+        rigs.append(Rig(name=name, settings=item, knspace=namespace))
+    return rigs
@@ -0,0 +1,176 @@
+'''Schedule
+===========
+
+Caches the trial odor schedules computed by
+:meth:`~forced_choice.stages.ExperimentConfig.compute_odors` on disk.
+
+Each schedule is identified by its key, which is a hash of everything that
+determines the schedule: the configuration parameters, the contents of the odor
+files, the seed, and the animal id. So a schedule is only ever computed once
+and the same animal with the same configuration always gets the same schedule
+back.
+
+All the schedules of an animal are stored in a single compact json file named
+after the animal, mapping the schedule keys to the schedules. These files are
+either written by the experiment when an animal is started, or ahead of time
+for many animals by :mod:`forced_choice.precompute`.
+'''
+
+import re
+import json
+import hashlib
+from os import makedirs, remove, rename
+from os.path import join, isdir, isfile, dirname
+
+from kivy import resources
+
+__all__ = ('schedule_version', 'compute_schedule_key', 'schedule_seed',
+           'schedule_filename', 'load_schedule', 'save_schedules')
+
+schedule_version = 2
+'''The version of the schedule generation. It's part of the schedule key, so
+it must be incremented whenever the generated schedules would change for the
+same key, invalidating all the cached schedules.
+
+Version 2 is the constructive sampler of
+:meth:`~forced_choice.stages.ExperimentConfig.do_equal_random`.
+'''
+
+_unsafe_filename_pat = re.compile('[^A-Za-z0-9_.-]')
+
+
+def _read_file(filename):
+    '''Returns the contents of the resource ``filename``, or an empty string if
+    it cannot be found.
+    '''
+    fname = resources.resource_find(filename)
+    if not fname or not isfile(fname):
+        return b''
+    with open(fname, 'rb') as fh:
+        return fh.read()
+
+
+def compute_schedule_key(config, animal_id):
+    '''Computes the key of the schedule for the configuration.
+
+    :Parameters:
+
+        `config`: :class:`~forced_choice.stages.ExperimentConfig`
+            The configuration for which the schedule is computed.
+        `animal_id`: str
+            The animal for whom the schedule is computed.
+
+    :returns:
+
+        The hex digest of the hash of the configuration parameters, the
+        :attr:`~forced_choice.stages.ExperimentConfig.odor_path` file and any
+        ``'list'`` method odor files, and
+        :attr:`~forced_choice.stages.ExperimentConfig.seed`.
+    '''
+    params = {
+        name: getattr(config, name) for name in config.__settings_attrs__}
+    params['n_valve_boards'] = config.n_valve_boards
+    params['use_mfc'] = config.use_mfc
+    params['animal_id'] = animal_id
+    params['schedule_version'] = schedule_version
+
+    h = hashlib.sha1()
+    h.update(json.dumps(params, sort_keys=True).encode('utf8'))
+    h.update(_read_file(config.odor_path))
+    for method, block_odors in zip(config.odor_method, config.odor_selection):
+        if method == 'list':
+            for fname in block_odors:
+                h.update(_read_file(fname.strip()))
+    return h.hexdigest()
+
+
+def schedule_seed(key):
+    '''Returns the seed used to generate the random odors of the schedule
+    whose key is ``key``, as returned by :func:`compute_schedule_key`.
+    '''
+    return int(key[:8], 16)
+
+
+def schedule_filename(path, animal_id):
+    '''Returns the filename under the directory ``path`` of the file holding
+    the schedules of the animal.
+
+    Any characters of ``animal_id`` other than letters, digits, ``_``, ``.``,
+    and ``-`` are replaced with ``_``, so it cannot name a file outside
+    ``path``. Animals whose ids map to the same file share it, which is fine
+    because the animal id is part of the schedule keys.
+    '''
+    name = _unsafe_filename_pat.sub('_', animal_id or '')
+    if not name.strip('.'):
+        name = '_' + name
+    return join(path, '{}.json'.format(name))
+
+
+def _tuple_odors(odors):
+    '''Converts the odors loaded from json back into the tuples returned by
+    :func:`~forced_choice.stages.extract_odor`.
+    '''
+    if odors is None:
+        return None
+    return tuple(tuple(odor) for odor in odors)
+
+
+def _read_schedules(filename):
+    '''Returns the dict of all the schedules stored in the file, or an empty
+    dict if it doesn't exist or is from another :attr:`schedule_version`.
+    '''
+    if not isfile(filename):
+        return {}
+
+    with open(filename, 'r') as fh:
+        data = json.load(fh)
+    if data.get('schedule_version') != schedule_version:
+        return {}
+    return data['schedules']
+
+
+def load_schedule(filename, key):
+    '''Loads the schedule whose key is ``key`` from the file saved with
+    :func:`save_schedules`.
+
+    :returns:
+
+        A 2-tuple of ``(trial_odors, odor_opts)`` as in
+        :attr:`~forced_choice.stages.ExperimentConfig.trial_odors` and
+        :attr:`~forced_choice.stages.ExperimentConfig.odor_opts`, or None if
+        the schedule is not in the file.
+    '''
+    schedule = _read_schedules(filename).get(key)
+    if schedule is None:
+        return None
+
+    trial_odors = [[_tuple_odors(o) for o in block]
+                   for block in schedule['trial_odors']]
+    odor_opts = [[_tuple_odors(o) for o in block]
+                 for block in schedule['odor_opts']]
+    return trial_odors, odor_opts
+
+
+def save_schedules(filename, schedules):
+    '''Adds the schedules to the file so they can be loaded with
+    :func:`load_schedule`. The directory is created if needed.
+
+    ``schedules`` is a dict whose keys are schedule keys and whose values are
+    2-tuples of ``(trial_odors, odor_opts)``.
+    '''
+    path = dirname(filename)
+    if path and not isdir(path):
+        makedirs(path)
+
+    data = _read_schedules(filename)
+    for key, (trial_odors, odor_opts) in schedules.items():
+        data[key] = {'trial_odors': trial_odors, 'odor_opts': odor_opts}
+
+    # write to a temp file first so a partially written file is never read
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as fh:
+        json.dump({'schedule_version': schedule_version, 'schedules': data},
+                  fh, separators=(',', ':'))
+    if isfile(filename):
+        remove(filename)
+    rename(tmp, filename)
@@ -0,0 +1,124 @@
+'''Session
+==========
+
+A binary session file format storing the trial results as typed columns,
+alongside the csv trial log.
+
+The file starts with a short text header describing the numpy dtype of the
+records, followed by one fixed size record for each trial. Records are simply
+appended as trials finish, and the file can be read back with
+:func:`read_session` as a memory mapped numpy structured array without parsing
+anything, e.g.::
+
+    >>> trials = read_session('rat1_session.fcs')
+    >>> trials['ttnp'][trials['outcome'] == 1].mean()
+
+Missing values are stored as ``-1`` for the integer columns, an empty string
+for the side columns, and ``nan`` for the float columns.
+'''
+
+import json
+
+import numpy as np
+
+__all__ = ('session_dtype', 'session_header', 'session_record',
+           'read_session')
+
+session_magic = b'FCSESSION\n'
+'''The first line of every session file.
+'''
+
+session_version = 2
+'''The version of the session file format. Version 2 added the
+``sound_latency`` column. Files of all the versions in
+:attr:`session_versions` can be read.
+'''
+
+session_versions = (1, 2)
+'''The versions of the session file format that :func:`read_session` can
+read.
+'''
+
+session_dtype = np.dtype([
+    ('block', '<i4'), ('trial', '<i4'), ('odor', '<i2'), ('side', 'S2'),
+    ('side_went', 'S2'), ('outcome', 'i1'), ('rewarded', 'i1'),
+    ('ttnp', '<f8'), ('tinp', '<f8'), ('ttrp', '<f8'), ('iti', '<f8'),
+    ('sound_latency', '<f8')])
+'''The numpy dtype of a trial record. The columns are:
+
+    `block`, `trial`: The zero-based block and trial numbers.
+    `odor`: The valve index of the trial odor, or -1 if there was no odor.
+    `side`, `side_went`: The side rewarded for the odor and the side the
+        animal went to, e.g. ``b'rl'`` or ``b'l'``.
+    `outcome`: 0 for fail, 1 for pass, and 2 for incomplete.
+    `rewarded`: 1 if the animal was rewarded, otherwise 0.
+    `ttnp`, `tinp`, `ttrp`, `iti`: The trial durations as in the csv log.
+    `sound_latency`: The onset latency of the sound cue, as in the csv log.
+'''
+
+_header_align = 64
+
+
+def session_header(dtype=session_dtype):
+    '''Returns the header bytes written at the start of a session file.
+
+    The header is padded with spaces so that its size is a multiple of 64
+    bytes.
+    '''
+    desc = json.dumps({'version': session_version, 'dtype': dtype.descr})
+    header = session_magic + desc.encode('utf8')
+    n = len(header) + 1
+    header += b' ' * (-n % _header_align) + b'\n'
+    return header
+
+
+def _encode_side(side):
+    return side.encode('utf8') if side else b''
+
+
+def session_record(block, trial, odor, side, side_went, outcome, rewarded,
+                   ttnp, tinp, ttrp, iti, sound_latency=None):
+    '''Returns the bytes of the record of a trial, to be appended to the
+    session file. The parameters are the :attr:`session_dtype` columns, any of
+    which can be None when missing, except ``block`` and ``trial``.
+    '''
+    rec = np.empty(1, dtype=session_dtype)
+    rec['block'] = block
+    rec['trial'] = trial
+    rec['odor'] = -1 if odor is None else odor
+    rec['side'] = _encode_side(side)
+    rec['side_went'] = _encode_side(side_went)
+    rec['outcome'] = -1 if outcome is None else outcome
+    rec['rewarded'] = -1 if rewarded is None else int(bool(rewarded))
+    for name, val in (('ttnp', ttnp), ('tinp', tinp), ('ttrp', ttrp),
+                      ('iti', iti), ('sound_latency', sound_latency)):
+        rec[name] = np.nan if val is None else val
+    return rec.tobytes()
+
+
+def read_session(filename, mode='r'):
+    '''Returns a numpy memory map of the records of the session file as a
+    structured array of :attr:`session_dtype`.
+
+    A partially written last record, e.g. if the experiment crashed, is
+    ignored. The columns are those of the file's version, e.g. version 1
+    files don't have the ``sound_latency`` column.
+    '''
+    with open(filename, 'rb') as fh:
+        if fh.readline() != session_magic:
+            raise ValueError('"{}" is not a session file'.format(filename))
+        desc = json.loads(fh.readline().decode('utf8'))
+        offset = fh.tell()
+        fh.seek(0, 2)
+        size = fh.tell()
+
+    if desc['version'] not in session_versions:
+        raise ValueError('Session file "{}" version {} is not supported'.
+                         format(filename, desc['version']))
+
+    dtype = np.dtype([tuple(field) for field in desc['dtype']])
+    n = (size - offset) // dtype.itemsize
+    if not n:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode=mode, offset=offset,
+                     shape=(n, ))
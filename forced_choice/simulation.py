@@ -0,0 +1,441 @@
+'''Simulation
+=============
+
+Runs the experiment in simulation mode without a window, against a virtual
+clock.
+
+The :class:`HeadlessExperiment` builds the app and its widgets without
+displaying them, and runs the same
+:class:`~forced_choice.stages.RootStage` and
+:class:`~forced_choice.stages.AnimalStage` stage tree, with the simulated
+devices, as a normal session. The kivy ``Clock`` and the
+:attr:`~forced_choice.timing.session_clock` are driven by a
+:class:`VirtualClock`, which instead of waiting for the next scheduled clock
+event jumps straight to its time. So e.g. the ``Delay`` stages and the ITIs
+take no real time, and a long session is simulated in seconds while writing
+the same log files as a real session.
+
+The simulated nose and reward port beams are driven by the
+:class:`~forced_choice.agents.Agent` instances in
+:attr:`HeadlessExperiment.agents`. Without agents, a trial that waits for the
+animal never finishes, which is detected with
+:attr:`HeadlessExperiment.idle_timeout`.
+
+For example, to simulate two animals using the ``default`` experiment of the
+json config file, and agents whose
+:class:`~forced_choice.agents.BehaviorModel` options are in ``model.json``,
+in parallel processes::
+
+    forced_choice_simulate config.json -a rat1 rat2 -m model.json
+'''
+
+import os
+# don't let kivy parse the command line of the script, and don't create a
+# window or require an OpenGL context
+os.environ['KIVY_NO_ARGS'] = '1'
+os.environ.setdefault('KIVY_WINDOW', '')
+os.environ.setdefault('KIVY_GL_BACKEND', 'mock')
+
+import json
+import argparse
+from time import time
+
+from kivy.clock import Clock
+from kivy.logger import Logger
+from kivy.uix.behaviors.knspace import knspace
+
+from forced_choice.timing import session_clock
+from forced_choice.main import ForcedChoiceApp
+from forced_choice.lifecycle import release_warm_devices
+
+__all__ = ('VirtualClock', 'SimulationError', 'HeadlessExperiment',
+           'run_simulation')
+
+_no_event = 1e300
+'''Clock timeouts larger than this mean that no event is scheduled.
+'''
+
+
+class SimulationError(Exception):
+    '''Raised when the simulation cannot continue.
+    '''
+    pass
+
+
+class VirtualClock(object):
+    '''A virtual time source for the kivy ``Clock`` and the
+    :attr:`~forced_choice.timing.session_clock`, that is advanced with
+    :meth:`step` from one scheduled clock event to the next.
+    '''
+
+    time = 0.
+    '''The current virtual time, in seconds.
+    '''
+
+    frame_time = 1 / 60.
+    '''The duration, in seconds, of a frame. When the next clock event is
+    scheduled for the next frame rather than for a specific time, the time is
+    advanced by this much.
+    '''
+
+    installed = False
+    '''Whether the clock is currently installed, see :meth:`install`.
+    '''
+
+    _max_fps = 0
+
+    def __init__(self, frame_time=1 / 60.):
+        self.frame_time = frame_time
+
+    def get_time(self):
+        '''Returns the current virtual time in seconds.
+        '''
+        return self.time
+
+    def get_time_ns(self):
+        '''Returns the current virtual time in nanoseconds.
+        '''
+        return int(round(self.time * 1e9))
+
+    def install(self):
+        '''Makes the kivy ``Clock`` and the
+        :attr:`~forced_choice.timing.session_clock` use the virtual time. The
+        virtual time starts from the current time of the ``Clock``.
+        '''
+        if self.installed:
+            return
+        self.time = Clock.time()
+        self._max_fps = Clock._max_fps
+        Clock.time = self.get_time
+        # never sleep waiting for the next frame
+        Clock._max_fps = 0
+        session_clock.clock_ns = self.get_time_ns
+        self.installed = True
+
+    def uninstall(self):
+        '''Restores the real time of the kivy ``Clock`` and the
+        :attr:`~forced_choice.timing.session_clock`.
+        '''
+        if not self.installed:
+            return
+        del Clock.time
+        Clock._max_fps = self._max_fps
+        del session_clock.clock_ns
+        self.installed = False
+
+    def step(self):
+        '''Advances the time to the next scheduled clock event, or by
+        :attr:`frame_time` if it's scheduled for the next frame, and processes
+        all the events that are due.
+
+        :returns:
+
+            The new time, or None if no event is scheduled, in which case the
+            time is not advanced.
+        '''
+        deadline = Clock.get_min_timeout()
+        if deadline >= _no_event:
+            return None
+
+        if deadline > self.time:
+            self.time = deadline
+        else:
+            self.time += self.frame_time
+        Clock.tick()
+        Clock.tick_draw()
+        return self.time
+
+
+class HeadlessExperiment(object):
+    '''Runs a simulated experiment session of one or more animals without a
+    window, using a :class:`VirtualClock`.
+
+    :meth:`run` starts the experiment with the simulated devices. Whenever
+    the experiment waits for the next animal, the next animal of
+    :attr:`animal_ids` is started, and once all the animals are done, the
+    experiment is stopped.
+
+    With :attr:`realtime`, the experiment runs in real time rather than
+    against the virtual clock, and with :attr:`simulate` False, with the
+    actual devices. This is how the :mod:`forced_choice.supervisor` runs
+    each rig in its own process.
+    '''
+
+    json_config_path = ''
+    '''The json config file of the experiment.
+    '''
+
+    animal_ids = []
+    '''The ids of the animals to simulate, in order.
+    '''
+
+    experiment = 'default'
+    '''The name of the experiment, in the json config file, to run.
+    '''
+
+    max_duration = None
+    '''The maximum virtual duration, in seconds, of the session. When
+    reached, the experiment is stopped. If None, there's no limit.
+    '''
+
+    idle_timeout = 3600.
+    '''The maximum virtual duration, in seconds, without a new trial or
+    animal starting. When reached, the session is considered stuck and a
+    :class:`SimulationError` is raised. If None, there's no limit.
+    '''
+
+    realtime = False
+    '''Whether the kivy ``Clock`` runs in real time. If False, the
+    :attr:`clock` is used.
+    '''
+
+    simulate = True
+    '''Whether to use the simulated devices rather than the actual devices.
+    '''
+
+    rig_name = ''
+    '''The name of the :class:`~forced_choice.rig.Rig` run by the app. If
+    empty, the default name is used.
+    '''
+
+    rig_settings = {}
+    '''The settings sections overriding the app settings for the rig, as in
+    :attr:`forced_choice.rig.Rig.settings`.
+    '''
+
+    agents = []
+    '''The list of :class:`~forced_choice.agents.Agent` instances driving the
+    simulated input devices. They are attached when the experiment starts and
+    detached when it's done.
+    '''
+
+    clock = None
+    '''The :class:`VirtualClock`, unless :attr:`realtime`.
+    '''
+
+    app = None
+    '''The :class:`~forced_choice.main.ForcedChoiceApp` created by
+    :meth:`run`.
+    '''
+
+    animals_started = 0
+    '''The number of animals of :attr:`animal_ids` started so far.
+    '''
+
+    trials = 0
+    '''The number of trials run so far.
+    '''
+
+    _stopping = False
+
+    _last_activity = 0.
+
+    def __init__(self, json_config_path, animal_ids, experiment='default',
+                 max_duration=None, idle_timeout=3600., frame_time=1 / 60.,
+                 agents=(), realtime=False, simulate=True, rig_name='',
+                 rig_settings=None):
+        self.json_config_path = json_config_path
+        self.animal_ids = list(animal_ids)
+        self.experiment = experiment
+        self.agents = list(agents)
+        self.max_duration = max_duration
+        self.idle_timeout = idle_timeout
+        self.realtime = realtime
+        self.simulate = simulate
+        self.rig_name = rig_name
+        self.rig_settings = rig_settings or {}
+        if not realtime:
+            self.clock = VirtualClock(frame_time=frame_time)
+
+    def build_app(self):
+        '''Creates the app and builds its widgets, like ``App.run`` does,
+        except that no window is created and the kivy event loop is not
+        started.
+        '''
+        app = self.app = ForcedChoiceApp()
+        app.load_config()
+        app.json_config_path = self.json_config_path
+        # the app runs a single rig, whose settings are given
+        app.rigs_path = ''
+        app.load_kv(filename=app.kv_file)
+        root = app.build()
+        if root:
+            app.root = root
+        app.dispatch('on_start')
+
+        rig = app.rigs[0]
+        if self.rig_name:
+            rig.name = self.rig_name
+        rig.settings = self.rig_settings
+        return app
+
+    def run(self):
+        '''Runs the whole session and returns once the experiment is done.
+
+        :returns:
+
+            The virtual duration of the session, in seconds.
+        '''
+        clock = self.clock
+        if clock is not None:
+            clock.install()
+        try:
+            app = self.build_app()
+            knspace.gui_simulate.state = 'down' if self.simulate else 'normal'
+            knspace.gui_trial_type.text = self.experiment
+            app.start_stage()
+
+            root = knspace.exp_root
+            if root is None:
+                raise SimulationError('The experiment did not start')
+            for agent in self.agents:
+                agent.attach()
+            knspace.exp_animal_wait.fbind('on_stage_start', self._wait_animal)
+            knspace.exp_trial.fbind('on_trial_start', self._count_trial)
+            if knspace.exp_animal_wait.started and \
+                    not knspace.exp_animal_wait.finished:
+                self._wait_animal()
+
+            start = self._last_activity = Clock.time()
+            max_duration, idle_timeout = self.max_duration, self.idle_timeout
+            while not root.finished:
+                t = self.step()
+                if t is None or idle_timeout is not None and \
+                        not self._stopping and \
+                        t - self._last_activity >= idle_timeout:
+                    raise SimulationError(
+                        'The experiment is stuck waiting after {} trials'.
+                        format(self.trials))
+                if max_duration is not None and t - start >= max_duration:
+                    self.stop()
+
+            duration = Clock.time() - start
+            self.release_devices()
+            app.dispatch('on_stop')
+            return duration
+        finally:
+            for agent in self.agents:
+                agent.detach()
+            if clock is not None:
+                clock.uninstall()
+
+    def release_devices(self):
+        '''Releases the devices kept open with
+        :attr:`~forced_choice.stages.RootStage.keep_devices_warm`, stepping
+        the clock until they are released, like
+        :meth:`~forced_choice.main.ForcedChoiceApp.stop` does.
+        '''
+        done = []
+        release_warm_devices(callback=lambda: done.append(True))
+        while not done and self.step() is not None:
+            pass
+
+    def step(self):
+        '''Processes the clock events of the next frame, advancing the
+        :attr:`clock` unless :attr:`realtime`, in which case the kivy
+        ``Clock`` waits for the next frame.
+
+        :returns:
+
+            The current clock time, or None if no event is scheduled.
+        '''
+        if self.clock is not None:
+            return self.clock.step()
+        Clock.tick()
+        Clock.tick_draw()
+        return Clock.time()
+
+    def stop(self):
+        '''Stops the experiment.
+        '''
+        if not self._stopping:
+            self._stopping = True
+            self.app.stop_experiment()
+
+    def _count_trial(self, *largs):
+        self.trials += 1
+        self._last_activity = Clock.time()
+
+    def _wait_animal(self, *largs):
+        # press the button in the next frame so the stage is waiting for it
+        Clock.schedule_once(self._next_animal, 0)
+
+    def _next_animal(self, *largs):
+        if self.animals_started >= len(self.animal_ids):
+            self.stop()
+            return
+
+        knspace.gui_trial_type.text = self.experiment
+        knspace.gui_animal_id.text = self.animal_ids[self.animals_started]
+        self.animals_started += 1
+        self._last_activity = Clock.time()
+
+        button = knspace.gui_next_animal
+        button.state = 'down'
+        Clock.schedule_once(lambda dt: setattr(button, 'state', 'normal'), 0)
+
+
+def run_simulation(args=None):
+    '''The entry point of the ``forced_choice_simulate`` script that runs a
+    :class:`HeadlessExperiment`, or when a behavior model is given, runs the
+    animals with :func:`~forced_choice.agents.simulate_agents`.
+    '''
+    parser = argparse.ArgumentParser(
+        description='Simulates the experiment without a window.')
+    parser.add_argument(
+        'config', help='The json config file of the experiment.')
+    parser.add_argument(
+        '-a', '--animals', nargs='+', required=True,
+        help='The ids of the animals to simulate.')
+    parser.add_argument(
+        '-e', '--experiment', default='default',
+        help='The name of the experiment in the config.')
+    parser.add_argument(
+        '-d', '--max-duration', type=float, default=None,
+        help='The maximum simulated duration of the session, in seconds.')
+    parser.add_argument(
+        '-i', '--idle-timeout', type=float, default=3600.,
+        help='The maximum simulated duration without a new trial before the '
+        'session is considered stuck, in seconds.')
+    parser.add_argument(
+        '-f', '--frame-time', type=float, default=1 / 60.,
+        help='The simulated duration of a frame, in seconds.')
+    parser.add_argument(
+        '-m', '--model', default=None,
+        help='A json file with the agent behavior model options. If '
+        'provided, each animal is simulated by an agent in its own process.')
+    parser.add_argument(
+        '-s', '--seed', type=int, default=None,
+        help='The seed of the first agent, incremented for each animal.')
+    parser.add_argument(
+        '-j', '--processes', type=int, default=None,
+        help='The number of agent processes. Defaults to the number of cpus.')
+    args = parser.parse_args(args)
+
+    config = os.path.abspath(args.config)
+    opts = {'max_duration': args.max_duration,
+            'idle_timeout': args.idle_timeout, 'frame_time': args.frame_time}
+    ts = time()
+    if args.model is None:
+        sim = HeadlessExperiment(config, args.animals, args.experiment, **opts)
+        duration = sim.run()
+        Logger.info(
+            'Simulation: Simulated {} trials of {} animals, {:.1f}s in '
+            '{:.2f}s'.format(sim.trials, sim.animals_started, duration,
+                             time() - ts))
+        return
+
+    from forced_choice.agents import simulate_agents
+    with open(args.model, 'r') as fh:
+        model = json.load(fh)
+    for res in simulate_agents(
+            config, args.animals, model, args.seed, args.experiment,
+            args.processes, **opts):
+        Logger.info(
+            'Simulation: Simulated {trials} trials of {animal_id}, '
+            '{duration:.1f}s'.format(**res))
+    Logger.info('Simulation: Done in {:.2f}s'.format(time() - ts))
+
+
+if __name__ == '__main__':
+    run_simulation()
@@ -0,0 +1,151 @@
+'''Spans
+========
+
+Measures the latency of each hop of the trial's hot path, from the nose port
+beam break until the odor valve command.
+
+When the animal enters the nose port, the ``nose_beam`` input goes high,
+which completes the nose poke wait stage, which calls
+:meth:`~forced_choice.stages.AnimalStage.do_nose_poke`, after which the odor
+delay stage starts. When the delay is done,
+:meth:`~forced_choice.stages.AnimalStage.do_odor_release` queues the valve
+change, which the odor device writes on the next clock iteration. Each of
+these steps marks its time in the :class:`SpanRecorder` of the rig, and the
+durations between the marks, the hops of :attr:`hot_path_hops`, are added to
+histograms allocated when the recorder is created.
+
+The hops are:
+
+    `gate`: From the beam edge until the nose poke stage callback, the stage
+        machinery of the wait stage.
+    `delay_start`: From the nose poke stage callback until the odor delay
+        stage started.
+    `delay_late`: From when the odor delay was due to end until the odor
+        release callback, the kivy ``Clock`` scheduling lateness.
+    `valve_queue`: From the odor release callback until the queued valve
+        change is written.
+    `valve_write`: The duration of the odor device's ``set_state`` call.
+
+The recorder is only created when
+:attr:`~forced_choice.stages.RootStage.record_latency_spans` is True.
+Otherwise, each instrumented call only checks that there's no recorder.
+'''
+
+import json
+
+from forced_choice.timing import session_clock
+from forced_choice.stats import Histogram
+
+__all__ = ('hot_path_hops', 'SpanRecorder')
+
+hot_path_hops = (
+    ('gate', 'nose_beam', 'nose_poke'),
+    ('delay_start', 'nose_poke', 'odor_delay_start'),
+    ('delay_late', 'odor_delay_due', 'odor_release'),
+    ('valve_queue', 'odor_release', 'valve_write'),
+    ('valve_write', 'valve_write', 'valve_written'))
+'''The ``(name, start, end)`` tuples of the hops of the trial's hot path,
+where ``start`` and ``end`` are the names of the marks between which the hop
+is measured.
+'''
+
+
+class SpanRecorder(object):
+    '''Records the time of named marks during a trial, and adds the duration
+    of each hop between two marks to the hop's histogram when the trial is
+    done.
+
+    Only the first time a mark is hit after :meth:`reset` is recorded, and
+    hops with a missing mark, e.g. if the nose port beam was already broken
+    when the trial started, are skipped for the trial.
+    '''
+
+    hops = ()
+    '''The ``(name, start, end)`` tuples of the hops, see
+    :attr:`hot_path_hops`.
+    '''
+
+    marks = []
+    '''The names of all the marks of the :attr:`hops`.
+    '''
+
+    times = []
+    '''The time of each of the :attr:`marks` in the current trial, in the
+    :attr:`~forced_choice.timing.session_clock` time, or None if it wasn't
+    hit yet.
+    '''
+
+    histograms = {}
+    '''A dict mapping the name of each hop to the
+    :class:`~forced_choice.stats.Histogram` of its durations, in seconds.
+    Negative durations, e.g. if the clock fired the delay early, are counted
+    in the underflow bin.
+    '''
+
+    _index = {}
+
+    _hops = []
+
+    _hist_list = []
+
+    def __init__(self, hops=hot_path_hops, high=.1, n_bins=1000):
+        self.hops = hops
+        marks = self.marks = []
+        for _, start, end in hops:
+            for mark in (start, end):
+                if mark not in marks:
+                    marks.append(mark)
+        self._index = {mark: i for i, mark in enumerate(marks)}
+        self._hops = [
+            (self._index[start], self._index[end]) for _, start, end in hops]
+        self.times = [None] * len(marks)
+        self.histograms = {
+            name: Histogram(0, high, n_bins) for name, _, _ in hops}
+        self._hist_list = [self.histograms[name] for name, _, _ in hops]
+
+    def mark(self, name, t=None):
+        '''Records the time ``t``, or the current time if None, of the mark
+        ``name``, unless it was already recorded since the last
+        :meth:`reset`.
+        '''
+        i = self._index[name]
+        if self.times[i] is None:
+            self.times[i] = session_clock.now() if t is None else t
+
+    def reset(self):
+        '''Clears the marks, e.g. when the trial starts.
+        '''
+        times = self.times
+        for i in range(len(times)):
+            times[i] = None
+
+    def commit(self):
+        '''Adds the duration of each hop whose marks were recorded to its
+        histogram, and then :meth:`reset`-s the marks.
+        '''
+        times = self.times
+        for (start, end), hist in zip(self._hops, self._hist_list):
+            t0, t1 = times[start], times[end]
+            if t0 is not None and t1 is not None:
+                hist.add(t1 - t0)
+        self.reset()
+
+    def to_dict(self):
+        '''Returns a json serializable dict mapping the name of each hop to
+        its :meth:`~forced_choice.stats.Histogram.to_dict`.
+        '''
+        return {name: self.histograms[name].to_dict()
+                for name, _, _ in self.hops}
+
+    def to_json(self):
+        '''Returns the :meth:`to_dict` as a json line.
+        '''
+        return json.dumps(self.to_dict()) + '\n'
+
+    def format_summary(self):
+        '''Returns a summary of all the hops, one line per hop, e.g. for
+        logging.
+        '''
+        return '\n'.join(
+            '{}: {}'.format(name, self.histograms[name].format_summary())
+            for name, _, _ in self.hops)
@@ -7,13 +7,13 @@ The stages of the experiment.
 
 from functools import partial
 import traceback
-from time import clock, strftime
+from time import strftime, localtime
 from re import match, compile
 from os.path import join, isfile
 from math import ceil
 import csv
-from random import choice, randint, random, shuffle, uniform
-from collections import defaultdict
+import json
+from random import random, uniform
 import numpy as np
 
 from moa.stage import MoaStage
@@ -23,24 +23,32 @@ from moa.utils import to_bool
 from moa.compat import unicode_type
 from moa.device.analog import NumericPropertyChannel
 from moa.device.digital import ButtonChannel
-from moa.utils import ObjectStateTracker
 
 from kivy.properties import (
     ObjectProperty, ListProperty, ConfigParserProperty, NumericProperty,
     BooleanProperty, StringProperty, OptionProperty, DictProperty)
 from kivy.clock import Clock
+from kivy.logger import Logger
 from kivy.factory import Factory
-from kivy.uix.behaviors.knspace import knspace, KNSpaceBehavior
 from kivy import resources
 
+from forced_choice.timing import session_clock
+from forced_choice.stats import TrialStats, Histogram
+from forced_choice.writer import TrialLogWriter
+from forced_choice.session import session_header, session_record
+from forced_choice.events import EdgeRecorder
+from forced_choice.spans import SpanRecorder
+from forced_choice.rig import acquire_server, release_server
+from forced_choice.lifecycle import (
+    DeviceGraph, WarmDevices, park_devices, take_warm_devices)
+from forced_choice.schedule import (
+    compute_schedule_key, schedule_seed, schedule_filename, load_schedule,
+    save_schedules)
 from forced_choice.devices import (
-    FTDIOdors, FTDIOdorsSim, DAQInDevice, DAQInDeviceSim, DAQOutDevice,
-    DAQOutDeviceSim)
+    FTDIOdorsSim, DAQInDeviceSim, DAQOutDeviceSim, get_hardware_config_classes)
 
-from cplcom.moa.device.barst_server import Server
-from cplcom.moa.device.ftdi import FTDIDevChannel
-from cplcom.moa.device.mfc import MFC
-from cplcom.moa.device.ffplayer import FFPyPlayerAudioDevice
+# the hardware backends, e.g. cplcom.moa.device.mfc and
+# forced_choice.hardware, are imported when the devices are created
 from cplcom.moa.app import app_error
 from cplcom.moa.stages import ConfigStageBase
 
@@ -134,16 +142,32 @@ def select_odor(odors):
 class RootStage(ConfigStageBase):
     '''The stage that creates and initializes all the Barst devices (or
     simulation devices if :attr:`ExperimentApp.simulate`).
+
+    Each rig runs its own root stage. The stages, devices, and GUI widgets of
+    a rig are named in the rig's :attr:`knspace`, which is the global
+    ``knspace`` for the default rig, and the Barst server is shared by all the
+    rigs. See :mod:`forced_choice.rig`.
     '''
 
     __settings_attrs__ = ('n_valve_boards', 'use_mfc', 'use_mfc_air',
                           'sound_file_r', 'sound_file_l', 'log_filename',
-                          'filter_len')
+                          'filter_len', 'schedule_path', 'log_flush_interval',
+                          'log_fsync', 'session_filename', 'events_filename',
+                          'valve_widgets', 'activation_timeout',
+                          'deactivation_timeout', 'keep_devices_warm',
+                          'sound_engine', 'sound_sink', 'sound_sink_file',
+                          'sound_latency_filename', 'max_sound_latency',
+                          'record_latency_spans', 'latency_spans_filename')
+
+    _device_attrs = ('server', 'ftdi_chan', 'odor_dev', 'daq_out_dev',
+                     'daq_in_dev', 'mfc_air', 'mfc_a', 'mfc_b', 'sound_l',
+                     'sound_r')
 
     server = ObjectProperty(None, allownone=True)
     '''The Barst server instance,
     :class:`~cplcom.moa.device.barst_server.Server`, or None when
-    :attr:`simulate`.
+    :attr:`simulate`. It's shared with the other rigs using the same server
+    settings, see :func:`~forced_choice.rig.acquire_server`.
     '''
 
     ftdi_chan = ObjectProperty(None, allownone=True)
@@ -174,7 +198,7 @@ class RootStage(ConfigStageBase):
     '''
 
     odor_dev = ObjectProperty(None, allownone=True)
-    '''The FTDI valve board, :class:`~forced_choice.devices.FTDIOdors`
+    '''The FTDI valve board, :class:`~forced_choice.hardware.FTDIOdors`
     when using actual hardware, or a
     :class:`~forced_choice.devices.FTDIOdorsSim` when :attr:`simulate` the
     hardware.
@@ -185,8 +209,22 @@ class RootStage(ConfigStageBase):
     8 valves.
     '''
 
+    valve_widgets = BooleanProperty(True)
+    '''Whether to show a GUI widget for each valve, which is updated whenever
+    the valve changes. With large valve arrays, this can be False so that
+    only the :attr:`odor_dev` state is updated when valves change. The
+    widgets are always shown when :attr:`simulate`.
+    '''
+
+    odor_widgets = {}
+    '''A dict mapping the names of the valves, e.g. ``p3``, to their GUI
+    widgets. It's empty when the widgets are not shown, see
+    :attr:`valve_widgets`.
+    '''
+
     daq_in_dev = ObjectProperty(None, allownone=True)
-    '''The Switch and Sense device, :class:`~forced_choice.devices.DAQInDevice`
+    '''The Switch and Sense device,
+    :class:`~forced_choice.hardware.DAQInDevice`
     when using actual hardware, or a
     :class:`~forced_choice.devices.DAQInDeviceSim` when :attr:`simulate` the
     hardware.
@@ -194,7 +232,7 @@ class RootStage(ConfigStageBase):
 
     daq_out_dev = ObjectProperty(None, allownone=True)
     '''The Switch and Sense device,
-    :class:`~forced_choice.devices.DAQOutDevice`
+    :class:`~forced_choice.hardware.DAQOutDevice`
     when using actual hardware, or a
     :class:`~forced_choice.devices.DAQOutDeviceSim` when :attr:`simulate` the
     hardware.
@@ -221,13 +259,82 @@ class RootStage(ConfigStageBase):
     '''
 
     sound_r = ObjectProperty(None, allownone=True, rebind=True)
-    '''The :class:`cplcom.moa.device.ffplayer.FFPyPlayerAudioDevice`
-    that plays the file provided in :attr:`sound_file_r`.
+    '''The :class:`cplcom.moa.device.ffplayer.FFPyPlayerAudioDevice`, or
+    the :class:`~forced_choice.audio.AudioCueDevice` when
+    :attr:`sound_engine` is ``'memory'``, that plays the file provided in
+    :attr:`sound_file_r`.
     '''
 
     sound_l = ObjectProperty(None, allownone=True, rebind=True)
-    '''The :class:`cplcom.moa.device.ffplayer.FFPyPlayerAudioDevice`
-    that plays the file provided in :attr:`sound_file_l`.
+    '''The :class:`cplcom.moa.device.ffplayer.FFPyPlayerAudioDevice`, or
+    the :class:`~forced_choice.audio.AudioCueDevice` when
+    :attr:`sound_engine` is ``'memory'``, that plays the file provided in
+    :attr:`sound_file_l`.
+    '''
+
+    sound_engine = OptionProperty('ffplayer', options=['ffplayer', 'memory'])
+    '''How the sound cues are played. With ``'ffplayer'``, each cue is played
+    by a ffpyplayer media player. With ``'memory'``, the cues are decoded
+    once by the :attr:`cue_engine` and played from memory with a low onset
+    latency, in which case :attr:`sound_file_r` and :attr:`sound_file_l` can
+    be wav files or ``tone:<frequency>:<duration>`` tones. See
+    :mod:`forced_choice.audio`.
+    '''
+
+    sound_sink = OptionProperty('device', options=['device', 'null', 'file'])
+    '''When :attr:`sound_engine` is ``'memory'``, where the cues are played.
+    ``'device'`` plays them on the sound card, ``'null'`` discards them, and
+    ``'file'`` writes them to :attr:`sound_sink_file`, e.g. for testing.
+    '''
+
+    sound_sink_file = StringProperty('cues.wav')
+    '''The wav file to which the cues are written when :attr:`sound_sink` is
+    ``'file'``.
+    '''
+
+    cue_engine = None
+    '''The :class:`~forced_choice.audio.CueEngine` playing the sound cues
+    when :attr:`sound_engine` is ``'memory'``.
+    '''
+
+    sound_latency_hist = None
+    '''The :class:`~forced_choice.stats.Histogram` of the onset latency, in
+    seconds, of the sound cues played during the session, from the time the
+    cue was requested until its first sample was output.
+
+    The latency of each trial is also logged in the trial log. It's only
+    measured when :attr:`sound_engine` is ``'memory'``, because the
+    ffpyplayer audio device doesn't report when the sound started.
+    '''
+
+    sound_latency_filename = StringProperty('')
+    '''The pattern, passed to `strftime` with the experiment start time, used
+    to generate the filename of the json file to which the
+    :attr:`sound_latency_hist` is written when the experiment stops. If
+    empty, it's only summarized in the log.
+    '''
+
+    max_sound_latency = NumericProperty(.02)
+    '''The sound cue onset latency, in seconds, above which a warning is
+    logged for the trial. If zero, no warning is logged.
+    '''
+
+    record_latency_spans = BooleanProperty(False)
+    '''Whether to measure the latency of each hop of the trial's hot path,
+    from the nose port beam break until the odor valve write, into
+    :attr:`latency_spans`. See :mod:`forced_choice.spans`.
+    '''
+
+    latency_spans = None
+    '''The :class:`~forced_choice.spans.SpanRecorder` of the session when
+    :attr:`record_latency_spans`, otherwise None.
+    '''
+
+    latency_spans_filename = StringProperty('')
+    '''The pattern, passed to `strftime` with the experiment start time, used
+    to generate the filename of the json file to which the histograms of the
+    :attr:`latency_spans` are written when the experiment stops. If empty,
+    they are only summarized in the log.
     '''
 
     configs = DictProperty({})
@@ -243,11 +350,38 @@ class RootStage(ConfigStageBase):
     '''
 
     tracker = None
-    '''The :class:`~moa.utils.ObjectStateTracker` instance used to
-    process the device activation and deactivation during startup and
-    shutdown.
+    '''The :class:`~forced_choice.lifecycle.DeviceGraph` of the devices, used
+    to activate and deactivate them during startup and shutdown. Devices
+    that don't depend on each other are activated and deactivated
+    concurrently, and the time each took is logged.
+    '''
+
+    activation_timeout = NumericProperty(30.)
+    '''The duration, in seconds, within which all the devices must be active
+    at startup, otherwise the experiment fails. If zero, there's no deadline.
+    '''
+
+    deactivation_timeout = NumericProperty(10.)
+    '''The duration, in seconds, within which all the devices must be inactive
+    at shutdown, after which the shutdown continues without waiting for the
+    remaining devices. If zero, there's no deadline.
     '''
 
+    keep_devices_warm = BooleanProperty(False)
+    '''Whether to keep the devices open when the experiment stops, so that
+    the next experiment of the rig reuses them rather than creating and
+    activating them again.
+
+    When the experiment stops, the valves, the daq outputs, and the sounds
+    are turned off, and the still active devices are parked with
+    :func:`~forced_choice.lifecycle.park_devices`. They are only reused if
+    the device settings and :attr:`simulate` didn't change, otherwise they
+    are deactivated before the new devices are created. See
+    :mod:`forced_choice.lifecycle`.
+    '''
+
+    _owner = None
+
     log_filename = StringProperty('{animal}_%m-%d-%Y_%I-%M-%S_%p.csv')
     '''The pattern that will be used to generate the log filenames for each
     trial. It is generated as follows::
@@ -262,24 +396,83 @@ class RootStage(ConfigStageBase):
     log name used for that animal.
 
     If the filename matches an existing file, the new data will be appended to
-    that file.
+    that file, unless the file starts with a different header line, e.g.
+    from before a column was added, in which case the data is written to a
+    new numbered file, e.g. ``rat1_..._PM-1.csv``.
+    '''
+
+    session_filename = StringProperty('')
+    '''The pattern used to generate the filenames of the binary session files,
+    which store the trial results as typed columns (see
+    :mod:`forced_choice.session`), in addition to the csv log. If empty, no
+    session file is written.
+
+    The filename is generated like :attr:`log_filename` and the records are
+    appended to the file if it exists. If the existing file was written
+    with a different :attr:`~forced_choice.session.session_version`, the
+    records are written to a new numbered file instead, e.g.
+    ``rat1_session-1.fcs``. The same applies to the csv log when its header
+    line changed.
+    '''
+
+    events_filename = StringProperty('')
+    '''The pattern, passed to `strftime` with the experiment start time, used
+    to generate the filename of the binary events file. If empty, no events
+    file is written.
+
+    The events file records every change of the beams, valves, and the other
+    input and output channels with its timestamp, using
+    :attr:`edge_recorder`. See :mod:`forced_choice.events`.
+    '''
+
+    edge_recorder = None
+    '''The :class:`~forced_choice.events.EdgeRecorder` recording the device
+    channel changes when :attr:`events_filename` is set.
+    '''
+
+    log_flush_interval = NumericProperty(1.)
+    '''The maximum duration, in seconds, that trial log lines may remain in
+    memory before they are flushed to the file. If zero, the lines are flushed
+    as soon as they are written.
+
+    The log is written in a background thread by :attr:`log_writer`, so this
+    never delays the trials.
+    '''
+
+    log_fsync = BooleanProperty(False)
+    '''Whether the trial log is also synced to the disk (``fsync``) whenever
+    it's flushed according to :attr:`log_flush_interval`.
+    '''
+
+    log_writer = None
+    '''The :class:`~forced_choice.writer.TrialLogWriter` that writes the trial
+    log in the background. It's created when the devices are initialized and
+    all its lines are written when the experiment stops.
     '''
 
     filter_len = NumericProperty(1)
     '''The number of previous trials to average when displaying the trial
-    result in the graphs.
+    result in the graphs. It's the window of the
+    :attr:`AnimalStage.stats` moving averages.
+    '''
+
+    schedule_path = StringProperty('schedules')
+    '''The directory where the trial odor schedules computed for each animal
+    are cached. See :mod:`forced_choice.schedule`.
+
+    When an animal is started with a configuration whose schedule was
+    previously computed, the schedule is loaded from this directory rather
+    than computed again. If empty, schedules are not cached.
     '''
 
     _shutting_down_devs = False
 
     @classmethod
     def get_config_classes(cls):
-        d = {
-            'barst_server': Server, 'ftdi_chan': FTDIDevChannel,
-            'devices': RootStage, 'odors': FTDIOdors,
-            'daqout': DAQOutDevice, 'daqin': DAQInDevice, 'mfc_air': MFC,
-            'mfc_a': MFC, 'mfc_b': MFC,
-            '_experiment': {'default': ExperimentConfig}}
+        # the hardware backends are only imported here, if available
+        d = get_hardware_config_classes()
+        d['devices'] = RootStage
+        d['_experiment'] = {'default': ExperimentConfig}
         d.update(ConfigStageBase.get_config_classes())
         return d
 
@@ -287,50 +480,166 @@ class RootStage(ConfigStageBase):
         super(RootStage, self).clear(*largs, **kwargs)
         self._shutting_down_devs = False
 
+    def clean_up(self):
+        '''Called when the stage is done to clean up the stage of its rig.
+        '''
+        rig = self.knspace.rig
+        if rig is not None and rig.root_stage is self:
+            rig.clean_up()
+        else:
+            self.knspace.app.clean_up_root_stage()
+
     @app_error
     def init_devices(self):
         '''Called to start the devices during the init stage.
         '''
-        settings = knspace.app.app_settings
+        settings = self.knspace.app.app_settings
+        rig = self.knspace.rig
+        if rig is not None:
+            settings = rig.get_settings(settings)
         for k, v in settings['devices'].items():
             setattr(self, k, v)
 
+        sim = self.simulate = self.knspace.gui_simulate.state == 'down'
+        key = self.get_devices_key(sim, settings)
+        warm = take_warm_devices(self.knspace)
+        if warm is not None and (
+                not self.keep_devices_warm or warm.key != key):
+            # the parked devices don't match, close them before starting
+            warm.release(lambda graph: self.init_devices(),
+                         timeout=self.deactivation_timeout or None)
+            return
+
         configs = self.configs = {
-            k: ExperimentConfig(**opts)
+            k: ExperimentConfig(
+                knspace=self.knspace, n_valve_boards=self.n_valve_boards,
+                use_mfc=self.use_mfc, **opts)
             for k, opts in settings['_experiment'].items()}
-        for config in configs.values():
-            config.compute_odors()
         if not configs:
             raise Exception('No experiment configuration provided')
 
-        sim = self.simulate = knspace.gui_simulate.state == 'down'
-        tracker = self.tracker = ObjectStateTracker()
-
+        writer = self.log_writer = TrialLogWriter(
+            flush_interval=self.log_flush_interval, fsync=self.log_fsync)
+        writer.start()
+        self.sound_latency_hist = Histogram(0, .1, 200)
+
+        if warm is not None:
+            # the devices are already active, so only re-bind to them
+            for attr, dev in warm.attrs.items():
+                setattr(self, attr, dev)
+            self.odor_widgets = warm.widgets
+            owner = self._owner = warm
+        else:
+            owner = self._owner = \
+                WarmDevices(key) if self.keep_devices_warm else self
+            self.create_devices(sim, settings)
+        self.create_edge_recorder()
+        self.create_latency_spans()
+
+        graph = self.tracker = self.create_device_graph()
+        graph.activate(
+            owner, self._devices_activated,
+            timeout=self.activation_timeout or None,
+            on_timeout=self._devices_activation_timeout)
+
+    def create_devices(self, sim, settings):
+        '''Creates all the devices, and the Barst server and the FTDI channel
+        when not ``sim``.
+        '''
         self.create_odor_devs(sim, settings)
         self.create_daqout_devs(sim, settings)
         self.create_daqin_devs(sim, settings)
         self.create_mfc_devs(sim, settings)
         self.create_sound_devs(sim, settings)
 
-        devs = [self.odor_dev, self.daq_out_dev, self.daq_in_dev, self.mfc_air,
-                self.mfc_a, self.mfc_b, self.sound_l, self.sound_r]
-        devs = [d for d in devs if d]
-
         if not sim:
-            server = self.server = Server(
-                knsname='barst_server', **settings.get('barst_server', {}))
-            ftdi = self.ftdi_chan = FTDIDevChannel(
+            from cplcom.moa.device.ftdi import FTDIDevChannel
+            server = self.server = acquire_server(
+                self._owner, settings.get('barst_server', {}))
+            self.ftdi_chan = FTDIDevChannel(
                 server=server, devs=[self.odor_dev], knsname='ftdi_chan',
-                **settings.get('ftdi_chan', {}))
-
-            for d in devs:
-                d.server = server
-            devs = [server, ftdi] + devs
+                knspace=self.knspace, **settings.get('ftdi_chan', {}))
+            for d in (self.odor_dev, self.daq_out_dev, self.daq_in_dev,
+                      self.mfc_air, self.mfc_a, self.mfc_b, self.sound_l,
+                      self.sound_r):
+                if d is not None:
+                    d.server = server
+
+    def get_devices_key(self, sim, settings):
+        '''Returns a string encoding the device settings, used to check
+        whether parked devices (see :attr:`keep_devices_warm`) can be reused.
+        '''
+        return json.dumps({
+            'simulate': sim,
+            'devices': {k: getattr(self, k) for k in (
+                'n_valve_boards', 'use_mfc', 'use_mfc_air', 'sound_file_r',
+                'sound_file_l', 'valve_widgets', 'sound_engine', 'sound_sink',
+                'sound_sink_file')},
+            'sections': {k: settings.get(k, {}) for k in (
+                'barst_server', 'ftdi_chan', 'odors', 'daqout', 'daqin',
+                'mfc_air', 'mfc_a', 'mfc_b')}}, sort_keys=True)
+
+    def park_warm_devices(self, warm):
+        '''Turns off the valves, daq outputs, and sounds and parks the
+        devices in ``warm``, a :class:`~forced_choice.lifecycle.WarmDevices`,
+        to be reused by the next experiment of the rig.
+        '''
+        for dev in (self.odor_dev, self.daq_out_dev):
+            dev.discard_state()
+        odor_dev = self.odor_dev
+        odor_dev.write_valves(low=np.arange(len(odor_dev.valves)), force=True)
+        self.daq_out_dev.set_state(
+            low=['ir_leds', 'fans', 'house_light', 'feeder_l', 'feeder_r'])
+        for sound in (self.sound_l, self.sound_r):
+            sound.set_state(False)
+
+        warm.attrs = {attr: getattr(self, attr) for attr in self._device_attrs}
+        warm.widgets = self.odor_widgets
+        warm.graph = self.tracker
+        park_devices(self.knspace, warm)
+        Logger.info('Forced choice: Kept the devices open for the next '
+                    'experiment')
+
+    def create_device_graph(self, with_server=True):
+        '''Creates the :class:`~forced_choice.lifecycle.DeviceGraph` of all
+        the devices that are not None. The Barst server comes first, then the
+        FTDI channel, and then the valves. The other server devices only
+        depend on the server, and the sound devices don't depend on anything.
+
+        If ``with_server`` is False, the server is left out of the graph,
+        e.g. when other rigs still use it.
+        '''
+        graph = DeviceGraph()
+        server = []
+        if with_server and self.server is not None:
+            graph.add('server', self.server)
+            server = ['server']
+
+        ftdi = server
+        if self.ftdi_chan is not None:
+            graph.add('ftdi_chan', self.ftdi_chan, server)
+            ftdi = ['ftdi_chan']
+
+        for name, dev, deps in (
+                ('odors', self.odor_dev, ftdi),
+                ('daqout', self.daq_out_dev, server),
+                ('daqin', self.daq_in_dev, server),
+                ('mfc_air', self.mfc_air, server),
+                ('mfc_a', self.mfc_a, server), ('mfc_b', self.mfc_b, server),
+                ('sound_l', self.sound_l, []), ('sound_r', self.sound_r, [])):
+            if dev is not None:
+                graph.add(name, dev, deps)
+        return graph
+
+    def _devices_activated(self, graph):
+        Logger.info('Forced choice: Activated devices in {:.3f}s ({})'.format(
+            graph.elapsed, graph.format_timings()))
+        self.knspace.exp_dev_init.ask_step_stage()
 
-        callbacks = [partial(d.activate, self) for d in devs[1:]]
-        callbacks.append(knspace.exp_dev_init.ask_step_stage)
-        tracker.add_func_links(devs, callbacks, 'activation', 'active')
-        devs[0].activate(self)
+    @app_error
+    def _devices_activation_timeout(self, graph):
+        raise Exception('Timed out activating devices {} ({})'.format(
+            ', '.join(graph.pending), graph.format_timings()))
 
     @app_error
     def step_stage(self, source=None, **kwargs):
@@ -339,104 +648,231 @@ class RootStage(ConfigStageBase):
             return super(RootStage, self).step_stage(source=source, **kwargs)
         self._shutting_down_devs = True
 
-        devs = [self.odor_dev, self.daq_out_dev, self.daq_in_dev, self.mfc_air,
-                self.mfc_a, self.mfc_b, self.sound_l, self.sound_r,
-                self.ftdi_chan, self.server]
-        devs = [d for d in devs if d]
+        recorder = self.edge_recorder
+        if recorder is not None:
+            recorder.unbind_devices()
+            recorder.flush()
+            self.edge_recorder = None
+
+        self.write_sound_latency()
+        self.write_latency_spans()
+        if self.log_writer is not None:
+            self.log_writer.stop()
+            self.log_writer = None
+
+        # stop waiting for the devices if they are still being activated
+        tracker = self.tracker
+        if tracker is not None:
+            tracker.cancel()
+
+        owner = self._owner if self._owner is not None else self
+        if isinstance(owner, WarmDevices) and tracker is not None and \
+                tracker.elapsed is not None and not tracker.pending:
+            self.park_warm_devices(owner)
+            return super(RootStage, self).step_stage(source=source, **kwargs)
+
+        # only the last rig using the shared server waits for it to stop
+        server = self.server
+        shared = server is not None and not release_server(owner, server)
+        if shared:
+            server.deactivate(owner)
 
-        if not devs:
+        graph = self.tracker = self.create_device_graph(with_server=not shared)
+        if not graph.names:
             return super(RootStage, self).step_stage(source=source, **kwargs)
 
-        tracker = self.tracker = ObjectStateTracker()
-        callbacks = [partial(d.deactivate, self, clear=True) for d in devs[1:]]
-        callbacks.append(partial(self.ask_step_stage, source=source, **kwargs))
-        tracker.add_func_links(devs, callbacks, 'activation', 'inactive',
-                               timeout=5.)
-        devs[0].deactivate(self, clear=True)
+        done = partial(self._devices_deactivated, source, kwargs)
+        graph.deactivate(
+            owner, done, timeout=self.deactivation_timeout or None,
+            on_timeout=done, clear=True)
+
+    def _devices_deactivated(self, source, kwargs, graph):
+        if graph.pending:
+            Logger.warning(
+                'Forced choice: Timed out deactivating devices {} ({})'.format(
+                    ', '.join(graph.pending), graph.format_timings()))
+        else:
+            Logger.info(
+                'Forced choice: Deactivated devices in {:.3f}s ({})'.format(
+                    graph.elapsed, graph.format_timings()))
+        self.ask_step_stage(source=source, **kwargs)
+
+    def write_sound_latency(self):
+        '''Logs the summary of the :attr:`sound_latency_hist` and writes it
+        to :attr:`sound_latency_filename`, if set. Called when the experiment
+        stops.
+        '''
+        hist = self.sound_latency_hist
+        if hist is None or not hist.count:
+            return
+
+        Logger.info('Forced choice: Sound cue onset latency {}'.format(
+            hist.format_summary()))
+        if self.sound_latency_filename and self.log_writer is not None:
+            self.log_writer.write(
+                self.sound_latency_filename, '',
+                json.dumps(hist.to_dict()) + '\n',
+                ts=localtime(session_clock.epoch_time))
+
+    def create_latency_spans(self):
+        '''Creates the :attr:`latency_spans` if :attr:`record_latency_spans`
+        and sets it as the recorder of the odor and daq input devices.
+        '''
+        spans = self.latency_spans = None
+        if self.record_latency_spans:
+            spans = self.latency_spans = SpanRecorder()
+        for dev in (self.odor_dev, self.daq_in_dev):
+            if dev is not None:
+                dev.spans = spans
+
+    def write_latency_spans(self):
+        '''Detaches the :attr:`latency_spans` from the devices, logs its
+        summary, and writes it to :attr:`latency_spans_filename`, if set.
+        Called when the experiment stops.
+        '''
+        spans = self.latency_spans
+        if spans is None:
+            return
+        for dev in (self.odor_dev, self.daq_in_dev):
+            if dev is not None:
+                dev.spans = None
+
+        Logger.info('Forced choice: Hot path latency spans\n{}'.format(
+            spans.format_summary()))
+        if self.latency_spans_filename and self.log_writer is not None:
+            self.log_writer.write(
+                self.latency_spans_filename, '', spans.to_json(),
+                ts=localtime(session_clock.epoch_time))
+
+    def create_edge_recorder(self):
+        '''Creates the :attr:`edge_recorder` if :attr:`events_filename` is set
+        and binds it to all the odor valves and the daq input and output
+        channels.
+        '''
+        if not self.events_filename:
+            return
+
+        recorder = self.edge_recorder = EdgeRecorder(
+            self.events_filename, self.log_writer)
+        recorder.bind_valves(self.odor_dev, 'odors')
+        recorder.bind_device(
+            self.daq_in_dev, 'daqin',
+            ('nose_beam', 'reward_beam_l', 'reward_beam_r'))
+        recorder.bind_device(
+            self.daq_out_dev, 'daqout',
+            ('ir_leds', 'fans', 'house_light', 'feeder_l', 'feeder_r'))
 
     def create_odor_devs(self, sim, settings):
         '''Creates the odor device, :attr:`odor_dev`.
         '''
         n_valve_boards = self.n_valve_boards
         dev_cls = [Factory.get('SwitchIcon'), Factory.get('DarkSwitchIcon')]
-        gui_odors = knspace.gui_odors
+        gui_odors = self.knspace.gui_odors
         gui_odors.clear_widgets()
 
-        odor_map = {}
-        for i in range(n_valve_boards * 8):
-            name = 'p{}'.format(i)
-            widget = dev_cls[i % 2](text=name, knsname='gui_' + name)
-            gui_odors.add_widget(widget)
-            odor_map[name] = widget
+        odor_map = self.odor_widgets = {}
+        if sim or self.valve_widgets:
+            for i in range(n_valve_boards * 8):
+                name = 'p{}'.format(i)
+                widget = dev_cls[i % 2](text=name, knspace=self.knspace)
+                gui_odors.add_widget(widget)
+                odor_map[name] = widget
 
-        odorcls = FTDIOdorsSim if sim else FTDIOdors
+        if sim:
+            odorcls = FTDIOdorsSim
+        else:
+            from forced_choice.hardware import FTDIOdors as odorcls
         s = settings.get('odors', {}) if not sim else {}
         self.odor_dev = odorcls(
-            knsname='odors', attr_map=odor_map, n_valve_boards=n_valve_boards,
-            **s)
+            knsname='odors', knspace=self.knspace, attr_map=odor_map,
+            n_valve_boards=n_valve_boards, **s)
 
     def create_daqout_devs(self, sim, settings):
         '''Creates the daq output device, :attr:`daq_out_dev`.
         '''
         daqout_map = {}
         for name in ('ir_leds', 'fans', 'house_light', 'feeder_l', 'feeder_r'):
-            daqout_map[name] = getattr(knspace, 'gui_{}'.format(name))
+            daqout_map[name] = getattr(self.knspace, 'gui_{}'.format(name))
 
-        daqoutcls = DAQOutDeviceSim if sim else DAQOutDevice
+        if sim:
+            daqoutcls = DAQOutDeviceSim
+        else:
+            from forced_choice.hardware import DAQOutDevice as daqoutcls
         s = settings.get('daqout', {}) if not sim else {}
         self.daq_out_dev = daqoutcls(
-            knsname='daqout', attr_map=daqout_map, **s)
+            knsname='daqout', knspace=self.knspace, attr_map=daqout_map, **s)
 
     def create_daqin_devs(self, sim, settings):
         '''Creates the daq input device, :attr:`daq_in_dev`.
         '''
         daqin_map = {}
         for name in ('nose_beam', 'reward_beam_l', 'reward_beam_r'):
-            daqin_map[name] = getattr(knspace, 'gui_{}'.format(name))
+            daqin_map[name] = getattr(self.knspace, 'gui_{}'.format(name))
 
-        daqincls = DAQInDeviceSim if sim else DAQInDevice
+        if sim:
+            daqincls = DAQInDeviceSim
+        else:
+            from forced_choice.hardware import DAQInDevice as daqincls
         s = settings.get('daqin', {}) if not sim else {}
-        self.daq_in_dev = daqincls(knsname='daqin', attr_map=daqin_map, **s)
+        self.daq_in_dev = daqincls(
+            knsname='daqin', knspace=self.knspace, attr_map=daqin_map, **s)
 
     def create_mfc_devs(self, sim, settings):
         '''Creates the MFC devices: :attr:`mfc_air`, :attr:`mfc_a`, and
         :attr:`mfc_b`.
         '''
         if sim:
-            s_air = s_a = a_b = {}
+            s_air = s_a = s_b = {}
             cls = NumericPropertyChannel
         else:
             s_air = settings.get('mfc_air', {})
             s_a = settings.get('mfc_a', {})
             s_b = settings.get('mfc_b', {})
-            cls = MFC
+            from cplcom.moa.device.mfc import MFC as cls
 
-        gui_air = knspace.gui_mfc_air
-        gui_a = knspace.gui_mfc_a
-        gui_b = knspace.gui_mfc_b
+        gui_air = self.knspace.gui_mfc_air
+        gui_a = self.knspace.gui_mfc_a
+        gui_b = self.knspace.gui_mfc_b
 
         mfc = self.use_mfc
+        kns = self.knspace
         if mfc or self.use_mfc_air:
             self.mfc_air = cls(
-                knsname='mfc_air', channel_widget=gui_air, prop_name='value',
-                **s_air)
+                knsname='mfc_air', knspace=kns, channel_widget=gui_air,
+                prop_name='value', **s_air)
             if mfc:
                 self.mfc_a = cls(
-                    knsname='mfc_a', channel_widget=gui_a,
+                    knsname='mfc_a', knspace=kns, channel_widget=gui_a,
                     prop_name='value', **s_a)
                 self.mfc_b = cls(
-                    knsname='mfc_b', channel_widget=gui_b,
+                    knsname='mfc_b', knspace=kns, channel_widget=gui_b,
                     prop_name='value', **s_b)
 
     def create_sound_devs(self, sim, settings):
         '''Creates the sound devices: :attr:`sound_l` and :attr:`sound_r`.
         '''
+        if self.sound_engine == 'memory':
+            from forced_choice.audio import (
+                CueEngine, AudioCueDevice, create_sink)
+            engine = self.cue_engine = CueEngine(
+                create_sink(self.sound_sink, self.sound_sink_file))
+            engine.add_cue('l', self.sound_file_l)
+            engine.add_cue('r', self.sound_file_r)
+            self.sound_l = AudioCueDevice(
+                button=self.knspace.gui_sound_l, knsname='sound_l',
+                knspace=self.knspace, engine=engine, cue='l')
+            self.sound_r = AudioCueDevice(
+                button=self.knspace.gui_sound_r, knsname='sound_r',
+                knspace=self.knspace, engine=engine, cue='r')
+            return
+
+        from cplcom.moa.device.ffplayer import FFPyPlayerAudioDevice
         self.sound_l = FFPyPlayerAudioDevice(
-            button=knspace.gui_sound_l, knsname='sound_l',
-            filename=self.sound_file_l)
+            button=self.knspace.gui_sound_l, knsname='sound_l',
+            knspace=self.knspace, filename=self.sound_file_l)
         self.sound_r = FFPyPlayerAudioDevice(
-            button=knspace.gui_sound_r, knsname='sound_r',
-            filename=self.sound_file_r)
+            button=self.knspace.gui_sound_r, knsname='sound_r',
+            knspace=self.knspace, filename=self.sound_file_r)
 
 
 def _verify_odor_method(val):
@@ -472,6 +908,26 @@ def _verify_list(prop, func, val):
         raise
 
 
+def _equal_random_feasible(counts, cond, last, run):
+    '''Returns whether the values remaining in ``counts`` (the number of
+    times each value still has to occur) can be ordered so that no value
+    occurs more than ``cond`` times successively, given that ``last`` was
+    just repeated ``run`` times.
+
+    A value can be placed in at most one more run than the number of other
+    values remaining, and the first of these runs is shortened when it
+    continues the run of ``last``.
+    '''
+    total = sum(counts)
+    for val, count in enumerate(counts):
+        capacity = cond * (total - count + 1)
+        if val == last:
+            capacity -= run
+        if count > capacity:
+            return False
+    return True
+
+
 class ExperimentConfig(MoaBase):
     '''Stores the configuration parameters for a experiment.
     '''
@@ -482,7 +938,8 @@ class ExperimentConfig(MoaBase):
         'beta_trials_min', 'beta_trials_max', 'odor_equalizer', 'odor_method',
         'NO_valve', 'mix_valve', 'min_nose_poke', 'sound_cue_delay',
         'max_nose_poke', 'sound_dur', 'max_decision_duration', 'num_pellets',
-        'odor_path', 'good_iti', 'bad_iti', 'incomplete_iti', 'odor_selection')
+        'odor_path', 'good_iti', 'bad_iti', 'incomplete_iti', 'odor_selection',
+        'seed')
 
     _list_props = [
         ('num_trials', int), ('wait_for_nose_poke', to_bool),
@@ -518,8 +975,8 @@ class ExperimentConfig(MoaBase):
     def read_odors(self):
         '''Reads odors from a csv file as provided by :attr:`odor_path`.
         '''
-        N = 8 * knspace.exp_root.n_valve_boards
-        use_mfc = knspace.exp_root.use_mfc
+        N = 8 * self.n_valve_boards
+        use_mfc = self.use_mfc
         odor_side = ['rl', ] * N
         valve_mfc = [None, ] * N
         odor_name = ['p{}'.format(i) for i in range(N)]
@@ -593,8 +1050,30 @@ class ExperimentConfig(MoaBase):
         '''Updates the odor and experiment values of the UI using the provided
         configuration parameters.
         '''
-        no = getattr(knspace, 'gui_' + self.NO_valve)
-        mix = getattr(knspace, 'gui_' + self.mix_valve)
+        widgets = self.knspace.exp_root.odor_widgets
+        if widgets:
+            self.apply_valves_ui(widgets)
+
+        time_line = self.knspace.time_line
+        time_line.clear_slices()
+        elems = (
+            (0, 'Init'), (0, 'Ready'), (0, 'Wait NP'),
+            (max(self.max_nose_poke), 'NP'),
+            (max(self.max_decision_duration), 'Wait HP'),
+            (0, 'Reward'),
+            (max([max(self.good_iti), max(self.bad_iti),
+                  max(self.incomplete_iti)]), 'ITI'),
+            (0, 'Done'))
+        for t, name in elems:
+            time_line.add_slice(name=name, duration=t)
+        time_line.smear_slices()
+
+    def apply_valves_ui(self, widgets):
+        '''Updates the valve widgets, ``widgets``, a dict mapping valve names
+        to their widgets, with the odors of the configuration.
+        '''
+        no = widgets[self.NO_valve]
+        mix = widgets[self.mix_valve]
         no.background_down = 'dark-blue-led-on-th.png'
         no.background_normal = 'dark-blue-led-off-th.png'
         mix.background_down = 'brown-led-on-th.png'
@@ -602,8 +1081,7 @@ class ExperimentConfig(MoaBase):
 
         for i, (side, odor_name) in enumerate(
                 zip(self.odor_side, self.odor_names)):
-            name = 'gui_p{}'.format(i)
-            obj = getattr(knspace, name)
+            obj = widgets['p{}'.format(i)]
 
             s = u''
             if 'l' in side:
@@ -615,20 +1093,6 @@ class ExperimentConfig(MoaBase):
 
             obj.text = u'{}\n{}'.format(s, odor_name)
 
-        time_line = knspace.time_line
-        time_line.clear_slices()
-        elems = (
-            (0, 'Init'), (0, 'Ready'), (0, 'Wait NP'),
-            (max(self.max_nose_poke), 'NP'),
-            (max(self.max_decision_duration), 'Wait HP'),
-            (0, 'Reward'),
-            (max([max(self.good_iti), max(self.bad_iti),
-                  max(self.incomplete_iti)]), 'ITI'),
-            (0, 'Done'))
-        for t, name in elems:
-            time_line.add_slice(name=name, duration=t)
-        time_line.smear_slices()
-
     def do_odor_list(self, block, block_odors, odor_opts):
         '''Reads the odor selection for each trial from a list when
         :attr:`odor_method` `'`list'``.
@@ -652,7 +1116,7 @@ class ExperimentConfig(MoaBase):
                             'in the list'.format(block))
 
         odors = extract_odor(read_odors[line_num][1:], block,
-                             knspace.exp_root.n_valve_boards * 8)
+                             self.n_valve_boards * 8)
         odor_opts.append([])
         if any([len(o) != 1 for o in odors]):
             raise Exception('Number of flow rates specified for block'
@@ -666,7 +1130,7 @@ class ExperimentConfig(MoaBase):
         equalizer = self.odor_equalizer[block]
 
         odors = extract_odor(block_odors, block,
-                             knspace.exp_root.n_valve_boards * 8)
+                             self.n_valve_boards * 8)
         odors = [o for elems in odors for o in elems]
         odor_opts.append(odors)
 
@@ -692,75 +1156,178 @@ class ExperimentConfig(MoaBase):
         # the condition for this random method
         condition = int(m.group(1)) if m.group(1) else 0
         if not equalizer:
-            if condition <= 0:  # random without condition
-                return [choice(odors) for _ in range(n)]
-
-            # random with condition
-            rand_odors = []
-            for _ in range(n):
-                o = randint(0, len(odors) - 1)
-                while (len(rand_odors) >= condition and
-                       all([t == o for t in
-                            rand_odors[-condition:]])):
-                    o = randint(0, len(odors) - 1)
-                rand_odors.append(o)
-
+            rand_odors = self.do_markov_random(n, len(odors), condition)
             return [odors[i] for i in rand_odors]
 
         # equalize
         rand_odors = []
+        last_run = 0
         for _ in range(int(ceil(n / float(equalizer)))):
             rand_odors.extend(self.do_equal_random(
                 equalizer, len(odors), condition,
-                last_val=rand_odors[-1] if rand_odors else None))
+                last_val=rand_odors[-1] if rand_odors else None,
+                last_run=last_run))
+            # the run of the last value of the sequence so far
+            last_run = 1
+            while last_run < len(rand_odors) and \
+                    rand_odors[-last_run - 1] == rand_odors[-1]:
+                last_run += 1
         del rand_odors[n:]
 
         return [odors[i] for i in rand_odors]
 
-    def do_equal_random(self, n, m, cond, last_val=None):
+    def do_markov_random(self, n, m, cond):
+        '''Implements the ``randomx`` :attr:`odor_method` when
+        :attr:`odor_equalizer` is not used.
+
+        Returns a list of ``n`` values in ``range(m)``, each uniformly chosen
+        except that if the last ``cond`` values are identical, the next value
+        is uniformly chosen from the other ``m - 1`` values. When ``cond`` is
+        zero, there's no condition.
+
+        This is the same distribution as redrawing a value until it satisfies
+        the condition, but all the values are drawn at once. Each value is
+        drawn as a random offset from the previous value, where an offset of
+        zero repeats it. Every ``cond``'th successive zero offset would break
+        the condition, so only those are redrawn from the non-zero offsets.
+        '''
+        rng = self.rng
+        deltas = rng.randint(0, m, size=n)
+        if cond > 0 and n > 1:
+            repeat = deltas == 0
+            repeat[0] = False
+            idx = np.arange(n)
+            # index of the last non-repeat before each element, so the number
+            # of successive repeats up to each element is the difference
+            start = np.maximum.accumulate(np.where(repeat, 0, idx))
+            forced = repeat & ((idx - start) % cond == 0)
+            deltas[forced] = rng.randint(
+                1, m, size=int(np.count_nonzero(forced)))
+        return (np.cumsum(deltas) % m).tolist()
+
+    def do_equal_random(self, n, m, cond, last_val=None, last_run=1):
         '''Implements :attr:`odor_equalizer` when selected.
+
+        Returns a list of ``n`` values in ``range(m)`` where each value occurs
+        exactly ``n / m`` times and, if ``cond`` is non-zero, no value occurs
+        more than ``cond`` times successively. ``last_val`` is the last value
+        of the previous chunk (or None), which ended with ``last_run``
+        successive ``last_val``, and it counts towards the run of the first
+        values of this chunk.
+
+        The sequence is built one element at a time in ``O(n * m ** 2)``. At
+        each step, the next value is chosen with probability proportional to
+        its remaining count (exactly like a shuffle), from the values that
+        don't break the run condition and that still leave the remaining
+        values arrangeable. So there's never any backtracking or retrying,
+        and nothing is cached between calls.
+
+        Unlike rejecting whole shuffles, the valid orderings are not exactly
+        equally likely, because the orderings that pass through states with
+        fewer valid options are favored. Computed exactly for 4 odors, the
+        total variation distance from the uniform distribution over the
+        valid orderings is 0 for ``random2`` with 8 trials (the condition
+        never binds), 0.08 for ``random2`` with 12 trials, and 0.13 and 0.18
+        for ``random1`` with 8 and 12 trials, respectively. In those cases
+        the most likely ordering is up to 3.6 times as likely as it would be
+        if uniform, and the least likely one is at least 0.68 times as
+        likely. Every valid ordering can occur and each value still occurs
+        exactly ``n / m`` times. When ``cond`` is zero, the values are
+        shuffled so it's exactly uniform.
+
+        A ValueError is raised if the values cannot be ordered to satisfy
+        ``cond``, e.g. if there's a single odor.
         '''
-        vals = []
+        rng = self.rng
         k = n // m
         if n % m:
             raise ValueError("{} odors don't equally divide {}".format(m, n))
 
-        if cond == 1 and m == 2:
-            newvals = [0, 1] if last_val is None or last_val else [1, 0]
-            for i in range(k):
-                vals.extend(newvals)
-            return vals
-
-        for i in range(m):
-            vals.extend([i, ] * k)
-        shuffle(vals)
+        vals = [i for i in range(m) for _ in range(k)]
         if not cond:
+            rng.shuffle(vals)
             return vals
 
-        failed = True
-        while failed:
-            count = 0 if last_val is None else 1
-            last = last_val
-            failed = False
-
-            for val in vals:
-                if val == last:
-                    count += 1
-                else:
-                    last = val
-                    count = 1
+        counts = [k, ] * m
+        last = last_val
+        run = 0 if last_val is None else min(last_run, cond)
+        if not _equal_random_feasible(counts, cond, last, run):
+            raise ValueError(
+                'Cannot order {} odors equally in {} trials with no more than '
+                '{} successive repeats following odor {}'.format(
+                    m, n, cond, last_val))
+
+        for i in range(n):
+            options = []
+            for val in range(m):
+                if not counts[val] or val == last and run >= cond:
+                    continue
 
-                if count > cond:
-                    failed = True
-                    shuffle(vals)
+                counts[val] -= 1
+                if _equal_random_feasible(
+                        counts, cond, val, run + 1 if val == last else 1):
+                    options.append(val)
+                counts[val] += 1
+
+            # the current state is feasible, so there's always an option
+            if not options:
+                raise ValueError(
+                    'No valid odor left for trial {} of the equalized '
+                    'sequence'.format(i))
+
+            r = rng.uniform(0, sum([counts[val] for val in options]))
+            for val in options:
+                r -= counts[val]
+                if r < 0:
                     break
 
+            vals[i] = val
+            counts[val] -= 1
+            if val == last:
+                run += 1
+            else:
+                last = val
+                run = 1
         return vals
 
     @app_error
-    def compute_odors(self):
+    def load_odors(self, animal_id, schedule_path=''):
+        '''Loads the odors for all the trials and blocks for the animal from
+        the schedule cached in ``schedule_path``, e.g.
+        :attr:`RootStage.schedule_path`, or computes them with
+        :meth:`compute_odors` and caches them if they were not cached. If
+        ``schedule_path`` is empty, they are always computed.
+
+        The odors are computed with a seed derived from the schedule key
+        (:func:`~forced_choice.schedule.compute_schedule_key`), so the same
+        animal, configuration, odor files and :attr:`seed` always
+        results in the same odors, even when not cached.
+        '''
+        key = self.schedule_key = compute_schedule_key(self, animal_id)
+
+        fname = ''
+        if schedule_path:
+            fname = schedule_filename(schedule_path, animal_id)
+            schedule = load_schedule(fname, key)
+            if schedule is not None:
+                self.trial_odors, self.odor_opts = schedule
+                return
+
+        self.compute_odors(seed=schedule_seed(key))
+        if fname:
+            save_schedules(fname, {key: (self.trial_odors, self.odor_opts)})
+
+    @app_error
+    def compute_odors(self, seed=None):
         '''Computes the odors for all the trials and blocks.
+
+        :Parameters:
+
+            `seed`: int or None
+                The seed of :attr:`rng` used to generate the random odors. If
+                None, the odors will be different every time.
         '''
+        self.rng = np.random.RandomState(seed)
         odor_method = self.odor_method
         odor_selection = self.odor_selection
         num_trials = self.num_trials
@@ -828,6 +1395,32 @@ class ExperimentConfig(MoaBase):
     the elements returned by :func:`extract_odor`.
     '''
 
+    schedule_key = ''
+    '''The key of the schedule last loaded with :meth:`load_odors`.
+    '''
+
+    rng = None
+    '''The :class:`numpy.random.RandomState` used by :meth:`compute_odors` to
+    generate the random odors.
+    '''
+
+    n_valve_boards = NumericProperty(2)
+    '''The number of valve boards connected, :attr:`RootStage.n_valve_boards`.
+    '''
+
+    use_mfc = BooleanProperty(False)
+    '''Whether a MFC is used for mixing the odor streams,
+    :attr:`RootStage.use_mfc`.
+    '''
+
+    seed = NumericProperty(0)
+    '''The seed from which the random trial odors are generated, along with
+    the animal id and the rest of the configuration.
+
+    With the same seed, an animal always gets the same trial odors for the
+    same configuration. Changing it generates a new set of trial odors.
+    '''
+
     num_blocks = NumericProperty(3)
     '''The number of blocks to run. Each block runs :attr:`num_trials` trials.
 
@@ -1073,8 +1666,11 @@ class AnimalStage(MoaStage):
     '''In this stage, each loop iteration runs another animal.
     '''
 
-    _filename = ''
-    _fd = None
+    log_header = (
+        'Date,Time,RatID,Block,Trial,OdorName, OdorIndex,TrialSide,SideWent,'
+        'Outcome,Rewarded?,TTNP,TINP,TTRP,ITI,SoundLatency\n')
+    '''The header line of the trial log file.
+    '''
 
     config = ObjectProperty(ExperimentConfig(load=False), rebind=True)
     '''The :class:`ExperimentConfig` instance used to configure the current
@@ -1093,7 +1689,11 @@ class AnimalStage(MoaStage):
     '''
 
     trial_start_ts = None
-    '''The start time of the trial in seconds. '''
+    '''The start time of the trial in seconds.
+
+    This and all the other trial timestamps are the seconds since the session
+    started, from :attr:`~forced_choice.timing.session_clock`.
+    '''
 
     trial_start_time = None
     '''The start time of the trial in human readable clock format. '''
@@ -1126,6 +1726,15 @@ class AnimalStage(MoaStage):
     :attr:`RootStage.sound_l`, to use for this trial.
     '''
 
+    sound_request_ts = None
+    '''The time the sound cue was requested with :meth:`play_sound`. '''
+
+    sound_onset_ts = None
+    '''The estimated time the first sample of the sound cue was output, or
+    None if it wasn't played or the sound device doesn't report it. The
+    difference from :attr:`sound_request_ts` is the onset latency.
+    '''
+
     odor = None
     '''The odor to reward for this trial.
     '''
@@ -1151,110 +1760,87 @@ class AnimalStage(MoaStage):
     '''The :class:`forced_choice.graphics.TrialOutcome` widget describing the
     current trial. '''
 
-    total_pass = NumericProperty(0)
-    '''Total number of passed trials for this block. '''
-
-    total_fail = NumericProperty(0)
-    '''Total number of failed trials for this block. '''
+    stats = ObjectProperty(None, allownone=True)
+    '''The :class:`~forced_choice.stats.TrialStats` tracking the outcome and
+    durations of the trials of the block. The total and side statistics use
+    the last :attr:`RootStage.filter_len` trials and the odor statistics use
+    the last :attr:`ExperimentConfig.beta_trials_max` trials of each odor.
+    Reset at each block.
 
-    total_incomplete = NumericProperty(0)
-    '''Total number of incomplete trials for this block. '''
-
-    outcomes = []
-    '''1 or 0 for each trial indicating the trial reward outcome. Reset at each
-    block.
-    '''
-
-    odor_outcome = {}
-    '''keys are the odor indices, values are a list with 0 or 1 indicating the
-    trial reward outcome for that odor. This combines all the blocks for
-    the animal.
+    The property is dispatched whenever a trial outcome is added.
     '''
 
-    odor_widgets = []
-    '''List of :class:`forced_choice.graphics.TrialPrediction` instances
-    for all the blocks, containing all the trials.
-    '''
-
-    predict_widget = None
-    ''':class:`forced_choice.graphics.TrialPrediction` instance for the current
-    trial.
+    odor_opt_valves = None
+    '''A numpy array of the valve indices of the odors in
+    :attr:`ExperimentConfig.odor_opts` for the current block, as returned by
+    :func:`select_odor`.
     '''
 
     def initialize_box(self):
         ''' Turns on fans, lights etc at the beginning of the experiment. '''
-        knspace.daqout.set_state(high=['ir_leds', 'fans'])
+        self.knspace.daqout.queue_state(high=['ir_leds', 'fans'])
 
     def initialize_animal(self):
         '''Executed before the start of a new animal. '''
         # get the config instance for this animal
-        c = self.config = knspace.exp_root.configs[knspace.gui_trial_type.text]
+        kns = self.knspace
+        c = self.config = kns.exp_root.configs[kns.gui_trial_type.text]
         c.knsname = 'exp_config'
-        config = knspace.exp_config
+        config = kns.exp_config
         config.apply_config_ui()
-        config.compute_odors()
+        animal_id = self.animal_id = kns.gui_animal_id.text
+        config.load_odors(animal_id, kns.exp_root.schedule_path)
         names = config.odor_names
-        self.animal_id = knspace.gui_animal_id.text
 
         sides = config.odor_side
-        odor_widgets = self.odor_widgets = []
-        PredictionGrid = Factory.PredictionGrid
-        TrialPrediction = Factory.TrialPrediction
-
-        predict_add = knspace.gui_prediction_container.add_widget
-        knspace.gui_prediction_container.clear_widgets()
 
-        # create the prediction displays for all trials
-        for block, block_odors in enumerate(config.trial_odors):
-            block_grid = PredictionGrid()
-            predict_add(block_grid)
-            block_add = block_grid.add_widget
+        # the predictions of all trials
+        blocks = []
+        for block_odors in config.trial_odors:
+            trials = []
+            blocks.append(trials)
 
-            block_widgets = []
-            odor_widgets.append(block_widgets)
-
-            for trial, odor in enumerate(block_odors):
+            for odor in block_odors:
                 if odor is not None:
                     odor = select_odor(odor)[0]
                     side = sides[odor]
                     if side == '-':
                         side = u'Ø'
-
-                    trial_wid = TrialPrediction(
-                        odor=names[odor], side=side, trial=trial)
+                    trials.append((names[odor], side))
                 else:
-                    trial_wid = TrialPrediction(side='rl', trial=trial)
-
-                block_widgets.append(trial_wid)
-                block_add(trial_wid)
+                    trials.append(('', 'rl'))
+        kns.gui_prediction_container.set_predictions(blocks)
 
     def pre_block(self):
         '''Executed before each block. '''
-        self.block = knspace.exp_block.count
-        self.total_fail = self.total_pass = self.total_incomplete = 0
-        for graph in (knspace.gui_ttnp, knspace.gui_tinp, knspace.gui_ttrp,
-                      knspace.gui_outcome):
-            graph.plots[0].points = []
-        self.outcomes = []
-        self.odor_outcome = defaultdict(list)
+        kns = self.knspace
+        self.block = kns.exp_block.count
+        for graph in (kns.gui_ttnp, kns.gui_tinp, kns.gui_ttrp,
+                      kns.gui_outcome):
+            graph.plots[0].clear_points()
+
+        config = self.config
+        self.stats = TrialStats(
+            config.n_valve_boards * 8, kns.exp_root.filter_len,
+            config.beta_trials_max)
+        self.odor_opt_valves = np.array(
+            [select_odor(o)[0] for o in config.odor_opts[self.block]],
+            dtype=np.int64)
 
     def init_trial(self, block, trial):
         '''Starts the trial.
         '''
-        trial = self.trial = knspace.exp_trial.count
+        trial = self.trial = self.knspace.exp_trial.count
         block = self.block
         config = self.config
-        blocks = knspace.gui_prediction_container.children
-        trials = blocks[-block - 1].children
-        self.predict_widget = trials[-trial - 1]
 
-        knspace.time_line.update_slice_attrs(
+        self.knspace.time_line.update_slice_attrs(
             'NP', text='NP ({}.{})'.format(block, trial),
             duration=config.max_nose_poke[block])
-        knspace.time_line.update_slice_attrs(
+        self.knspace.time_line.update_slice_attrs(
             'Wait HP', duration=config.max_decision_duration[block])
 
-        container = knspace.gui_results_container
+        container = self.knspace.gui_results_container
         self.outcome_wid = widget = container.children[0]
         container.remove_widget(widget)
         container.add_widget(widget, len(container.children))
@@ -1262,6 +1848,7 @@ class AnimalStage(MoaStage):
 
         self.nose_poke_ts = self.odor_start_ts = self.nose_poke_exit_ts = None
         self.reward_entry_ts = self.sound = self.side_went = None
+        self.sound_request_ts = self.sound_onset_ts = None
         self.reward_side = self.outcome = None
         self.reward_entry_timed_out = self.nose_poke_exit_timed_out = False
         self.iti = 0
@@ -1275,8 +1862,8 @@ class AnimalStage(MoaStage):
             widget.side = side = self.side = \
                 config.odor_side[select_odor(odor)[0]]
             if config.sound_dur[block] and side != '-':
-                self.sound = (knspace.sound_r if 'r' in side else
-                              knspace.sound_l)
+                self.sound = (self.knspace.sound_r if 'r' in side else
+                              self.knspace.sound_l)
         self.start_mixing()
 
     def update_trial_odor(self):
@@ -1289,47 +1876,50 @@ class AnimalStage(MoaStage):
             return
 
         beta = config.odor_beta[block]
-        beta_trials_min = max(config.beta_trials_min, 1)
-        beta_trials_max = max(config.beta_trials_max, 1)
-        outcomes = self.odor_outcome
-        widget = self.odor_widgets[block][trial]
-
-        odor_opts = config.odor_opts[block]
-        N = len(odor_opts)
-        odor_idxs = [select_odor(o)[0] for o in odor_opts]
-
-        if not beta or not odor_idxs or not outcomes:
+        valves = self.odor_opt_valves
+        if not beta or not len(valves):
             return
 
-        outcome_frac = np.zeros(N)
-        for i, o in enumerate(odor_idxs):
-            odor_outcome = outcomes[o][-beta_trials_max:]
-            if len(odor_outcome) < beta_trials_min:
-                return
-            outcome_frac[i] = sum(odor_outcome) / float(len(odor_outcome))
+        accuracy = self.stats.by_odor['accuracy']
+        if accuracy.counts[valves].min() < max(config.beta_trials_min, 1):
+            return
 
-        p = np.exp(-beta * np.array(outcome_frac))
-        p *= 1 / float(N)
+        p = np.exp(-beta * accuracy.accuracy(valves))
         p /= np.sum(p)
-        k = uniform(0, 1.)
-
-        cum_sum = np.cumsum(p)
-        cum_sum[-1] = 1.
-        for i, f in enumerate(cum_sum):
-            if k < f:
-                break
+        i = min(int(np.searchsorted(np.cumsum(p), uniform(0, 1.),
+                                    side='right')), len(p) - 1)
 
-        odor = odor_idxs[i]
-        if config.trial_odors[block][trial] == odor:
+        odor_opts = config.odor_opts[block]
+        if config.trial_odors[block][trial] == odor_opts[i]:
             return
 
-        widget.odor = config.odor_names[odor]
+        odor = int(valves[i])
         side = config.odor_side[odor]
         if side == '-':
             side = u'Ø'
-        widget.side = side
+        self.knspace.gui_prediction_container.update_prediction(
+            block, trial, odor=config.odor_names[odor], side=side)
         config.trial_odors[block][trial] = odor_opts[i]
 
+    def add_stat(self, metric, value):
+        '''Adds the value of the metric, e.g. ``ttnp``, of the current trial
+        to :attr:`stats`.
+        '''
+        odor = self.odor
+        self.stats.add(
+            metric, value, None if odor is None else select_odor(odor)[0],
+            self.side)
+
+    def add_outcome(self, outcome):
+        '''Adds the outcome, ``pass``, ``fail``, or ``inc``, of the current
+        trial to :attr:`stats`.
+        '''
+        odor = self.odor
+        self.stats.add_outcome(
+            outcome, None if odor is None else select_odor(odor)[0],
+            self.side)
+        self.property('stats').dispatch(self)
+
     def start_mixing(self):
         '''Opens the odor valves to start mixing with the air stream, but
         directs it to the vacuum.
@@ -1340,138 +1930,196 @@ class AnimalStage(MoaStage):
         if odor is None:
             return
 
-        if knspace.exp_root.use_mfc:  # laterz
+        if self.knspace.exp_root.use_mfc:  # laterz
             raise NotImplementedError()
         else:
-            knspace.odors.set_state(
-                high=['p{}'.format(select_odor(odor)[0]), config.NO_valve])
+            odors = self.knspace.odors
+            odors.queue_valves(high=[
+                select_odor(odor)[0], odors.valve_index[config.NO_valve]])
 
     def pre_trial(self):
         '''Executed before each trial. '''
-        self.trial_start_ts = clock()
-        self.trial_start_time = strftime('%H:%M:%S')
+        spans = self.knspace.exp_root.latency_spans
+        if spans is not None:
+            spans.reset()
+        ts = self.trial_start_ts = session_clock.now()
+        self.trial_start_time = strftime(
+            '%H:%M:%S', localtime(session_clock.to_absolute(ts)))
 
     def do_nose_poke(self):
         '''Executed after the first nose port entry of the trial. '''
-        self.nose_poke_ts = clock()
+        t = self.nose_poke_ts = session_clock.now()
+        spans = self.knspace.exp_root.latency_spans
+        if spans is not None:
+            spans.mark('nose_poke', t)
         ttnp = self.outcome_wid.ttnp = self.nose_poke_ts - self.trial_start_ts
-        knspace.gui_ttnp.plots[0].points.append((self.trial, ttnp))
+        self.add_stat('ttnp', ttnp)
+        self.knspace.gui_ttnp.plots[0].add_point(self.trial, ttnp)
+
+    def start_odor_delay(self, delay):
+        '''Executed when the ``delay`` long odor delay, after the nose port
+        entry, starts. It's only used to measure the latency spans of the
+        trial.
+        '''
+        spans = self.knspace.exp_root.latency_spans
+        if spans is not None:
+            t = session_clock.now()
+            spans.mark('odor_delay_start', t)
+            spans.mark('odor_delay_due', t + delay)
 
     def do_odor_release(self):
         '''After :meth:`start_mixing`, it redirects the already mixing odor
         to the animal.
         '''
-        knspace.odors.set_state(high=[self.config.mix_valve])
-        self.odor_start_ts = clock()
+        spans = self.knspace.exp_root.latency_spans
+        if spans is not None:
+            spans.mark('odor_release')
+        odors = self.knspace.odors
+        odors.queue_valves(high=[odors.valve_index[self.config.mix_valve]])
+        self.odor_start_ts = session_clock.now()
+
+    def play_sound(self):
+        '''Starts playing the :attr:`sound` cue of the trial. '''
+        self.sound_request_ts = session_clock.now()
+        self.sound.set_state(True)
+
+    def stop_sound(self):
+        '''Stops playing the :attr:`sound` cue of the trial. '''
+        self.sound.set_state(False)
+
+    def get_sound_latency(self):
+        '''Returns the onset latency, in seconds, of the trial's sound cue,
+        from when it was requested with :meth:`play_sound` until its first
+        sample was output, or None if it's unknown.
+
+        The onset is reported by the sound device using the clock of its
+        sink (see :meth:`~forced_choice.audio.AudioCueDevice.get_onset`), so
+        it includes the time from the request until the cue was mixed into
+        the output, as well as the output latency of the sound card.
+        '''
+        get_onset = getattr(self.sound, 'get_onset', None)
+        if self.sound_request_ts is None or get_onset is None:
+            return None
+
+        if self.sound_onset_ts is None:
+            onset = get_onset()
+            if onset is None or onset[0] < self.sound_request_ts:
+                return None
+            self.sound_onset_ts = onset[1]
+        return self.sound_onset_ts - self.sound_request_ts
 
     def do_nose_poke_exit(self, timed_out):
         '''Executed after the first nose port exit of the trial. '''
-        te = self.nose_poke_exit_ts = clock()
+        te = self.nose_poke_exit_ts = session_clock.now()
 
         # turn off odor
         config, block, trial = self.config, self.block, self.trial
-        if knspace.exp_root.use_mfc:
+        if self.knspace.exp_root.use_mfc:
             raise NotImplementedError()
         else:
-            knspace.odors.set_state(
-                low=['p{}'.format(select_odor(self.odor)[0]),
-                     config.NO_valve, config.mix_valve])
+            odors = self.knspace.odors
+            index = odors.valve_index
+            odors.queue_valves(low=[
+                select_odor(self.odor)[0], index[config.NO_valve],
+                index[config.mix_valve]])
 
         self.nose_poke_exit_timed_out = timed_out
         wid = self.outcome_wid
         tinp = wid.tinp = te - self.nose_poke_ts
-        knspace.gui_tinp.plots[0].points.append((trial, tinp))
+        self.add_stat('tinp', tinp)
+        self.knspace.gui_tinp.plots[0].add_point(trial, tinp)
 
         if not timed_out:
             min_poke = config.min_nose_poke[block]
             if min_poke > 0 and tinp < min_poke:
                 self.outcome = 'inc'
                 self.reward_side = False
-                self.total_incomplete += 1
                 wid.passed = False
                 wid.incomplete = True
                 self.iti = wid.iti = config.incomplete_iti[block]
 
-                predict = self.predict_widget
-                predict.outcome = False
-                predict.outcome_text = 'INC'
-                self.outcomes.append(0)
+                self.knspace.gui_prediction_container.update_prediction(
+                    block, trial, outcome=False, outcome_text='INC')
+                self.add_outcome('inc')
 
     def do_decision(self, r, l, timed_out):
         '''Executed after the reward port entry or after waiting for the
         reward port entry timed out. It decides whether the animal is
         rewarded.
         '''
-        ts = self.reward_entry_ts = clock()
+        ts = self.reward_entry_ts = session_clock.now()
         config, block, trial = self.config, self.block, self.trial
         odor = self.odor and select_odor(self.odor)
         wid = self.outcome_wid
-        predict = self.predict_widget
+        predict = {}
         side = self.side
         wfnp = config.wait_for_nose_poke[block]
 
         self.reward_entry_timed_out = timed_out
         if not timed_out:
-            predict.side_went = wid.side_went = side_went = self.side_went = \
-                'r' if r else 'l'
+            predict['side_went'] = wid.side_went = side_went = \
+                self.side_went = 'r' if r else 'l'
             wid.ttrp = ts - (self.nose_poke_exit_ts if self.nose_poke_exit_ts
                              is not None else self.trial_start_ts)
-            knspace.gui_ttrp.plots[0].points.append((trial, wid.ttrp))
-
+            self.add_stat('ttrp', wid.ttrp)
+            self.knspace.gui_ttrp.plots[0].add_point(trial, wid.ttrp)
 
         reward = not timed_out and (odor is None or (
             side == 'rl' or side == side_went) and random() <= odor[1])
-        predict.outcome = wid.passed = passed = not timed_out and (
+        predict['outcome'] = wid.passed = passed = not timed_out and (
             not wfnp or (side == 'rl' or side == side_went))
-        self.outcomes.append(int(predict.outcome))
-        if odor is not None:
-            self.odor_outcome[odor[0]].append(passed)
 
         wid.iti = self.iti = (
             config.good_iti[block] if passed else config.bad_iti[block])
         self.reward_side = reward and ('feeder_' + side_went)
         if reward:
-            predict.side_rewarded = wid.rewarded = side_went
+            predict['side_rewarded'] = wid.rewarded = side_went
         self.outcome = 'pass' if passed else 'fail'
-
-        if passed:
-            self.total_pass += 1
-            predict.outcome_text = 'PASS'
-        else:
-            self.total_fail += 1
-            predict.outcome_text = 'FAIL'
+        predict['outcome_text'] = 'PASS' if passed else 'FAIL'
+        self.knspace.gui_prediction_container.update_prediction(
+            block, trial, **predict)
+        self.add_outcome(self.outcome)
 
     def post_trial(self):
         '''Executed after each trial. '''
-        fname = strftime(
-            knspace.exp_root.log_filename.format(**{'trial': self.trial,
-            'block': self.block, 'animal': self.animal_id}))
-        filename = self._filename
-        o = self.outcomes[-knspace.exp_root.filter_len:]
-        knspace.gui_outcome.plots[0].points.append((
-            self.trial, sum(o) / max(1., float(len(o))) * 100))
-
-        if filename != fname:
-            if not fname:
-                return
-            fd = self._fd
-            if fd is not None:
-                fd.close()
-            fd = self._fd = open(fname, 'a')
-            fd.write('Date,Time,RatID,Block,Trial,OdorName, OdorIndex,'
-                     'TrialSide,SideWent,Outcome,Rewarded?,TTNP,TINP,TTRP,'
-                     'ITI\n')
-            self._filename = fname
-        elif not filename:
+        root = self.knspace.exp_root
+        if root.edge_recorder is not None:
+            root.edge_recorder.flush()
+
+        accuracy = self.stats.mean('accuracy')
+        self.knspace.gui_outcome.plots[0].add_point(
+            self.trial, 0. if accuracy != accuracy else accuracy * 100)
+
+        if root.latency_spans is not None:
+            root.latency_spans.commit()
+
+        sound_latency = self.get_sound_latency()
+        if sound_latency is not None:
+            root.sound_latency_hist.add(sound_latency)
+            if root.max_sound_latency and \
+                    sound_latency > root.max_sound_latency:
+                Logger.warning(
+                    'Forced choice: Sound cue onset latency of trial {} was '
+                    '{:.2f}ms'.format(self.trial, sound_latency * 1e3))
+
+        fmt = {'trial': self.trial, 'block': self.block,
+               'animal': self.animal_id}
+        fname = root.log_filename.format(**fmt)
+        session_fname = root.session_filename.format(**fmt)
+        writer = root.log_writer
+        if not fname and not session_fname or writer is None:
             return
-        else:
-            fd = self._fd
 
         ts = self.trial_start_ts
         np = self.nose_poke_ts
         ne = self.nose_poke_exit_ts
         rp = self.reward_entry_ts
+        ttnp = (np - ts) if np is not None else None
+        tinp = (ne - np) if ne is not None and np is not None else None
+        ttrp = (rp - (ne if ne is not None else ts)) if rp is not None \
+            else None
 
+        odor_idx = None
         if self.odor is not None:
             odor_idx = select_odor(self.odor)[0]
             odor_name = self.config.odor_names[odor_idx]
@@ -1479,18 +2127,27 @@ class AnimalStage(MoaStage):
         else:
             odor_i = odor_name = ''
 
-        outcome = {'fail': 0, 'pass': 1, 'inc': 2, None: None}
-        vals = [strftime('%m-%d-%Y'), self.trial_start_time, self.animal_id,
-                self.block, self.trial,
+        outcome = {'fail': 0, 'pass': 1, 'inc': 2, None: None}[self.outcome]
+        t = localtime(session_clock.to_absolute(session_clock.now()))
+        if session_fname:
+            writer.write(
+                session_fname, session_header(), session_record(
+                    self.block, self.trial, odor_idx, self.side,
+                    self.side_went, outcome, bool(self.reward_side), ttnp,
+                    tinp, ttrp, self.iti, sound_latency), ts=t, binary=True)
+        if not fname:
+            return
+
+        vals = [strftime('%m-%d-%Y', t), self.trial_start_time,
+                self.animal_id, self.block, self.trial,
                 odor_name, odor_i,
-                self.side, self.side_went, outcome[self.outcome],
-                bool(self.reward_side), (np - ts) if np else None,
-                (ne - np) if ne and np else None,
-                (rp - (ne if ne else ts)) if rp else None, self.iti]
+                self.side, self.side_went, outcome,
+                bool(self.reward_side), ttnp, tinp, ttrp, self.iti,
+                sound_latency]
         for i, val in enumerate(vals):
             if val is None:
                 vals[i] = ''
             elif isinstance(val, bool):
                 vals[i] = str(int(val))
-        fd.write(','.join(map(str, vals)))
-        fd.write('\n')
+        writer.write(fname, self.log_header, ','.join(map(str, vals)) + '\n',
+                     ts=t)
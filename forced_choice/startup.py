@@ -0,0 +1,158 @@
+'''Startup
+==========
+
+The entry point of the ``forced_choice`` script, which can profile the app
+startup.
+
+When the script is run with ``--profile-startup``, :func:`run_app` installs
+a :class:`StartupProfiler` before anything else is imported, so it times
+the import of every module and the loading of every kv file until the app
+starts. The report is printed once the app started, e.g.::
+
+    forced_choice --profile-startup
+
+Only the first import of each module is timed. The import time of a module
+is reported both including and excluding the modules it imported itself.
+'''
+
+import sys
+from time import time
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+__all__ = ('StartupProfiler', 'profiler', 'report_startup', 'run_app')
+
+
+class StartupProfiler(object):
+    '''Times the module imports and the kv file loading after it's
+    :meth:`install`-ed.
+    '''
+
+    imports = []
+    '''A list with a ``(name, total, self)`` tuple for each imported module,
+    in the order their import finished. ``total`` is the duration, in
+    seconds, of the import and ``self`` excludes the imports of other modules
+    during it.
+    '''
+
+    kv_files = []
+    '''A list with a ``(filename, duration)`` tuple for each kv file loaded.
+    '''
+
+    start = 0.
+    '''The time when the profiler was installed.
+    '''
+
+    _import = None
+
+    _load_file = None
+
+    def __init__(self):
+        self.imports = []
+        self.kv_files = []
+        self._stack = []
+
+    def install(self):
+        '''Starts timing the imports and the kv files.
+        '''
+        self.start = time()
+        self._import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+        from kivy.lang.builder import BuilderBase
+        self._load_file = original = BuilderBase.load_file
+        kv_files = self.kv_files
+
+        def load_file(builder, filename, **kwargs):
+            t = time()
+            try:
+                return original(builder, filename, **kwargs)
+            finally:
+                kv_files.append((filename, time() - t))
+        BuilderBase.load_file = load_file
+
+    def uninstall(self):
+        '''Stops timing.
+        '''
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+        if self._load_file is not None:
+            from kivy.lang.builder import BuilderBase
+            BuilderBase.load_file = self._load_file
+            self._load_file = None
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(),
+                      level=0):
+        if level > 0 or name in sys.modules:
+            return self._import(name, globals, locals, fromlist, level)
+
+        stack = self._stack
+        stack.append(0.)
+        t = time()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            total = time() - t
+            children = stack.pop()
+            if stack:
+                stack[-1] += total
+            self.imports.append((name, total, total - children))
+
+    def format_report(self, n=25):
+        '''Returns the report of the ``n`` slowest module imports, by their
+        own import time, and of all the kv files.
+        '''
+        elapsed = time() - self.start
+        imports = sorted(self.imports, key=lambda item: item[2], reverse=True)
+        total = sum(item[2] for item in self.imports)
+        kv_total = sum(item[1] for item in self.kv_files)
+
+        lines = ['Startup took {:.3f}s, {:.3f}s importing {} modules and '
+                 '{:.3f}s loading {} kv files'.format(
+                     elapsed, total, len(self.imports), kv_total,
+                     len(self.kv_files)),
+                 '{:>9} {:>9}  {}'.format('Self', 'Total', 'Module')]
+        for name, t, self_t in imports[:n]:
+            lines.append('{:8.3f}s {:8.3f}s  {}'.format(self_t, t, name))
+        lines.append('{:>9}  {}'.format('Load', 'Kv file'))
+        for filename, t in self.kv_files:
+            lines.append('{:8.3f}s  {}'.format(t, filename))
+        return '\n'.join(lines)
+
+
+profiler = None
+'''The :class:`StartupProfiler` when the app was started with
+``--profile-startup``, otherwise None.
+'''
+
+
+def report_startup():
+    '''Prints the startup report and stops the :attr:`profiler`, if the app
+    was started with ``--profile-startup``. Called by the app once it
+    started.
+    '''
+    global profiler
+    if profiler is None:
+        return
+    profiler.uninstall()
+    print(profiler.format_report())
+    profiler = None
+
+
+def run_app():
+    '''The entry point of the ``forced_choice`` script, which runs
+    :func:`forced_choice.main.run_app`, profiling the startup if
+    ``--profile-startup`` is in the command line arguments.
+    '''
+    global profiler
+    if '--profile-startup' in sys.argv:
+        sys.argv.remove('--profile-startup')
+        profiler = StartupProfiler()
+        profiler.install()
+
+    from forced_choice.main import run_app
+    return run_app()
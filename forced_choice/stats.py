@@ -0,0 +1,394 @@
+'''Statistics
+==============
+
+Running statistics of the animal's performance that are updated in constant
+time on every trial, no matter how many trials preceded it.
+
+:class:`TrialStats` is the statistics engine of the
+:class:`~forced_choice.stages.AnimalStage`. It tracks the trial accuracy and
+the trial durations broken down by odor and by side, using
+:class:`RollingWindow` instances that each keep a moving window and an
+exponential moving average of their values.
+
+:class:`Histogram` accumulates the distribution of a duration, e.g. the onset
+latency of the sound cues, into fixed bins allocated up front, so it can be
+updated on every trial, or in a hot path, without allocating memory.
+'''
+
+import numpy as np
+
+__all__ = ('RollingWindow', 'RollingAccuracy', 'TrialStats', 'Histogram')
+
+
+class RollingWindow(object):
+    '''Tracks, for each of a number of groups, the moving average over the
+    last :attr:`capacity` values added to that group, as well as their
+    exponential moving average.
+
+    The values of each group are stored in a ring buffer along with their
+    running sum, so adding a value and reading the average of any number of
+    groups takes constant time.
+    '''
+
+    capacity = 1
+    '''The number of the last values of each group that are used to compute
+    its moving average. Older values are dropped.
+    '''
+
+    alpha = .1
+    '''The smoothing factor, between zero and one, of the exponential moving
+    average. The larger it is, the faster older values are discounted.
+    '''
+
+    values = None
+    '''A 2d array of the last :attr:`capacity` values of each group, used as a
+    ring buffer.
+    '''
+
+    counts = None
+    '''A 1d array of the number of values currently in :attr:`values` for
+    each group, up to :attr:`capacity`.
+    '''
+
+    sums = None
+    '''A 1d array of the sum of the values currently in :attr:`values` for
+    each group.
+    '''
+
+    pos = None
+    '''A 1d array of the index in :attr:`values` where the next value of each
+    group is stored.
+    '''
+
+    emas = None
+    '''A 1d array of the exponential moving average of all the values added
+    to each group, or ``nan`` for groups without values.
+    '''
+
+    def __init__(self, n_groups, capacity, alpha=.1, dtype=np.float64):
+        self.capacity = capacity = max(int(capacity), 1)
+        self.alpha = alpha
+        self.values = np.zeros((n_groups, capacity), dtype=dtype)
+        self.counts = np.zeros(n_groups, dtype=np.int64)
+        self.sums = np.zeros(
+            n_groups, dtype=np.float64 if self.values.dtype.kind == 'f'
+            else np.int64)
+        self.pos = np.zeros(n_groups, dtype=np.int64)
+        self.emas = np.full(n_groups, np.nan)
+
+    def add(self, group, value):
+        '''Adds the value to the group, dropping the oldest value of that
+        group if there are :attr:`capacity` values.
+        '''
+        i = self.pos[group]
+        values = self.values
+        if self.counts[group] == self.capacity:
+            self.sums[group] -= values[group, i]
+        else:
+            self.counts[group] += 1
+
+        values[group, i] = value
+        self.sums[group] += values[group, i]
+        i = self.pos[group] = (i + 1) % self.capacity
+        # recompute the float sums once per cycle so rounding errors don't
+        # accumulate, which keeps the amortized cost constant
+        if not i and values.dtype.kind == 'f':
+            self.sums[group] = values[group].sum()
+
+        ema = self.emas[group]
+        if ema != ema:
+            self.emas[group] = value
+        else:
+            self.emas[group] = ema + self.alpha * (value - ema)
+
+    def mean(self, groups):
+        '''Returns an array of the moving average of each of the ``groups``
+        (an array of group indices). Groups without any values have an
+        average of ``nan``.
+        '''
+        counts = self.counts[groups]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sums[groups] / counts.astype(np.float64)
+
+    def ema(self, groups):
+        '''Returns an array of the exponential moving average of each of the
+        ``groups`` (an array of group indices).
+        '''
+        return self.emas[groups]
+
+
+class RollingAccuracy(RollingWindow):
+    '''A :class:`RollingWindow` that tracks, for each valve, the accuracy of
+    the animal over the last :attr:`capacity` trials of that valve.
+    '''
+
+    def __init__(self, n_valves, capacity, alpha=.1):
+        super(RollingAccuracy, self).__init__(
+            n_valves, capacity, alpha=alpha, dtype=np.uint8)
+
+    def add(self, valve, outcome):
+        '''Adds the outcome (True/False) of a trial of the valve, dropping the
+        oldest outcome of that valve if there are :attr:`capacity` outcomes.
+        '''
+        super(RollingAccuracy, self).add(valve, int(bool(outcome)))
+
+    def accuracy(self, valves):
+        '''Returns an array of the accuracy, the fraction of passed trials, of
+        each of the ``valves`` (an array of valve indices). Valves without any
+        trials have an accuracy of zero.
+        '''
+        counts = self.counts[valves]
+        return self.sums[valves] / np.maximum(counts, 1).astype(np.float64)
+
+
+class TrialStats(object):
+    '''The statistics of the trials of a block.
+
+    For each of the :attr:`metrics`, the values are tracked in total, by
+    the side of the trial, and by the trial odor valve. The total and side
+    statistics use the last :attr:`window` trials, while the odor statistics
+    use the last :attr:`odor_window` trials of each odor.
+
+    The ``accuracy`` metric is 1 for passed trials and 0 otherwise.
+    Incomplete trials count as failures in the total and side accuracy, but
+    are not counted in the odor accuracy, which is used for the odor bias
+    compensation.
+    '''
+
+    metrics = ('accuracy', 'ttnp', 'tinp', 'ttrp')
+    '''The names of the tracked metrics.
+    '''
+
+    sides = ('l', 'r')
+    '''The sides by which the metrics are broken down. Trials with other
+    sides, e.g. ``rl``, are only counted in the total.
+    '''
+
+    window = 1
+    '''The number of the last trials used for the total and side moving
+    averages.
+    '''
+
+    odor_window = 1
+    '''The number of the last trials of each odor used for the odor moving
+    averages.
+    '''
+
+    total = {}
+    '''A dict mapping each metric to its :class:`RollingWindow`, with a
+    single group, for all the trials.
+    '''
+
+    by_side = {}
+    '''A dict mapping each metric to its :class:`RollingWindow`, with a group
+    for each of the :attr:`sides`.
+    '''
+
+    by_odor = {}
+    '''A dict mapping each metric to its :class:`RollingWindow`, with a group
+    for each odor valve. The ``accuracy`` is a :class:`RollingAccuracy`.
+    '''
+
+    counts = {}
+    '''A dict with the number of ``pass``, ``fail``, and ``inc`` trials.
+    '''
+
+    def __init__(self, n_valves, window, odor_window, alpha=.1):
+        self.window = window
+        self.odor_window = odor_window
+        self.counts = {'pass': 0, 'fail': 0, 'inc': 0}
+        self.total = total = {}
+        self.by_side = by_side = {}
+        self.by_odor = by_odor = {}
+
+        for metric in self.metrics:
+            dtype = np.uint8 if metric == 'accuracy' else np.float64
+            total[metric] = RollingWindow(1, window, alpha, dtype)
+            by_side[metric] = RollingWindow(
+                len(self.sides), window, alpha, dtype)
+            by_odor[metric] = RollingWindow(
+                n_valves, odor_window, alpha, dtype)
+        by_odor['accuracy'] = RollingAccuracy(n_valves, odor_window, alpha)
+
+    def add(self, metric, value, odor=None, side=None):
+        '''Adds the value of the metric for a trial of the odor valve and
+        side, either of which may be None.
+        '''
+        self.total[metric].add(0, value)
+        if side in self.sides:
+            self.by_side[metric].add(self.sides.index(side), value)
+        if odor is not None:
+            self.by_odor[metric].add(odor, value)
+
+    def add_outcome(self, outcome, odor=None, side=None):
+        '''Adds the outcome, one of ``pass``, ``fail``, or ``inc``, of a
+        trial of the odor valve and side, either of which may be None.
+        '''
+        self.counts[outcome] += 1
+        passed = int(outcome == 'pass')
+        if outcome == 'inc':
+            odor = None
+        self.add('accuracy', passed, odor, side)
+
+    def _window(self, metric, odor, side):
+        if odor is not None:
+            return self.by_odor[metric], odor
+        if side is not None:
+            return self.by_side[metric], self.sides.index(side)
+        return self.total[metric], 0
+
+    def mean(self, metric, odor=None, side=None):
+        '''Returns the moving average of the metric for the odor valve, or
+        the side if ``odor`` is None, or all the trials if both are None. It
+        is ``nan`` if there are no trials.
+        '''
+        window, group = self._window(metric, odor, side)
+        return float(window.mean(group))
+
+    def ema(self, metric, odor=None, side=None):
+        '''Like :meth:`mean`, but returns the exponential moving average.
+        '''
+        window, group = self._window(metric, odor, side)
+        return float(window.ema(group))
+
+
+class Histogram(object):
+    '''A histogram of values, e.g. durations in seconds, with :attr:`n_bins`
+    bins of equal width between :attr:`low` and :attr:`high`.
+
+    The bins are allocated when the histogram is created, and values below
+    :attr:`low` or at or above :attr:`high` are counted in the underflow and
+    overflow bins, respectively. Adding a value takes constant time and
+    doesn't allocate memory.
+    '''
+
+    low = 0.
+    '''The lower edge of the first bin.
+    '''
+
+    high = 1.
+    '''The upper edge of the last bin.
+    '''
+
+    n_bins = 1
+    '''The number of bins between :attr:`low` and :attr:`high`.
+    '''
+
+    counts = None
+    '''A 1d array of the number of values in each bin. It has
+    :attr:`n_bins` + 2 elements, the first is the underflow bin and the last
+    is the overflow bin.
+    '''
+
+    count = 0
+    '''The number of values added.
+    '''
+
+    total = 0.
+    '''The sum of the values added.
+    '''
+
+    min = float('inf')
+    '''The smallest value added.
+    '''
+
+    max = float('-inf')
+    '''The largest value added.
+    '''
+
+    _scale = 1.
+
+    def __init__(self, low, high, n_bins):
+        if high <= low or n_bins < 1:
+            raise ValueError('Invalid histogram range [{}, {}) with {} bins'.
+                             format(low, high, n_bins))
+        self.low = float(low)
+        self.high = float(high)
+        self.n_bins = n_bins = int(n_bins)
+        self._scale = n_bins / (self.high - self.low)
+        self.counts = np.zeros(n_bins + 2, dtype=np.int64)
+        self.clear()
+
+    def clear(self):
+        '''Removes all the values.
+        '''
+        self.counts[:] = 0
+        self.count = 0
+        self.total = 0.
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, value):
+        '''Adds the value to its bin.
+        '''
+        if value < self.low:
+            i = 0
+        elif value >= self.high:
+            i = self.n_bins + 1
+        else:
+            i = min(int((value - self.low) * self._scale), self.n_bins - 1) + 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def edges(self):
+        '''A 1d array of the :attr:`n_bins` + 1 edges of the bins.
+        '''
+        return np.linspace(self.low, self.high, self.n_bins + 1)
+
+    def mean(self):
+        '''Returns the mean of the values added, or ``nan`` if none were.
+        '''
+        if not self.count:
+            return float('nan')
+        return self.total / self.count
+
+    def percentile(self, q):
+        '''Returns the ``q``-th percentile, between 0 and 100, of the values
+        added, or ``nan`` if none were.
+
+        The percentile is estimated as the upper edge of the bin it falls in,
+        so it's accurate to one bin width. It's :attr:`min` or :attr:`max`
+        if it falls in the underflow or overflow bin, respectively.
+        '''
+        if not self.count:
+            return float('nan')
+        rank = max(q / 100. * self.count, 1)
+        i = int(np.searchsorted(np.cumsum(self.counts), rank))
+        if i == 0:
+            return self.min
+        if i > self.n_bins:
+            return self.max
+        return min(self.low + i / self._scale, self.max)
+
+    def to_dict(self):
+        '''Returns a json serializable dict of the histogram and its summary
+        statistics.
+        '''
+        nan = self.count == 0
+        return {
+            'low': self.low, 'high': self.high, 'n_bins': self.n_bins,
+            'counts': self.counts.tolist(), 'count': self.count,
+            'mean': None if nan else self.mean(),
+            'min': None if nan else self.min,
+            'max': None if nan else self.max,
+            'p50': None if nan else self.percentile(50),
+            'p90': None if nan else self.percentile(90),
+            'p99': None if nan else self.percentile(99)}
+
+    def format_summary(self, scale=1e3, unit='ms'):
+        '''Returns a one line summary of the histogram, e.g. for logging,
+        with the values multiplied by ``scale`` and shown in ``unit``.
+        '''
+        if not self.count:
+            return 'n=0'
+        return 'n={}, mean={:.2f}{u}, p50={:.2f}{u}, p90={:.2f}{u}, ' \
+            'p99={:.2f}{u}, max={:.2f}{u}'.format(
+                self.count, self.mean() * scale, self.percentile(50) * scale,
+                self.percentile(90) * scale, self.percentile(99) * scale,
+                self.max * scale, u=unit)
@@ -0,0 +1,305 @@
+'''Status
+=========
+
+A status board shared between processes, through which each rig process
+publishes the live state of its experiment.
+
+The board is a small memory mapped file holding a table with one
+:attr:`status_dtype` row for each rig. The rig process updates its row with a
+:class:`StatusPublisher`, a few times a second, with the current block,
+trial, and stage, the running outcome totals, and the latencies of the last
+trial. Any other process, e.g. the dashboard started by the
+:mod:`forced_choice.supervisor`, can read all the rows with
+:meth:`StatusBoard.read` without locking or otherwise interfering with the
+rig processes.
+
+Each row has a sequence number, ``seq``, that is odd while the row is being
+written, so readers can tell when they read a partially written row and
+retry.
+
+Only :class:`StatusPublisher`, which runs in the rig processes, uses kivy,
+which it imports when it's created. So the supervisor and the dashboard can
+read the board without setting up kivy.
+'''
+
+import json
+import os
+from time import time, strftime, localtime
+
+import numpy as np
+
+__all__ = ('status_dtype', 'stage_names', 'StatusBoard', 'StatusPublisher',
+           'format_status')
+
+status_magic = b'FCSTATUS\n'
+'''The first line of every status board file.
+'''
+
+status_version = 1
+'''The version of the status board file format.
+'''
+
+status_dtype = np.dtype([
+    ('seq', '<u4'), ('pid', '<i4'), ('state', 'u1'), ('stage', 'u1'),
+    ('block', '<i4'), ('trial', '<i4'), ('passed', '<i4'), ('failed', '<i4'),
+    ('incomplete', '<i4'), ('ttnp', '<f8'), ('tinp', '<f8'), ('ttrp', '<f8'),
+    ('updated', '<f8'), ('name', 'S32'), ('animal', 'S32')])
+'''The numpy dtype of a rig's row. The columns are:
+
+    `seq`: The sequence number, incremented before and after each update.
+    `pid`: The process id of the rig process.
+    `state`: The index in :attr:`states` of the state of the rig process.
+    `stage`: The index in :attr:`stage_names` of the current stage.
+    `block`, `trial`: The current zero-based block and trial numbers.
+    `passed`, `failed`, `incomplete`: The outcome totals of the block.
+    `ttnp`, `tinp`, `ttrp`: The latencies of the last trial, or ``nan``.
+    `updated`: The wall time of the last update.
+    `name`, `animal`: The rig name and the current animal id.
+'''
+
+states = ('starting', 'running', 'done', 'failed', 'stale')
+'''The states of a rig process. ``'stale'`` is only set by
+:meth:`StatusBoard.read` for rows it could not read consistently.
+'''
+
+stage_names = (
+    'Idle', 'Init', 'Wait animal', 'Trial', 'Wait NP', 'NP', 'Wait HP',
+    'Done')
+'''The names of the stages published in the ``stage`` column.
+'''
+
+_stage_knsnames = (
+    (1, 'exp_dev_init'), (2, 'exp_animal_wait'), (3, 'exp_trial'),
+    (4, 'exp_nose_poke_wait'), (5, 'exp_nose_poke'), (6, 'exp_decision'))
+
+_header_align = 64
+
+
+class StatusBoard(object):
+    '''The status board file, memory mapped.
+
+    The file is created with :meth:`create` by the supervisor and opened by
+    the rig and dashboard processes by instantiating the class with the
+    filename.
+    '''
+
+    filename = ''
+    '''The filename of the board.
+    '''
+
+    rows = None
+    '''The numpy memory map of the :attr:`status_dtype` rows.
+    '''
+
+    def __init__(self, filename, mode='r+'):
+        self.filename = filename
+        with open(filename, 'rb') as fh:
+            if fh.readline() != status_magic:
+                raise ValueError(
+                    '"{}" is not a status board file'.format(filename))
+            desc = json.loads(fh.readline().decode('utf8'))
+            offset = fh.tell()
+
+        if desc['version'] != status_version:
+            raise ValueError('Status board "{}" version {} is not supported'.
+                             format(filename, desc['version']))
+        self.rows = np.memmap(
+            filename, dtype=status_dtype, mode=mode, offset=offset,
+            shape=(desc['n_rigs'], ))
+
+    @classmethod
+    def create(cls, filename, names):
+        '''Creates the board file, with a row for each of the rig ``names``,
+        and returns the opened :class:`StatusBoard`.
+        '''
+        desc = json.dumps({'version': status_version,
+                           'dtype': status_dtype.descr,
+                           'n_rigs': len(names)})
+        header = status_magic + desc.encode('utf8')
+        n = len(header) + 1
+        header += b' ' * (-n % _header_align) + b'\n'
+
+        rows = np.zeros(len(names), dtype=status_dtype)
+        rows['name'] = [name.encode('utf8')[:32] for name in names]
+        for key in ('block', 'trial'):
+            rows[key] = -1
+        for key in ('ttnp', 'tinp', 'ttrp'):
+            rows[key] = np.nan
+        with open(filename, 'wb') as fh:
+            fh.write(header)
+            fh.write(rows.tobytes())
+        return cls(filename)
+
+    def update(self, index, **values):
+        '''Updates the columns of the row ``index`` with the given values.
+        '''
+        row = self.rows[index:index + 1]
+        seq = int(row['seq'][0])
+        row['seq'] = seq + 1
+        for key, value in values.items():
+            row[key] = value
+        row['updated'] = time()
+        row['seq'] = seq + 2
+
+    def read(self, retries=100):
+        '''Returns a consistent copy of all the rows.
+
+        A row that is still being written after ``retries`` attempts is
+        returned with the ``'stale'`` state (see :attr:`states`) and without
+        any of its values except for its name, rather than partially
+        written.
+        '''
+        rows = self.rows
+        result = np.array(rows)
+        for i in range(len(result)):
+            for _ in range(retries):
+                seq = rows['seq'][i]
+                row = np.array(rows[i:i + 1])
+                if not seq % 2 and seq == row['seq'][0] == rows['seq'][i]:
+                    result[i] = row[0]
+                    break
+            else:
+                stale = np.zeros(1, dtype=status_dtype)
+                stale['name'] = rows['name'][i]
+                stale['state'] = states.index('stale')
+                for key in ('block', 'trial'):
+                    stale[key] = -1
+                for key in ('ttnp', 'tinp', 'ttrp'):
+                    stale[key] = np.nan
+                result[i] = stale[0]
+        return result
+
+    def close(self):
+        '''Flushes and closes the memory map.
+        '''
+        if self.rows is not None:
+            if self.rows.mode != 'r':
+                self.rows.flush()
+            self.rows = None
+
+
+class StatusPublisher(object):
+    '''Periodically publishes the state of the experiment running in this
+    process to a row of a :class:`StatusBoard`.
+
+    The state is read from the stages named in :attr:`knspace` with the
+    kivy ``Clock``, so nothing is added to the trial stages themselves.
+    '''
+
+    board = None
+    '''The :class:`StatusBoard`.
+    '''
+
+    index = 0
+    '''The index of the row of the rig in the :attr:`board`.
+    '''
+
+    interval = .25
+    '''The interval, in seconds, between updates.
+    '''
+
+    knspace = None
+    '''The namespace of the rig's stages. Defaults to the global ``knspace``.
+    '''
+
+    _event = None
+
+    def __init__(self, board, index, interval=.25, namespace=None):
+        self.board = board
+        self.index = index
+        self.interval = interval
+        if namespace is None:
+            from kivy.uix.behaviors.knspace import knspace as namespace
+        self.knspace = namespace
+
+    def start(self):
+        '''Starts publishing.
+        '''
+        from kivy.clock import Clock
+        self.board.update(self.index, pid=os.getpid(), state=0)
+        if self._event is None:
+            self._event = Clock.schedule_interval(self.publish, self.interval)
+
+    def stop(self, failed=False):
+        '''Stops publishing, after a last update marking the rig as done or
+        ``failed``.
+        '''
+        if self._event is not None:
+            self._event.cancel()
+            self._event = None
+        self.publish()
+        self.board.update(self.index, state=3 if failed else 2)
+
+    def current_stage(self):
+        '''Returns the index in :attr:`stage_names` of the current stage.
+        '''
+        kns = self.knspace
+        root = kns.exp_root
+        if root is None or not root.started:
+            return 0
+        if root.finished:
+            return len(stage_names) - 1
+
+        current = 0
+        for i, name in _stage_knsnames:
+            stage = getattr(kns, name)
+            if stage is not None and stage.started and not stage.finished:
+                current = i
+        return current
+
+    def publish(self, *largs):
+        '''Updates the row with the current state of the experiment.
+        '''
+        kns = self.knspace
+        values = {'stage': self.current_stage()}
+        root = kns.exp_root
+        if root is not None and root.started and not root.finished:
+            values['state'] = 1
+
+        stage = kns.exp_animal_stage
+        if stage is not None:
+            values['block'] = stage.block
+            values['trial'] = stage.trial
+            values['animal'] = stage.animal_id.encode('utf8')[:32]
+            stats = stage.stats
+            if stats is not None:
+                counts = stats.counts
+                values['passed'] = counts['pass']
+                values['failed'] = counts['fail']
+                values['incomplete'] = counts['inc']
+
+            ts, np_ = stage.trial_start_ts, stage.nose_poke_ts
+            ne, rp = stage.nose_poke_exit_ts, stage.reward_entry_ts
+            if ts is not None and np_ is not None:
+                values['ttnp'] = np_ - ts
+            if np_ is not None and ne is not None:
+                values['tinp'] = ne - np_
+            if rp is not None and (ne is not None or ts is not None):
+                values['ttrp'] = rp - (ne if ne is not None else ts)
+        self.board.update(self.index, **values)
+
+
+def format_status(rows, now=None):
+    '''Returns a text table of the status board ``rows``, as returned by
+    :meth:`StatusBoard.read`.
+    '''
+    now = time() if now is None else now
+    lines = ['{:<12} {:<8} {:<10} {:<11} {:>5} {:>5} {:>5} {:>5} {:>5} '
+             '{:>7} {:>7} {:>7} {:>6}'.format(
+                 'Rig', 'State', 'Animal', 'Stage', 'Block', 'Trial', 'Pass',
+                 'Fail', 'Inc', 'TTNP', 'TINP', 'TTRP', 'Age')]
+    for row in rows:
+        latencies = [
+            '{:7.3f}'.format(row[k]) if row[k] == row[k] else '{:>7}'.format(
+                '-') for k in ('ttnp', 'tinp', 'ttrp')]
+        age = now - row['updated'] if row['updated'] else float('nan')
+        lines.append(
+            '{:<12} {:<8} {:<10} {:<11} {:>5} {:>5} {:>5} {:>5} {:>5} '
+            '{} {} {} {:6.1f}'.format(
+                row['name'].decode('utf8')[:12], states[row['state']],
+                row['animal'].decode('utf8')[:10],
+                stage_names[row['stage']], row['block'], row['trial'],
+                row['passed'], row['failed'], row['incomplete'],
+                latencies[0], latencies[1], latencies[2], age))
+    lines.append(strftime('%m-%d-%Y %H:%M:%S', localtime(now)))
+    return '\n'.join(lines)
@@ -0,0 +1,227 @@
+'''Supervisor
+=============
+
+Runs each rig in its own headless process, rather than all the rigs in one
+app as in :mod:`forced_choice.rig`.
+
+:func:`run_supervisor`, the entry point of the ``forced_choice_supervisor``
+script, starts a process for each rig listed in the rigs json file (see
+:mod:`forced_choice.rig`). Each process runs the rig's experiment with a
+real time :class:`~forced_choice.simulation.HeadlessExperiment`, without a
+window, pinned to its own cpu core. This way, e.g. the garbage collection or
+the work of one rig never delays the valve timing of another rig.
+
+Each rig process publishes its state to a shared
+:class:`~forced_choice.status.StatusBoard`, which a dashboard process prints
+periodically for all the rigs.
+
+In addition to the settings sections, the dict of each rig in the rigs file
+may have a ``supervisor`` dict with the ``animals`` list of the ids of the
+animals to run in order, and the ``cpu`` index of the core to which to pin
+the rig process. E.g.::
+
+    [
+        {"name": "box1", "supervisor": {"animals": ["rat1", "rat2"]}},
+        {"name": "box2", "supervisor": {"animals": ["rat3"], "cpu": 3},
+         "daqin": {"nose_beam_pin": 5}}
+    ]
+
+The experiment is then started with::
+
+    forced_choice_supervisor config.json rigs.json
+'''
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import traceback
+from time import sleep
+from multiprocessing import Process, cpu_count
+
+__all__ = ('pin_cpu', 'run_rig', 'run_dashboard', 'run_supervisor')
+
+
+def pin_cpu(cpu):
+    '''Pins the current process to the cpu core index ``cpu``.
+
+    :returns:
+
+        True if the process was pinned, or False if it's not supported on
+        this platform.
+    '''
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {cpu})
+        return True
+
+    try:
+        import psutil
+    except ImportError:
+        return False
+    psutil.Process().cpu_affinity([cpu])
+    return True
+
+
+def run_rig(json_config_path, status_path, index, rig, experiment='default',
+            cpu=None, simulate=False, model=None, seed=None):
+    '''Runs the experiment of a rig in the current process, publishing its
+    state to row ``index`` of the status board ``status_path``. Started by
+    :func:`run_supervisor` in each rig process.
+
+    ``rig`` is the dict of the rig from the rigs file. With ``simulate``,
+    the simulated devices are used instead of the actual devices, in which
+    case when the :class:`~forced_choice.agents.BehaviorModel` options,
+    ``model``, are given an :class:`~forced_choice.agents.Agent` with the
+    ``seed`` plays the animal.
+    '''
+    if cpu is not None and not pin_cpu(cpu):
+        sys.stderr.write('Cannot pin rig "{}" to cpu {}\n'.format(
+            rig['name'], cpu))
+
+    # import here, so kivy is only set up in the rig processes
+    from forced_choice.simulation import HeadlessExperiment
+    from forced_choice.status import StatusBoard, StatusPublisher
+
+    settings = dict(rig)
+    name = settings.pop('name')
+    opts = settings.pop('supervisor', {})
+    agents = []
+    if simulate and model is not None:
+        from forced_choice.agents import Agent, BehaviorModel
+        agents.append(Agent(BehaviorModel(**model), seed=seed))
+
+    board = StatusBoard(status_path)
+    publisher = StatusPublisher(board, index)
+    publisher.start()
+    failed = True
+    try:
+        sim = HeadlessExperiment(
+            json_config_path, opts.get('animals', []), experiment,
+            idle_timeout=None, agents=agents, realtime=True,
+            simulate=simulate, rig_name=name, rig_settings=settings)
+        sim.run()
+        failed = False
+    except Exception:
+        traceback.print_exc()
+        raise
+    finally:
+        publisher.stop(failed=failed)
+        board.close()
+
+
+def run_dashboard(status_path, interval=1.):
+    '''Prints the status board ``status_path`` to the terminal every
+    ``interval`` seconds, forever. Started by :func:`run_supervisor` in the
+    dashboard process.
+    '''
+    from forced_choice.status import StatusBoard, format_status
+
+    board = StatusBoard(status_path, mode='r')
+    while True:
+        # clear the terminal and print from the top
+        sys.stdout.write('\x1b[H\x1b[2J' + format_status(board.read()) + '\n')
+        sys.stdout.flush()
+        sleep(interval)
+
+
+def run_supervisor(args=None):
+    '''The entry point of the ``forced_choice_supervisor`` script, which
+    starts a process for each rig in the rigs file, and a dashboard process,
+    and waits for all the rigs to finish.
+    '''
+    parser = argparse.ArgumentParser(
+        description='Runs each rig in its own headless process.')
+    parser.add_argument(
+        'config', help='The json config file of the experiment.')
+    parser.add_argument(
+        'rigs', help='The json file listing the rigs.')
+    parser.add_argument(
+        '-e', '--experiment', default='default',
+        help='The name of the experiment in the config.')
+    parser.add_argument(
+        '--status', default=None,
+        help='The status board file. Defaults to a file in the temp '
+        'directory.')
+    parser.add_argument(
+        '--interval', type=float, default=1.,
+        help='The dashboard refresh interval, in seconds.')
+    parser.add_argument(
+        '--no-dashboard', action='store_true',
+        help='Do not start the dashboard process.')
+    parser.add_argument(
+        '--simulate', action='store_true',
+        help='Use the simulated devices instead of the actual devices.')
+    parser.add_argument(
+        '-m', '--model', default=None,
+        help='When simulating, a json file with the agent behavior model '
+        'options of the agents that play the animals.')
+    parser.add_argument(
+        '-s', '--seed', type=int, default=None,
+        help='The seed of the first agent, incremented for each rig.')
+    args = parser.parse_args(args)
+
+    from forced_choice.status import StatusBoard, format_status
+
+    config = os.path.abspath(args.config)
+    with open(args.rigs, 'r') as fh:
+        rigs = json.load(fh)
+    if not rigs:
+        raise ValueError('No rigs listed in "{}"'.format(args.rigs))
+    for i, rig in enumerate(rigs):
+        rig.setdefault('name', 'Rig {}'.format(i))
+
+    model = None
+    if args.model is not None:
+        with open(args.model, 'r') as fh:
+            model = json.load(fh)
+
+    status_path = args.status or os.path.join(
+        tempfile.gettempdir(), 'forced_choice_status_{}.bin'.format(
+            os.getpid()))
+    board = StatusBoard.create(status_path, [rig['name'] for rig in rigs])
+
+    # leave the first core to the supervisor and the dashboard
+    n_cpus = cpu_count()
+    procs = []
+    for i, rig in enumerate(rigs):
+        cpu = rig.get('supervisor', {}).get('cpu', (i + 1) % n_cpus)
+        proc = Process(
+            target=run_rig, name=rig['name'], args=(
+                config, status_path, i, rig, args.experiment, cpu,
+                args.simulate, model,
+                None if args.seed is None else args.seed + i))
+        proc.start()
+        procs.append(proc)
+
+    dashboard = None
+    if not args.no_dashboard:
+        dashboard = Process(
+            target=run_dashboard, name='dashboard',
+            args=(status_path, args.interval))
+        dashboard.daemon = True
+        dashboard.start()
+
+    try:
+        for proc in procs:
+            proc.join()
+    except KeyboardInterrupt:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.join()
+    finally:
+        if dashboard is not None:
+            dashboard.terminate()
+            dashboard.join()
+
+    print(format_status(board.read()))
+    board.close()
+    failed = [proc.name for proc in procs if proc.exitcode]
+    if failed:
+        sys.stderr.write('Rigs failed: {}\n'.format(', '.join(failed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run_supervisor()
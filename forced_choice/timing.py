@@ -0,0 +1,82 @@
+'''Timing
+=========
+
+The clock used to timestamp all the trial events.
+
+All timestamps come from a monotonic, high resolution clock (``perf_counter``)
+that is not affected by changes to the system time. They are expressed in
+seconds since the anchor of the :class:`SessionClock`, which records the wall
+time of the anchor so that any timestamp can be converted to an absolute time.
+'''
+
+from time import time
+try:
+    from time import perf_counter_ns as _clock_ns
+except ImportError:
+    try:
+        from time import perf_counter as _clock
+    except ImportError:
+        from timeit import default_timer as _clock
+
+    def _clock_ns():
+        return int(_clock() * 1e9)
+
+__all__ = ('SessionClock', 'session_clock')
+
+
+class SessionClock(object):
+    '''A monotonic nanosecond clock anchored at the start of the session.
+    '''
+
+    epoch_ns = 0
+    '''The monotonic clock value, in nanoseconds, at the anchor.
+    '''
+
+    epoch_time = 0.
+    '''The wall time (``time.time()``), in seconds since the unix epoch, at the
+    anchor.
+    '''
+
+    clock_ns = staticmethod(_clock_ns)
+    '''The function returning the monotonic clock value in nanoseconds.
+    Defaults to ``perf_counter_ns``, but it can be replaced, e.g. with the
+    :class:`~forced_choice.simulation.VirtualClock` when simulating.
+    '''
+
+    def __init__(self):
+        self.anchor()
+
+    def anchor(self):
+        '''Sets the anchor of the clock to now. Typically called once at the
+        start of a session.
+        '''
+        # take the wall time in between to halve the error between them
+        clock_ns = self.clock_ns
+        t0 = clock_ns()
+        self.epoch_time = time()
+        t1 = clock_ns()
+        self.epoch_ns = (t0 + t1) // 2
+
+    def now_ns(self):
+        '''Returns the nanoseconds elapsed since the anchor, as an int.
+        '''
+        return self.clock_ns() - self.epoch_ns
+
+    def now(self):
+        '''Returns the seconds elapsed since the anchor, as a float.
+        '''
+        return (self.clock_ns() - self.epoch_ns) / 1e9
+
+    def to_absolute(self, ts):
+        '''Converts the timestamp ``ts``, as returned by :meth:`now`, to the
+        wall time in seconds since the unix epoch.
+        '''
+        return self.epoch_time + ts
+
+
+session_clock = SessionClock()
+'''The :class:`SessionClock` used to timestamp all the trial events. It is
+shared by all the rigs, and is anchored by
+:meth:`~forced_choice.main.ForcedChoiceApp.start_stage` when the experiment
+starts while no rig is running.
+'''
@@ -0,0 +1,238 @@
+'''Writer
+=========
+
+Writes the trial logs to disk from a background thread, so that slow disks
+never delay the experiment.
+'''
+
+import os
+from time import localtime, strftime, time
+from threading import Thread
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
+
+from kivy.logger import Logger
+
+__all__ = ('TrialLogWriter', )
+
+
+class TrialLogWriter(object):
+    '''Writes the lines of the trial log files in a background thread.
+
+    Lines are added to a queue of at most :attr:`max_queued` lines with
+    :meth:`write` and the thread writes all the lines that are queued in a
+    single batch. The file is flushed at most every :attr:`flush_interval`
+    seconds, and optionally fsynced.
+
+    :meth:`write` never blocks. If the disk stalls and the queue is full, the
+    line is dropped and counted in :attr:`dropped`, so the memory used stays
+    bounded. An error is logged at the first dropped line, and the number of
+    lines dropped is logged once the thread catches up.
+
+    The thread is started with :meth:`start` and :meth:`stop` waits until all
+    the queued lines are written before closing the file.
+    '''
+
+    flush_interval = 1.
+    '''The maximum duration, in seconds, that written lines can remain
+    unflushed. If zero, the file is flushed after every batch of lines.
+    '''
+
+    fsync = False
+    '''Whether to also ``fsync`` the file when it's flushed, so that the lines
+    are on the disk and not just in the os buffers.
+    '''
+
+    max_queued = 1000
+    '''The maximum number of lines waiting to be written. Once that many are
+    waiting, e.g. when the disk stalls, new lines are dropped.
+    '''
+
+    dropped = 0
+    '''The total number of lines dropped because the queue was full.
+    '''
+
+    thread = None
+    '''The thread writing the lines, while started.
+    '''
+
+    _overflowing = False
+
+    def __init__(self, flush_interval=1., fsync=False, max_queued=1000):
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_queued = max_queued
+        self.queue = Queue(maxsize=max_queued)
+
+    def start(self):
+        '''Starts the writing thread.
+        '''
+        if self.thread is not None:
+            return
+        thread = self.thread = Thread(
+            target=self._run, name='TrialLogWriter')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self, timeout=None):
+        '''Writes all the queued lines, closes the file and stops the thread.
+        '''
+        thread = self.thread
+        if thread is None:
+            return
+        self.queue.put(None)
+        thread.join(timeout)
+        self.thread = None
+
+    def write(self, filename, header, line, ts=None, binary=False):
+        '''Queues the line to be written to the file.
+
+        Each distinct ``filename`` pattern is a separate stream with its own
+        open file, so lines of different files can be interleaved.
+
+        :Parameters:
+
+            `filename`: str
+                The filename pattern passed to ``strftime`` along with ``ts``
+                to get the filename.
+            `header`: str or bytes
+                The line written before the first line, whenever the filename
+                of the pattern changes from the previous line. If ``binary``,
+                it's only written when the file is empty. If the file already
+                starts with a different header, e.g. written with an older
+                version of the format, the lines are written to a new
+                numbered file instead, see :meth:`open_file`.
+            `line`: str or bytes
+                The line to write.
+            `ts`: :class:`time.struct_time`
+                The time used to format ``filename``. Defaults to now.
+            `binary`: bool
+                Whether ``header`` and ``line`` are bytes to be appended to a
+                binary file.
+        '''
+        try:
+            self.queue.put_nowait((
+                filename, localtime() if ts is None else ts, header, line,
+                binary))
+        except Full:
+            self.dropped += 1
+            if not self._overflowing:
+                self._overflowing = True
+                Logger.error(
+                    'TrialLogWriter: {} lines are waiting to be written, '
+                    'dropping new lines. Is the disk stalled?'.format(
+                        self.max_queued))
+
+    def open_file(self, filename, header, binary=False):
+        '''Opens the file for appending, or if it's not empty and doesn't
+        start with ``header``, the first of ``<name>-1<ext>``,
+        ``<name>-2<ext>``, etc. that is empty or starts with ``header``, so
+        that lines of different formats are never mixed in one file.
+
+        :returns:
+
+            A 2-tuple of the name of the file opened and the file.
+        '''
+        base, ext = os.path.splitext(filename)
+        fname = filename
+        i = 0
+        while header and not self._has_header(fname, header, binary):
+            i += 1
+            fname = '{}-{}{}'.format(base, i, ext)
+        if i:
+            Logger.warning(
+                'TrialLogWriter: "{}" has a different header, writing to '
+                '"{}" instead'.format(filename, fname))
+        return fname, open(fname, 'ab' if binary else 'a')
+
+    def _has_header(self, filename, header, binary):
+        '''Returns whether the file doesn't exist, is empty, or starts with
+        ``header``.
+        '''
+        if not os.path.exists(filename) or not os.path.getsize(filename):
+            return True
+        with open(filename, 'rb' if binary else 'r') as fh:
+            return fh.read(len(header)) == header
+
+    def _write_item(self, files, item):
+        '''Writes the queued item to its file, opening it if needed.
+        '''
+        pattern, ts, header, line, binary = item
+        fname = strftime(pattern, ts)
+        filename, fd = files.get(pattern, ('', None))
+
+        if fname != filename:
+            if fd is not None:
+                del files[pattern]
+                fd.close()
+
+            path, fd = self.open_file(fname, header, binary)
+            files[pattern] = fname, fd
+            if not binary or not os.path.getsize(path):
+                fd.write(header)
+        fd.write(line)
+
+    def _flush(self, files):
+        '''Flushes, and syncs if :attr:`fsync`, all the open files.
+        '''
+        for filename, fd in files.values():
+            try:
+                fd.flush()
+                if self.fsync:
+                    os.fsync(fd.fileno())
+            except Exception as e:
+                Logger.error('TrialLogWriter: Failed flushing "{}": {}'.
+                             format(filename, e))
+
+    def _run(self):
+        queue = self.queue
+        flush_interval = self.flush_interval
+        # for each pattern, its current filename and file
+        files = {}
+        last_flush = time()
+        dirty = done = False
+        # the number of dropped lines already logged
+        reported = 0
+
+        try:
+            while not done:
+                try:
+                    items = [queue.get(timeout=flush_interval or None)]
+                except Empty:
+                    items = []
+                while True:
+                    try:
+                        items.append(queue.get_nowait())
+                    except Empty:
+                        break
+
+                for item in items:
+                    if item is None:
+                        done = True
+                        continue
+
+                    try:
+                        self._write_item(files, item)
+                        dirty = True
+                    except Exception as e:
+                        Logger.error(
+                            'TrialLogWriter: Failed writing to "{}": {}'.
+                            format(item[0], e))
+
+                dropped = self.dropped
+                if dropped != reported and queue.empty():
+                    self._overflowing = False
+                    Logger.error(
+                        'TrialLogWriter: Caught up writing the queued lines, '
+                        '{} lines were dropped'.format(dropped - reported))
+                    reported = dropped
+
+                if dirty and (done or time() - last_flush >= flush_interval):
+                    self._flush(files)
+                    last_flush = time()
+                    dirty = False
+        finally:
+            for _, fd in files.values():
+                fd.close()
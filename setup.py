@@ -26,5 +26,11 @@ setup(
     install_requires=['pymoa', 'pybarst', 'ffpyplayer', 'cplcom'],
     package_data={'forced_choice': ['data/*', '*.kv']},
     entry_points={'console_scripts':
-                  ['forced_choice=forced_choice.main:run_app']},
+                  ['forced_choice=forced_choice.startup:run_app',
+                   'forced_choice_precompute='
+                   'forced_choice.precompute:run_precompute',
+                   'forced_choice_simulate='
+                   'forced_choice.simulation:run_simulation',
+                   'forced_choice_supervisor='
+                   'forced_choice.supervisor:run_supervisor']},
 )